@@ -1,8 +1,10 @@
+import itertools
 import logging
 
 import app_util
-from flask import request, jsonify, url_for
+from flask import request, jsonify, url_for, Response, stream_with_context
 from flask_restful import Resource
+from json_encoder import RdrJsonEncoder
 from model.utils import to_client_participant_id
 from query import OrderBy, Query
 from werkzeug.exceptions import BadRequest, NotFound
@@ -10,6 +12,8 @@ from werkzeug.exceptions import BadRequest, NotFound
 
 DEFAULT_MAX_RESULTS = 100
 MAX_MAX_RESULTS = 10000
+# Number of bundle entries converted to JSON at a time when streaming bundles.
+STREAM_CHUNK_SIZE = 500
 
 
 class BaseApi(Resource):
@@ -20,10 +24,15 @@ class BaseApi(Resource):
 
   For APIs that support PUT requests as well, extend from UpdatableApi instead.
 
+  Subclasses can set stream_bundles to write list results out as they are converted to JSON (see
+  make_streaming_bundle_response), rather than building the whole Bundle in memory first.
+
   When extending this class, prefer to use the method_decorators class property
   for uniform authentication, e.g.:
     method_decorators = [app_util.auth_required_cron]
   """
+  stream_bundles = False
+
   def __init__(self, dao, get_returns_children=False):
     self.dao = dao
     self._get_returns_children = get_returns_children
@@ -64,6 +73,11 @@ class BaseApi(Resource):
   def _make_response(self, obj):
     return self.dao.to_client_json(obj)
 
+  def _make_responses(self, objs):
+    """Returns the JSON for a page of results. Subclasses that don't customize _make_response can
+    override this to use BaseDao.to_client_json_list."""
+    return [self._make_response(obj) for obj in objs]
+
   def _get_model_to_insert(self, resource, participant_id=None):
     # Children of participants accept a participant_id parameter to from_client_json; others don't.
     if participant_id is not None:
@@ -120,6 +134,8 @@ class BaseApi(Resource):
     order_by = None
     missing_id_list = ['awardee', 'organization', 'site']
     include_total = request.args.get('_includeTotal', False)
+    # _includeTotal=estimated allows a cheaper, approximate total.
+    estimate_total = include_total == 'estimated'
     offset = request.args.get('_offset', False)
 
     for key, value in request.args.iteritems(multi=True):
@@ -145,7 +161,7 @@ class BaseApi(Resource):
         if field_filter:
           field_filters.append(field_filter)
     return Query(field_filters, order_by, max_results, pagination_token,
-                 include_total=include_total, offset=offset)
+                 include_total=include_total, offset=offset, estimate_total=estimate_total)
 
   def _make_bundle(self, results, id_field, participant_id):
     import main
@@ -156,17 +172,22 @@ class BaseApi(Resource):
 
       next_url = main.api.url_for(self.__class__, _external=True, **query_params)
       bundle_dict['link'] = [{"relation": "next", "url": next_url}]
-    entries = []
-    for item in results.items:
-      json = self._make_response(item)
-      full_url = self._make_resource_url(json, id_field, participant_id)
-      entries.append({"fullUrl": full_url,
-                     "resource": json})
-    bundle_dict['entry'] = entries
     if results.total is not None:
       bundle_dict['total'] = results.total
+      bundle_dict['totalType'] = 'estimated' if results.total_estimated else 'exact'
+    entry_chunks = self._make_entry_chunks(results.items, id_field, participant_id)
+    if self.stream_bundles:
+      return make_streaming_bundle_response(bundle_dict, entry_chunks)
+    bundle_dict['entry'] = [entry for entries in entry_chunks for entry in entries]
     return bundle_dict
 
+  def _make_entry_chunks(self, items, id_field, participant_id):
+    """Yields lists of Bundle entries for items, STREAM_CHUNK_SIZE at a time."""
+    for start in range(0, len(items), STREAM_CHUNK_SIZE):
+      yield [{"fullUrl": self._make_resource_url(json, id_field, participant_id),
+              "resource": json}
+             for json in self._make_responses(items[start:start + STREAM_CHUNK_SIZE])]
+
   def _make_resource_url(self, json, id_field, participant_id):
     import main
     if participant_id:
@@ -259,17 +280,17 @@ def _parse_etag(etag):
   raise BadRequest("Invalid ETag: %s" % etag)
 
 
-def get_sync_results_for_request(dao, max_results):
+def get_sync_results_for_request(dao, max_results, stream=False):
   token = request.args.get('_token')
   count_str = request.args.get('_count')
   count = int(count_str) if count_str else max_results
 
   results = dao.query(Query([], OrderBy('logPositionId', True),
                             count, token, always_return_token=True))
-  return make_sync_results_for_request(dao, results)
+  return make_sync_results_for_request(dao, results, stream)
 
 
-def make_sync_results_for_request(dao, results):
+def make_sync_results_for_request(dao, results, stream=False):
   bundle_dict = {'resourceType': 'Bundle', 'type': 'history'}
   if results.pagination_token:
     query_params = request.args.copy()
@@ -277,8 +298,38 @@ def make_sync_results_for_request(dao, results):
     link_type = 'next' if results.more_available else 'sync'
     next_url = url_for(request.url_rule.endpoint, _external=True, **query_params)
     bundle_dict['link'] = [{'relation': link_type, 'url': next_url}]
-  entries = []
-  for item in results.items:
-    entries.append({'resource': dao.to_client_json(item)})
-  bundle_dict['entry'] = entries
+  entry_chunks = ([{'resource': json} for json in
+                   dao.to_client_json_list(results.items[start:start + STREAM_CHUNK_SIZE])]
+                  for start in range(0, len(results.items), STREAM_CHUNK_SIZE))
+  if stream:
+    return make_streaming_bundle_response(bundle_dict, entry_chunks)
+  bundle_dict['entry'] = [entry for entries in entry_chunks for entry in entries]
   return jsonify(bundle_dict)
+
+
+def make_streaming_bundle_response(bundle_dict, entry_chunks):
+  """Returns a response that writes a FHIR Bundle while its entries are converted to JSON.
+
+  The resourceType and type of bundle_dict are written first, then the entries from each list in
+  entry_chunks, then the rest of bundle_dict (links and total). The first chunk is converted before
+  returning, so that most errors still produce an error response rather than a truncated body.
+  """
+  entry_chunks = iter(entry_chunks)
+  first_entries = next(entry_chunks, [])
+  encoder = RdrJsonEncoder()
+
+  def generate():
+    yield '{"resourceType": %s, "type": %s, "entry": [' % (
+        encoder.encode(bundle_dict['resourceType']), encoder.encode(bundle_dict['type']))
+    separator = ''
+    for entries in itertools.chain([first_entries], entry_chunks):
+      if entries:
+        yield separator + ', '.join(encoder.encode(entry) for entry in entries)
+        separator = ', '
+    yield ']'
+    for key, value in bundle_dict.iteritems():
+      if key not in ('resourceType', 'type', 'entry'):
+        yield ', %s: %s' % (encoder.encode(key), encoder.encode(value))
+    yield '}'
+
+  return Response(stream_with_context(generate()), mimetype='application/json')
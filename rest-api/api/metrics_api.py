@@ -3,13 +3,16 @@ import datetime
 import json
 
 from api_util import HEALTHPRO
-from dao.metrics_dao import MetricsBucketDao
+from dao.metrics_dao import MetricsBucketDao, MetricsBlockDao
 from flask import request
 from flask_restful import Resource
 from werkzeug.exceptions import BadRequest
 
 DATE_FORMAT = '%Y-%m-%d'
 DAYS_LIMIT = 7
+# Packed metrics versions are read a block of dates at a time, rather than a bucket per HPO and
+# date, so they can be served for much longer ranges.
+PACKED_DAYS_LIMIT = 366
 
 class MetricsApi(Resource):
 
@@ -32,6 +35,12 @@ class MetricsApi(Resource):
       except ValueError:
         raise BadRequest("Invalid end date: %s" % end_date_str)
       date_diff = abs((end_date - start_date).days)
+      if date_diff > PACKED_DAYS_LIMIT:
+        raise BadRequest("Difference between start date and end date "\
+          "should not be greater than %s days" % PACKED_DAYS_LIMIT)
+      results = MetricsBlockDao().get_active_client_json(start_date, end_date)
+      if results is not None:
+        return results
       if date_diff > DAYS_LIMIT:
         raise BadRequest("Difference between start date and end date "\
           "should not be greater than %s days" % DAYS_LIMIT)
@@ -1,14 +1,22 @@
+import json
+
+import sqlalchemy
+
 from api.base_api import BaseApi, make_sync_results_for_request
-from api_util import PTC_HEALTHPRO_AWARDEE, AWARDEE, DEV_MAIL
+from api_util import PTC_HEALTHPRO_AWARDEE, AWARDEE, DEV_MAIL, parse_date
 from app_util import auth_required, get_validated_user_info
+from dao.database_factory import get_server_cursor_database
 from dao.participant_summary_dao import ParticipantSummaryDao
-from flask import request
+from flask import request, Response, stream_with_context
 from model.participant_summary import ParticipantSummary
 from model.hpo import HPO
+from model.utils import to_client_participant_id
 from werkzeug.exceptions import Forbidden, InternalServerError, BadRequest
 
 
 class ParticipantSummaryApi(BaseApi):
+  stream_bundles = True
+
   def __init__(self):
     super(ParticipantSummaryApi, self).__init__(ParticipantSummaryDao())
 
@@ -45,9 +53,12 @@ class ParticipantSummaryApi(BaseApi):
     query.backfill_sync = self._get_request_arg_bool('_backfill', True)
     return query
 
+  def _make_responses(self, objs):
+    return self.dao.to_client_json_list(objs)
+
   def _make_bundle(self, results, id_field, participant_id):
     if self._get_request_arg_bool('_sync'):
-      return make_sync_results_for_request(self.dao, results)
+      return make_sync_results_for_request(self.dao, results, stream=self.stream_bundles)
     return super(ParticipantSummaryApi, self)._make_bundle(results, id_field, participant_id)
 
 
@@ -63,10 +74,16 @@ class ParticipantSummaryModifiedApi(BaseApi):
     """
     Return participant_id and last_modified for all records or a subset based
     on the awardee parameter.
+
+    lastModified=ge<timestamp> (or gt<timestamp>) limits the results to participants modified since
+    then. _format=ndjson returns one JSON object per line, and _format=csv returns CSV with a
+    header row, instead of a JSON array.
+
+    Results are read through a server-side cursor and written out as they are read.
     """
-    response = list()
     user_email, user_info = get_validated_user_info()
     request_awardee = None
+    hpo_id = None
 
     with self.dao.session() as session:
 
@@ -76,6 +93,7 @@ class ParticipantSummaryModifiedApi(BaseApi):
         hpo = session.query(HPO.hpoId).filter(HPO.name == request_awardee).first()
         if not hpo:
           raise BadRequest('invalid awardee')
+        hpo_id = hpo.hpoId
 
       # verify user has access to the requested awardee.
       if AWARDEE in user_info['roles'] and user_email != DEV_MAIL:
@@ -85,14 +103,82 @@ class ParticipantSummaryModifiedApi(BaseApi):
         except KeyError:
           raise InternalServerError("config error for awardee")
 
-      query = session.query(ParticipantSummary.participantId, ParticipantSummary.lastModified)
-      query = query.order_by(ParticipantSummary.participantId)
-      if request_awardee:
-        query = query.filter(ParticipantSummary.hpoId == hpo.hpoId)
-
-      items = query.all()
-      for item in items:
-        response.append({'participantId': 'P{0}'.format(item.participantId),
-                         'lastModified': item.lastModified.isoformat()})
-
-    return response
+    output_format = request.args.get('_format', 'json')
+    if output_format not in _MODIFIED_FORMATS:
+      raise BadRequest('invalid _format %s' % output_format)
+    query = (sqlalchemy.select([ParticipantSummary.participantId, ParticipantSummary.lastModified])
+             .order_by(ParticipantSummary.participantId))
+    if hpo_id is not None:
+      query = query.where(ParticipantSummary.hpoId == hpo_id)
+    last_modified_filter = _get_last_modified_filter(request.args.get('lastModified'))
+    if last_modified_filter is not None:
+      query = query.where(last_modified_filter)
+
+    formatter, mimetype = _MODIFIED_FORMATS[output_format]
+    return Response(stream_with_context(formatter(_read_modified(query))), mimetype=mimetype)
+
+
+# Number of rows fetched from the server-side cursor at a time by ParticipantSummaryModifiedApi.
+_MODIFIED_BATCH_SIZE = 10000
+
+
+def _get_last_modified_filter(value):
+  if not value:
+    return None
+  prefix, timestamp = value[:2], value[2:]
+  if prefix not in ('ge', 'gt'):
+    raise BadRequest('lastModified must start with ge or gt')
+  try:
+    last_modified = parse_date(timestamp)
+  except ValueError:
+    raise BadRequest('invalid lastModified timestamp %s' % timestamp)
+  if prefix == 'ge':
+    return ParticipantSummary.lastModified >= last_modified
+  return ParticipantSummary.lastModified > last_modified
+
+
+def _read_modified(query):
+  """Yields lists of (client participant ID, lastModified ISO string) for query's results."""
+  with get_server_cursor_database().session() as session:
+    cursor = session.execute(query)
+    try:
+      rows = cursor.fetchmany(_MODIFIED_BATCH_SIZE)
+      while rows:
+        yield [(to_client_participant_id(participant_id),
+                last_modified.isoformat() if last_modified else None)
+               for participant_id, last_modified in rows]
+        rows = cursor.fetchmany(_MODIFIED_BATCH_SIZE)
+    finally:
+      cursor.close()
+
+
+def _format_modified_json(batches):
+  yield '['
+  separator = ''
+  for batch in batches:
+    if batch:
+      yield separator + ', '.join(
+          json.dumps({'participantId': participant_id, 'lastModified': last_modified})
+          for participant_id, last_modified in batch)
+      separator = ', '
+  yield ']'
+
+
+def _format_modified_ndjson(batches):
+  for batch in batches:
+    yield ''.join(json.dumps({'participantId': participant_id, 'lastModified': last_modified}) +
+                  '\n' for participant_id, last_modified in batch)
+
+
+def _format_modified_csv(batches):
+  yield 'participantId,lastModified\r\n'
+  for batch in batches:
+    yield ''.join('%s,%s\r\n' % (participant_id, last_modified or '')
+                  for participant_id, last_modified in batch)
+
+
+_MODIFIED_FORMATS = {
+  'json': (_format_modified_json, 'application/json'),
+  'ndjson': (_format_modified_ndjson, 'application/x-ndjson'),
+  'csv': (_format_modified_csv, 'text/csv'),
+}
@@ -9,6 +9,8 @@ from query import Query, Operator, FieldFilter
 
 
 class PhysicalMeasurementsApi(BaseApi):
+  stream_bundles = True
+
   def __init__(self):
     super(PhysicalMeasurementsApi, self).__init__(PhysicalMeasurementsDao())
 
@@ -35,4 +37,4 @@ class PhysicalMeasurementsApi(BaseApi):
 @app_util.auth_required(PTC)
 def sync_physical_measurements():
   max_results = config.getSetting(config.MEASUREMENTS_ENTITIES_PER_SYNC, 100)
-  return get_sync_results_for_request(PhysicalMeasurementsDao(), max_results)
+  return get_sync_results_for_request(PhysicalMeasurementsDao(), max_results, stream=True)
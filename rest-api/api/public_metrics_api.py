@@ -1,7 +1,7 @@
 import datetime
 
 from flask_restful import Resource
-from flask import request
+from flask import make_response, request
 from werkzeug.exceptions import BadRequest
 from participant_enums import MetricsCacheType
 from api_util import STOREFRONT, convert_to_datetime, get_awardee_id_from_name
@@ -11,11 +11,16 @@ from dao.calendar_dao import INTERVAL_DAY
 from participant_enums import EnrollmentStatus, Stratifications
 from dao.metrics_cache_dao import MetricsEnrollmentStatusCacheDao, MetricsGenderCacheDao, \
   MetricsAgeCacheDao, MetricsRaceCacheDao, MetricsRegionCacheDao, MetricsLifecycleCacheDao, \
-  MetricsLanguageCacheDao
+  MetricsLanguageCacheDao, MetricsPublicPayloadCacheDao, decompress_payload
 from dao.metrics_ehr_service import MetricsEhrService
 
 DATE_FORMAT = '%Y-%m-%d'
 DAYS_LIMIT_FOR_HISTORY_DATA = 600
+# Stratifications for which only an end date is given (and used as the start date too).
+END_DATE_ONLY_STRATIFICATIONS = [Stratifications.FULL_STATE, Stratifications.FULL_CENSUS,
+                                 Stratifications.FULL_AWARDEE, Stratifications.GEO_STATE,
+                                 Stratifications.GEO_CENSUS, Stratifications.GEO_AWARDEE,
+                                 Stratifications.LIFECYCLE]
 
 
 class PublicMetricsApi(Resource):
@@ -33,10 +38,28 @@ class PublicMetricsApi(Resource):
     }
 
     filters = self.validate_params(params)
+    if not filters['awardee_ids'] and not filters['enrollment_statuses']:
+      payload = MetricsPublicPayloadCacheDao().get_payload(
+          filters['stratification'], filters['start_date'], filters['end_date'])
+      if payload is not None:
+        return self._make_payload_response(payload)
     results = self.get_filtered_results(**filters)
 
     return results
 
+  @staticmethod
+  def _make_payload_response(payload):
+    """Returns a response with a pre-rendered gzipped payload, decompressed if the client doesn't
+    accept gzip."""
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+      response = make_response(payload)
+      response.headers['Content-Encoding'] = 'gzip'
+    else:
+      response = make_response(decompress_payload(payload))
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
   def get_filtered_results(self, stratification, start_date, end_date, awardee_ids,
                            enrollment_statuses):
     """Queries DB, returns results in format consumed by front-end
@@ -105,10 +128,7 @@ class PublicMetricsApi(Resource):
     except TypeError:
       raise BadRequest('Invalid stratification: %s' % params['stratification'])
 
-    if filters['stratification'] in [Stratifications.FULL_STATE, Stratifications.FULL_CENSUS,
-                                     Stratifications.FULL_AWARDEE, Stratifications.GEO_STATE,
-                                     Stratifications.GEO_CENSUS, Stratifications.GEO_AWARDEE,
-                                     Stratifications.LIFECYCLE]:
+    if filters['stratification'] in END_DATE_ONLY_STRATIFICATIONS:
       # Validate dates
       if not params['end_date']:
         raise BadRequest('end date should not be empty')
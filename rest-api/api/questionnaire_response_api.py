@@ -1,4 +1,7 @@
 import app_util
+import collections
+import logging
+import re
 
 from api.base_api import BaseApi
 from api_util import PTC, PTC_AND_HEALTHPRO
@@ -9,7 +12,15 @@ from model.code import Code, CodeType
 from model.participant import Participant
 from model.questionnaire import QuestionnaireConcept
 from model.questionnaire_response import QuestionnaireResponse
-from werkzeug.exceptions import BadRequest, NotFound
+from model.utils import from_client_participant_id, to_client_participant_id
+from werkzeug.exceptions import BadRequest, NotFound, HTTPException, InternalServerError
+
+# Most entries accepted in one QuestionnaireResponse batch Bundle.
+MAX_BATCH_ENTRIES = 100
+
+# The URL of a batch entry's request: Participant/:participant_id/QuestionnaireResponse, relative to
+# the API or absolute.
+_BATCH_ENTRY_URL_RE = re.compile(r'^(?:.*/)?Participant/([^/]+)/QuestionnaireResponse/?$')
 
 
 class QuestionnaireResponseApi(BaseApi):
@@ -26,6 +37,88 @@ class QuestionnaireResponseApi(BaseApi):
     return super(QuestionnaireResponseApi, self).post(participant_id=p_id)
 
 
+class QuestionnaireResponseBatchApi(Resource):
+  """Inserts the QuestionnaireResponses in a FHIR batch Bundle, for any number of participants.
+
+  Each entry POSTs a response to Participant/:participant_id/QuestionnaireResponse. The responses
+  for each participant are inserted in one transaction (see
+  QuestionnaireResponseDao.insert_for_participant); an entry that fails doesn't keep the others
+  out. Returns a batch-response Bundle with an entry (giving the status and the location of the
+  response, or an OperationOutcome) for each entry, in the same order.
+  """
+
+  @app_util.auth_required(PTC)
+  def post(self):
+    bundle = request.get_json(force=True)
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+      raise BadRequest('Expected a Bundle resource.')
+    if bundle.get('type') != 'batch':
+      raise BadRequest('Bundle type must be batch, not %s.' % bundle.get('type'))
+    entries = bundle.get('entry') or []
+    if len(entries) > MAX_BATCH_ENTRIES:
+      raise BadRequest('Bundle has %d entries; at most %d are allowed.' %
+                       (len(entries), MAX_BATCH_ENTRIES))
+
+    dao = QuestionnaireResponseDao()
+    client_id = app_util.get_oauth_id()
+    results = [None] * len(entries)
+    # participant ID -> [(entry index, resource JSON)], in the order participants first appear
+    participant_entries = collections.OrderedDict()
+    for index, entry in enumerate(entries):
+      try:
+        participant_id, resource = _parse_batch_entry(entry)
+      except BadRequest as e:
+        results[index] = e
+        continue
+      participant_entries.setdefault(participant_id, []).append((index, resource))
+
+    for participant_id, indexed_resources in participant_entries.iteritems():
+      factories = [_make_response_factory(dao, resource, participant_id, client_id)
+                   for _, resource in indexed_resources]
+      try:
+        participant_results = dao.insert_for_participant(participant_id, factories)
+      except Exception:  # pylint: disable=broad-except
+        # Report the failure on these entries rather than failing those already committed.
+        logging.exception('Failed to insert responses for participant %d.', participant_id)
+        participant_results = [InternalServerError()] * len(indexed_resources)
+      for (index, _), result in zip(indexed_resources, participant_results):
+        results[index] = result
+
+    return {'resourceType': 'Bundle', 'type': 'batch-response',
+            'entry': [_make_batch_response_entry(result) for result in results]}
+
+
+def _parse_batch_entry(entry):
+  """Returns the participant ID and QuestionnaireResponse JSON of a batch Bundle entry."""
+  if not isinstance(entry, dict) or not isinstance(entry.get('resource'), dict):
+    raise BadRequest('Bundle entry has no resource.')
+  entry_request = entry.get('request') or {}
+  if entry_request.get('method') != 'POST':
+    raise BadRequest('Bundle entry request method must be POST.')
+  match = _BATCH_ENTRY_URL_RE.match(entry_request.get('url') or '')
+  if not match:
+    raise BadRequest('Bundle entry request URL must be Participant/:participant_id/'
+                     'QuestionnaireResponse, not %s.' % entry_request.get('url'))
+  return from_client_participant_id(match.group(1)), entry['resource']
+
+
+def _make_response_factory(dao, resource, participant_id, client_id):
+  return lambda: dao.from_client_json(resource, participant_id=participant_id, client_id=client_id)
+
+
+def _make_batch_response_entry(result):
+  if isinstance(result, HTTPException):
+    return {'response': {
+      'status': '%d %s' % (result.code, result.name),
+      'outcome': {'resourceType': 'OperationOutcome',
+                  'issue': [{'severity': 'error', 'code': 'processing',
+                             'diagnostics': result.description}]}}}
+  return {'response': {
+    'status': '200 OK',
+    'location': 'Participant/%s/QuestionnaireResponse/%d' % (
+        to_client_participant_id(result.participantId), result.questionnaireResponseId)}}
+
+
 class ParticipantQuestionnaireAnswers(Resource):
 
   @app_util.auth_required(PTC_AND_HEALTHPRO)
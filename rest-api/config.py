@@ -56,6 +56,37 @@ BIOBANK_STATUS_MAIL_RECIPIENTS = 'biobank_status_mail_recipients'
 # aren't in the code book; false if we should reject the questionnaires.
 ADD_QUESTIONNAIRE_CODES_IF_MISSING = 'add_questionnaire_codes_if_missing'
 
+# True if the Biobank samples import should update sample data in all participant summaries (for
+# backfills); false (the default) to only update participants whose samples changed.
+BIOBANK_SAMPLES_FULL_SUMMARY_REFRESH = 'biobank_samples_full_summary_refresh'
+
+# True if the metrics cache refresh should run each cache's SQL once per HPO; false (the default) to
+# compute all caches from one scan of the participant data with MetricsCacheBuilder.
+METRICS_CACHE_SQL_REFRESH = 'metrics_cache_sql_refresh'
+
+# True if the metrics cache refresh should copy the rows of each cache's serving version that
+# participant changes since can't have affected, and only recompute the rest; false (the default)
+# to recompute every row. Ignored if METRICS_CACHE_SQL_REFRESH is set.
+METRICS_CACHE_INCREMENTAL_REFRESH = 'metrics_cache_incremental_refresh'
+
+# Number of threads refreshing metrics caches at once (default 1), and the most database
+# connections a refresh may use for them (default unlimited, i.e. one per thread).
+METRICS_CACHE_REFRESH_WORKERS = 'metrics_cache_refresh_workers'
+METRICS_CACHE_REFRESH_CONNECTIONS = 'metrics_cache_refresh_connections'
+
+# Lengths in days of the date windows (ending on the day of a metrics cache refresh and the next)
+# that PublicMetrics API responses are pre-rendered for.
+PUBLIC_METRICS_PRERENDERED_DAYS = 'public_metrics_prerendered_days'
+
+# True if the metrics pipeline should compute participant deltas with
+# reduce_participant_data_to_hpo_metric_date_deltas_batched; false (the default) to use
+# reduce_participant_data_to_hpo_metric_date_deltas. Both emit the same output.
+METRICS_PIPELINE_BATCHED_REDUCER = 'metrics_pipeline_batched_reducer'
+
+# True if the metrics pipeline should pack each new metrics version's buckets into blocks
+# (see MetricsBlockDao), which are smaller and can be served for longer date ranges.
+METRICS_PIPELINE_PACK_BUCKETS = 'metrics_pipeline_pack_buckets'
+
 REQUIRED_CONFIG_KEYS = [BIOBANK_SAMPLES_BUCKET_NAME]
 
 DAYS_TO_DELETE_KEYS = "days_to_delete_keys"
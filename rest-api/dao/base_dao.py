@@ -3,31 +3,38 @@ import collections
 import json
 import logging
 import datetime
-import random
+import threading
 from contextlib import closing
 
 from fhirclient.models.domainresource import DomainResource
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 from protorpc import messages
 from query import Operator, PropertyType, FieldFilter, Results
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, tuple_
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, NotFound, PreconditionFailed, ServiceUnavailable
 
 import api_util
+import clock
 import dao.database_factory
+from dao.database_utils import estimate_row_count
+from dao.id_reservation import reserve_id, record_collisions
 from model.utils import get_property_type
 
 # Maximum number of times we will attempt to insert an entity with a random ID before
 # giving up.
 MAX_INSERT_ATTEMPTS = 20
 
-# Range of possible values for random IDs.
-_MIN_ID = 100000000
-_MAX_ID = 999999999
-
 _COMPARABLE_PROPERTY_TYPES = [PropertyType.DATE, PropertyType.DATETIME, PropertyType.INTEGER]
 
+# How long exact totals for include_total queries are reused by later pages of the same query.
+_TOTAL_CACHE_TTL = datetime.timedelta(minutes=2)
+# Expired totals are pruned when the cache grows past this many entries.
+_TOTAL_CACHE_MAX_SIZE = 1000
+# (model type name, filter key) -> (total, expiration time)
+_total_cache = {}
+_total_cache_lock = threading.Lock()
+
 _OPERATOR_PREFIX_MAP = {
   "lt": Operator.LESS_THAN,
   "le": Operator.LESS_THAN_OR_EQUALS,
@@ -36,6 +43,21 @@ _OPERATOR_PREFIX_MAP = {
   "ne": Operator.NOT_EQUALS
 }
 
+def _get_total_cache_key(query_def):
+  """Returns a key for the rows matched by query_def, independent of the order of its filters and of
+  its page. (The order by field is included, as DAOs may filter on it in _initialize_query.)"""
+  filters = tuple(sorted((field_filter.field_name, str(field_filter.operator),
+                          repr(field_filter.value))
+                         for field_filter in query_def.field_filters))
+  order_by_field = query_def.order_by.field_name if query_def.order_by else None
+  return filters, order_by_field
+
+
+def reset_total_cache_for_tests():
+  with _total_cache_lock:
+    _total_cache.clear()
+
+
 class BaseDao(object):
   """A data access object base class; defines common methods for inserting and retrieving
   objects using SQLAlchemy.
@@ -46,7 +68,15 @@ class BaseDao(object):
   order_by_ending is a list of field names to always order by (in ascending order, possibly after
   another sort field) when query() is invoked. It should always end in the primary key.
   If not specified, query() is not supported.
+
+  use_row_value_pagination controls how pagination tokens are turned into query filters. When set
+  (the default) and the database supports row value comparisons (MySQL), the token becomes a single
+  (a, b, c) > (:a, :b, :c) keyset condition that can be served by one index range scan; otherwise
+  an equivalent or-of-ands filter is used.
   """
+
+  use_row_value_pagination = True
+
   def __init__(self, model_type, backup=False, order_by_ending=None, db=None):
     self.model_type = model_type
     if not db:
@@ -247,22 +277,51 @@ class BaseDao(object):
       items = query.all()
 
       total = None
+      total_estimated = False
       if query_def.include_total:
-        total = self._count_query(session, query_def)
+        total, total_estimated = self._get_total(session, query_def)
 
       if not items:
-        return Results([], total=total)
+        return Results([], total=total, total_estimated=total_estimated)
 
     if len(items) > query_def.max_results:
       # Items, pagination token, and more are available
       page = items[0:query_def.max_results]
       token = self._make_pagination_token(items[query_def.max_results - 1].asdict(), field_names)
-      return Results(page, token, more_available=True, total=total)
+      return Results(page, token, more_available=True, total=total,
+                     total_estimated=total_estimated)
     else:
       token = (self._make_pagination_token(items[-1].asdict(), field_names)
                if query_def.always_return_token
                else None)
-      return Results(items, token, more_available=False, total=total)
+      return Results(items, token, more_available=False, total=total,
+                     total_estimated=total_estimated)
+
+  def _get_total(self, session, query_def):
+    """Returns (total, whether it is estimated) for an include_total query.
+
+    If query_def.estimate_total is set and the database is MySQL, the total is the optimizer's
+    estimate for the query. Otherwise it is an exact count, which is cached for a short time by the
+    query's filters, so that fetching later pages (with a pagination token) doesn't count again.
+    """
+    if query_def.estimate_total and self._database.db_type.startswith('mysql'):
+      query = self._initialize_query(session, query_def)
+      query = self._set_filters(query, query_def.field_filters)
+      return estimate_row_count(session, query), True
+    cache_key = (self.model_type.__name__, _get_total_cache_key(query_def))
+    now = clock.CLOCK.now()
+    if query_def.pagination_token:
+      cached = _total_cache.get(cache_key)
+      if cached and cached[1] > now:
+        return cached[0], False
+    total = self._count_query(session, query_def)
+    with _total_cache_lock:
+      if len(_total_cache) >= _TOTAL_CACHE_MAX_SIZE:
+        for key in [key for key, (_, expiration) in _total_cache.iteritems() if expiration <= now]:
+          del _total_cache[key]
+      if len(_total_cache) < _TOTAL_CACHE_MAX_SIZE:
+        _total_cache[cache_key] = (total, now + _TOTAL_CACHE_TTL)
+    return total, False
 
   def _make_pagination_token(self, item_dict, field_names):
     vals = [item_dict.get(field_name) for field_name in field_names]
@@ -324,10 +383,34 @@ class BaseDao(object):
       raise BadRequest('Invalid operator: %r.' % field_filter.operator)
     return query
 
+  def _supports_row_value_comparisons(self):
+    """Returns True if the database can compare row values, e.g. (a, b) > (1, 2)."""
+    return self._database.db_type.startswith('mysql')
+
   def _add_pagination_filter(self, query, query_def, fields, first_descending):
     """Adds a pagination filter for the decoded values in the pagination token based on
     the sort order."""
     decoded_vals = self._decode_token(query_def, fields)
+    # Row value comparisons evaluate to NULL when any value is NULL, and can't express a descending
+    # first sort field, so only use them when neither applies.
+    if (self.use_row_value_pagination and not first_descending and
+        all(val is not None for val in decoded_vals) and self._supports_row_value_comparisons()):
+      return self._add_row_value_pagination_filter(query, fields, decoded_vals)
+    return self._add_or_of_ands_pagination_filter(query, fields, decoded_vals, first_descending)
+
+  @staticmethod
+  def _add_row_value_pagination_filter(query, fields, decoded_vals):
+    """Adds a keyset filter of the form (a, b, c) > (:a, :b, :c) for ascending sort fields.
+
+    The redundant bound on the first field lets the optimizer pick a range scan on an index
+    starting with that field even when it can't use the row value comparison itself.
+    """
+    return query.filter(and_(fields[0] >= decoded_vals[0],
+                             tuple_(*fields) > tuple(decoded_vals)))
+
+  @staticmethod
+  def _add_or_of_ands_pagination_filter(query, fields, decoded_vals, first_descending):
+    """Adds a pagination filter built from comparisons of individual fields."""
     # SQLite does not support tuple comparisons, so make an or-of-ands statements that is
     # equivalent.
     or_clauses = []
@@ -394,17 +477,14 @@ class BaseDao(object):
       query = query.order_by(f)
     return query
 
-  def _get_random_id(self):
-    return random.randint(_MIN_ID, _MAX_ID)
-
   def _insert_with_random_id(self, obj, fields):
-    """Attempts to insert an entity with randomly assigned ID(s) repeatedly until success
-    or a maximum number of attempts are performed."""
+    """Inserts an entity with random ID(s) reserved for fields (see dao/id_reservation.py),
+    retrying with new IDs until success or a maximum number of attempts are performed."""
     all_tried_ids = []
     for _ in range(0, MAX_INSERT_ATTEMPTS):
       tried_ids = {}
       for field in fields:
-        rand_id = self._get_random_id()
+        rand_id = reserve_id(self, field)
         tried_ids[field] = rand_id
         setattr(obj, field, rand_id)
       all_tried_ids.append(tried_ids)
@@ -415,6 +495,8 @@ class BaseDao(object):
         result = self.handle_integrity_error(tried_ids, e, obj)
         if result:
           return result
+        # Most likely another server inserted one of the reserved IDs since it was checked.
+        record_collisions(self, tried_ids.items(), e)
     # We were unable to insert a participant (unlucky). Throw an error.
     logging.warning(
         'Giving up after %d insert attempts, tried %s.' % (MAX_INSERT_ATTEMPTS, all_tried_ids))
@@ -442,6 +524,13 @@ class BaseDao(object):
     except AttributeError:
       raise NotImplementedError()
 
+  def to_client_json_list(self, models):
+    """Converts a page of models to JSON objects to be returned to API clients.
+
+    Subclasses can override this to convert the whole page in one pass.
+    """
+    return [self.to_client_json(model) for model in models]
+
   def from_client_json(self):
     """Subclasses must implement this to parse API request bodies into model objects.
 
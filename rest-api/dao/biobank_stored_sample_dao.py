@@ -1,33 +1,144 @@
+import collections
 import logging
 
 from code_constants import BIOBANK_TESTS_SET
 from dao.base_dao import BaseDao
 from model.biobank_stored_sample import BiobankStoredSample
+from sqlalchemy import inspect
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+# Default number of samples written per INSERT statement by upsert_all.
+UPSERT_BATCH_SIZE = 1000
+
+
+class UpsertCounts(collections.namedtuple('UpsertCounts', ('inserted', 'updated', 'unchanged'))):
+  """Numbers of samples passed to upsert_all that were new, that changed existing samples, and
+  that matched existing samples exactly (and so weren't written)."""
+
+  @property
+  def written(self):
+    return self.inserted + self.updated + self.unchanged
+
+  def __add__(self, other):
+    return UpsertCounts(*[mine + theirs for mine, theirs in zip(self, other)])
 
 
 class BiobankStoredSampleDao(BaseDao):
   """Batch operations for updating samples. Individual insert/get operations are testing only."""
   def __init__(self):
     super(BiobankStoredSampleDao, self).__init__(BiobankStoredSample)
+    # (attribute name, column) for each column, in the same order.
+    self._column_attrs = [(attr.key, attr.columns[0])
+                          for attr in inspect(BiobankStoredSample).column_attrs]
 
   def get_id(self, obj):
     return obj.biobankStoredSampleId
 
-  def upsert_all(self, samples):
-    """Inserts/updates samples. """
+  def upsert_all(self, samples, changed_biobank_ids=None, batch_size=UPSERT_BATCH_SIZE):
+    """Inserts/updates samples, returning UpsertCounts.
+
+    Samples are handled batch_size at a time: the existing rows for a batch are read with one
+    query, and the new or changed samples are written with one multi-row INSERT ... ON DUPLICATE
+    KEY UPDATE on MySQL, or INSERT OR REPLACE on SQLite. (Other databases use session.merge().)
+
+    If changed_biobank_ids is provided, the biobank IDs of samples that were inserted or had any
+    field changed are added to it.
+    """
+    samples = [sample for sample in samples if self._is_recognized(sample)]
+    db_type = self._database.db_type
+    if not (db_type.startswith('mysql') or db_type == 'sqlite'):
+      return self._upsert_all_by_merge(samples, changed_biobank_ids)
+
+    def upsert(session):
+      counts = UpsertCounts(0, 0, 0)
+      for start in range(0, len(samples), batch_size):
+        counts += self._upsert_batch(session, samples[start:start + batch_size],
+                                     changed_biobank_ids)
+      return counts
+    return self._database.autoretry(upsert)
+
+  def _upsert_batch(self, session, samples, changed_biobank_ids):
+    # If a sample ID appears more than once, the last one wins (as with merge()).
+    samples_by_id = collections.OrderedDict((sample.biobankStoredSampleId, sample)
+                                            for sample in samples)
+    existing_values = {
+        values.biobankStoredSampleId: values for values in
+        session.query(*[getattr(BiobankStoredSample, key) for key, _ in self._column_attrs])
+        .filter(BiobankStoredSample.biobankStoredSampleId.in_(samples_by_id.keys()))
+    }
+    rows = []
+    inserted = updated = unchanged = 0
+    for sample_id, sample in samples_by_id.iteritems():
+      old_values = existing_values.get(sample_id)
+      values = self._get_values(sample, old_values)
+      if old_values is None:
+        inserted += 1
+      elif tuple(old_values) == values:
+        unchanged += 1
+        continue
+      else:
+        updated += 1
+      rows.append({column.name: value for (_, column), value in zip(self._column_attrs, values)})
+      if changed_biobank_ids is not None:
+        changed_biobank_ids.add(sample.biobankId)
+    # Duplicates in the input are counted once.
+    unchanged += len(samples) - len(samples_by_id)
+    if rows:
+      table = BiobankStoredSample.__table__
+      if self._database.db_type == 'sqlite':
+        session.execute(table.insert().prefix_with('OR REPLACE'), rows)
+      else:
+        statement = mysql_insert(table).values(rows)
+        statement = statement.on_duplicate_key_update(
+            [(column.name, statement.inserted[column.name])
+             for _, column in self._column_attrs if not column.primary_key])
+        session.execute(statement)
+    return UpsertCounts(inserted, updated, unchanged)
+
+  def _get_values(self, sample, old_values):
+    """Returns the column values to write for sample, given the existing row's values (or None).
+
+    As with merge(), fields that were never set on sample keep their existing values; and for new
+    rows, columns with defaults get them in place of None (as an ORM insert would).
+    """
+    values = []
+    for i, (key, column) in enumerate(self._column_attrs):
+      if key in sample.__dict__:
+        value = sample.__dict__[key]
+      elif old_values is not None:
+        value = old_values[i]
+      else:
+        value = None
+      if value is None and old_values is None and column.default is not None and \
+          column.default.is_scalar:
+        value = column.default.arg
+      values.append(value)
+    return tuple(values)
+
+  def _upsert_all_by_merge(self, samples, changed_biobank_ids=None):
+    """Upserts samples one at a time with session.merge(), which is a SELECT plus an INSERT or
+    UPDATE per sample. Used for databases without a bulk upsert statement, and for comparison."""
     # Ensure that the sample set can be re-iterated if the operation needs to be retried
     samples = list(samples)
     def upsert(session):
-      # TODO(DA-230) Scale this to handle full study data.  SQLAlchemy does not provide batch
-      # upserting; individual session.merge() calls as below may be expensive but cannot be
-      # effectively batched, see stackoverflow.com/questions/25955200. If this proves to be a
-      # bottleneck, we can switch to generating "INSERT .. ON DUPLICATE KEY UPDATE".
-      written = 0
+      inserted = updated = unchanged = 0
       for sample in samples:
-        if sample.test not in BIOBANK_TESTS_SET:
-          logging.warn('test sample %s not recognized.' % sample.test)
+        merged_sample = session.merge(sample)
+        if merged_sample in session.new:
+          inserted += 1
+        elif session.is_modified(merged_sample):
+          updated += 1
         else:
-          session.merge(sample)
-          written += 1
-      return written
+          unchanged += 1
+          continue
+        if changed_biobank_ids is not None:
+          changed_biobank_ids.add(sample.biobankId)
+      return UpsertCounts(inserted, updated, unchanged)
     return self._database.autoretry(upsert)
+
+  @staticmethod
+  def _is_recognized(sample):
+    if sample.test not in BIOBANK_TESTS_SET:
+      logging.warn('test sample %s not recognized.' % sample.test)
+      return False
+    return True
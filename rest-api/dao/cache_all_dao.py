@@ -1,28 +1,75 @@
+import copy
+import logging
+from datetime import timedelta
+
+import clock
 from base_dao import UpdatableDao
+from sqlalchemy import func
 from sqlalchemy.orm.session import make_transient
 
 import singletons
 
+# On each incremental refresh, rows modified up to this long before the newest modification seen by
+# the previous load are read again, to pick up transactions that committed after later ones.
+_INCREMENTAL_REFRESH_OVERLAP = timedelta(minutes=10)
+# Incrementally refreshed caches are still fully reloaded this often. This bounds how long a change
+# that the incremental queries missed (e.g. from a very long transaction) can go unnoticed.
+_FULL_RELOAD_INTERVAL = timedelta(hours=1)
+
+
 class EntityCache(object):
   """A cache of entities of a particular type, indexed by ID (in id_to_entity) and optionally other
    fields (in index_maps).
+
+   version is the newest modified time among the entities, for DAOs that refresh incrementally.
+   loaded_time is when the entities were last fully loaded, and checked_time is when the cache was
+   last brought up to date with the database.
    """
-  def __init__(self, dao, entities, index_field_keys):
+  def __init__(self, dao, entities, index_field_keys, version=None):
     """Constructor taking the DAO, all the entities in the database for this type, and a list of
     field names or tuples of field names to index the entities by."""
     self.id_to_entity = {}
-    if index_field_keys:
-      self.index_maps = {index_field_key: {} for index_field_key in index_field_keys}
+    self.index_field_keys = index_field_keys or []
+    self.index_maps = {index_field_key: {} for index_field_key in self.index_field_keys}
+    self.version = version
+    self.loaded_time = clock.CLOCK.now()
+    self.checked_time = self.loaded_time
+    self._add_entities(dao, entities)
+
+  def _add_entities(self, dao, entities):
     for entity in entities:
       make_transient(entity)
-      self.id_to_entity[dao.get_id(entity)] = entity
-      if index_field_keys:
-        for index_field_key in index_field_keys:
-          if type(index_field_key) is tuple:
-            key = tuple(getattr(entity, index_field) for index_field in index_field_key)
-          else:
-            key = getattr(entity, index_field_key)
-          self.index_maps[index_field_key][key] = entity
+      entity_id = dao.get_id(entity)
+      old_entity = self.id_to_entity.get(entity_id)
+      self.id_to_entity[entity_id] = entity
+      for index_field_key in self.index_field_keys:
+        index_map = self.index_maps[index_field_key]
+        if old_entity is not None:
+          old_key = _get_index_key(old_entity, index_field_key)
+          if index_map.get(old_key) is old_entity:
+            del index_map[old_key]
+        index_map[_get_index_key(entity, index_field_key)] = entity
+
+  def merge(self, dao, entities, version):
+    """Returns a new EntityCache with the given new or changed entities added to those in this one.
+
+    This cache is left unchanged, so that it can keep being read while the merge happens.
+    """
+    merged = copy.copy(self)
+    merged.id_to_entity = dict(self.id_to_entity)
+    merged.index_maps = {index_field_key: dict(index_map)
+                         for index_field_key, index_map in self.index_maps.iteritems()}
+    merged.version = version
+    merged.checked_time = clock.CLOCK.now()
+    merged._add_entities(dao, entities)
+    return merged
+
+
+def _get_index_key(entity, index_field_key):
+  if type(index_field_key) is tuple:
+    return tuple(getattr(entity, index_field) for index_field in index_field_key)
+  return getattr(entity, index_field_key)
+
 
 class CacheAllDao(UpdatableDao):
   """A DAO that loads all values from the database and caches them in memory for some period of time
@@ -35,28 +82,83 @@ class CacheAllDao(UpdatableDao):
   cache_index is an index from singletons (e.g. CODE_CACHE_INDEX) provided by subclasses
   to specify a key for the cache. (This is faster than hashing the type name.)
 
-  cache_ttl_seconds is the TTL for entries in the cache in seconds.
+  cache_ttl_seconds is the TTL for entries in the cache in seconds. Once it expires, the old cache
+  keeps being served while a background thread reloads it.
 
   index_field_keys is an optional list for secondary indexes; elements in it can either by
   individual field names or tuples of field names. Cached objects will be keyed by those fields.
 
+  If incremental_refresh is set, the model must have a "modified" field set on every insert and
+  update. Reloads after the TTL expires or an invalidation then first check the table's newest
+  modified time and row count, and only read rows modified since the previous load, merging them
+  into the existing cache. This makes frequent reloads cheap, so a short TTL can be used to bound
+  how stale other servers' caches get. Deleted rows trigger a full reload.
+
   See BaseDao for documentation on order_by_ending.
   """
 
   def __init__(self, model_type, cache_index, cache_ttl_seconds, index_field_keys=None,
-               order_by_ending=None):
+               order_by_ending=None, incremental_refresh=False):
     super(CacheAllDao, self).__init__(model_type, order_by_ending=order_by_ending)
     self.index_field_keys = index_field_keys
     self.cache_index = cache_index
     self.cache_ttl_seconds = cache_ttl_seconds
+    self.incremental_refresh = incremental_refresh
 
   def _load_cache(self):
     with self.session() as session:
+      # Read the version first, so that rows changed while loading are read again next time.
+      version = self._get_cache_version(session)[0] if self.incremental_refresh else None
       all_entities = session.query(self.model_type).all()
-    return EntityCache(self, all_entities, self.index_field_keys)
+    cache = EntityCache(self, all_entities, self.index_field_keys, version)
+    self._link_cache_entities(cache, all_entities)
+    return cache
+
+  def _get_cache_version(self, session):
+    """Returns the newest modified time and the row count for the table."""
+    return (session.query(func.max(self.model_type.modified), func.count())
+            .select_from(self.model_type)
+            .one())
+
+  def _refresh_cache(self):
+    """Brings the last loaded cache up to date, reading only the rows that changed since."""
+    cache = singletons.get_last(self.cache_index)
+    if (cache is None or cache.version is None or
+        clock.CLOCK.now() - cache.loaded_time >= _FULL_RELOAD_INTERVAL):
+      return self._load_cache()
+    with self.session() as session:
+      version, count = self._get_cache_version(session)
+      if version == cache.version and count == len(cache.id_to_entity):
+        cache.checked_time = clock.CLOCK.now()
+        return cache
+      changed_entities = (session.query(self.model_type)
+                          .filter(self.model_type.modified >=
+                                  cache.version - _INCREMENTAL_REFRESH_OVERLAP)
+                          .all())
+    merged_cache = cache.merge(self, changed_entities, version)
+    if len(merged_cache.id_to_entity) != count:
+      logging.info('%s cache has %d rows but the table has %d; reloading all.',
+                   self.model_type.__name__, len(merged_cache.id_to_entity), count)
+      return self._load_cache()
+    self._link_cache_entities(merged_cache, changed_entities)
+    logging.info('Merged %d changed rows into %s cache.', len(changed_entities),
+                 self.model_type.__name__)
+    return merged_cache
+
+  def _link_cache_entities(self, cache, entities):
+    """Override to set up relationships between cached entities after entities (all of them, or
+    just those changed by an incremental refresh) are added to the cache."""
+    pass
 
   def _get_cache(self):
-    return singletons.get(self.cache_index, (lambda: self._load_cache()), self.cache_ttl_seconds)
+    constructor = self._refresh_cache if self.incremental_refresh else self._load_cache
+    return singletons.get(self.cache_index, constructor, self.cache_ttl_seconds,
+                          refresh_in_background=True)
+
+  def get_cache_age(self):
+    """Returns how long ago the cache was last brought up to date with the database; changes made
+    on other servers since then aren't visible yet."""
+    return clock.CLOCK.now() - self._get_cache().checked_time
 
   def get_with_session(self, session, obj_id, **kwargs):
     #pylint: disable=unused-argument
@@ -82,7 +184,8 @@ class CacheAllDao(UpdatableDao):
   def get_with_ids(self, ids):
     if ids is None:
       return []
-    return [self.get(id_) for id_ in ids]
+    id_to_entity = self._get_cache().id_to_entity
+    return [id_to_entity.get(id_) for id_ in ids]
 
   def get_all(self):
     return self._get_cache().id_to_entity.values()
@@ -1,10 +1,12 @@
 import clock
+import collections
 import logging
 import traceback
 
 from dao.base_dao import BaseDao
 from dao.cache_all_dao import CacheAllDao
 from model.code import CodeBook, Code, CodeHistory, CodeType
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.exceptions import BadRequest
 from singletons import CODE_CACHE_INDEX
 
@@ -105,20 +107,46 @@ class CodeBookDao(BaseDao):
 SYSTEM_AND_VALUE = ('system', 'value')
 
 
+def _copy_code(code):
+  """Returns a new Code with the same fields as code, but no relationships."""
+  copied = Code()
+  copied.fromdict(code.asdict(), allow_pk=True)
+  copied.modified = code.modified
+  return copied
+
+
 class CodeDao(CacheAllDao):
   def __init__(self):
-    super(CodeDao, self).__init__(Code, cache_index=CODE_CACHE_INDEX, cache_ttl_seconds=600,
-                                  index_field_keys=[SYSTEM_AND_VALUE])
-
-  def _load_cache(self):
-    result = super(CodeDao, self)._load_cache()
-    for code in result.id_to_entity.values():
+    super(CodeDao, self).__init__(Code, cache_index=CODE_CACHE_INDEX, cache_ttl_seconds=60,
+                                  index_field_keys=[SYSTEM_AND_VALUE], incremental_refresh=True)
+
+  def _link_cache_entities(self, cache, entities):
+    # Codes that were re-read are new objects, so their parents and children must point at them.
+    # Cached codes may still be shared with the previous cache (which can be being read), so rather
+    # than changing those, they are replaced with copies, and every relinked code gets a rebuilt
+    # children list (with one entry per child code).
+    changed_ids = set(code.codeId for code in entities)
+    child_ids_by_parent = collections.defaultdict(list)
+    for code in cache.id_to_entity.itervalues():
       if code.parentId is not None:
-        parent = result.id_to_entity.get(code.parentId)
-        if parent:
-          parent.children.append(code)
-          code.parent = parent
-    return result
+        child_ids_by_parent[code.parentId].append(code.codeId)
+    relinked_ids = set(changed_ids)
+    for code_id in changed_ids:
+      relinked_ids.update(child_ids_by_parent[code_id])
+      # Ancestors too, so that walking down from any of them reaches the new objects.
+      parent_id = cache.id_to_entity[code_id].parentId
+      while parent_id is not None and parent_id not in relinked_ids:
+        relinked_ids.add(parent_id)
+        parent = cache.id_to_entity.get(parent_id)
+        parent_id = parent.parentId if parent else None
+    relinked_ids.intersection_update(cache.id_to_entity)
+    cache._add_entities(self, [_copy_code(cache.id_to_entity[code_id])
+                               for code_id in relinked_ids - changed_ids])
+    for code_id in relinked_ids:
+      code = cache.id_to_entity[code_id]
+      set_committed_value(code, 'children', [cache.id_to_entity[child_id] for child_id
+                                             in sorted(child_ids_by_parent[code_id])])
+      set_committed_value(code, 'parent', cache.id_to_entity.get(code.parentId))
 
   def _add_history(self, session, obj):
     history = CodeHistory()
@@ -68,6 +68,13 @@ def get_db_connection_string(backup=False, instance_name=None):
   return result
 
 
+def get_server_cursor_database():
+  """Returns a singleton database like make_server_cursor_database()'s, for reads of large results
+  while serving requests (which would otherwise each create, and leave open, their own connection
+  pool)."""
+  return singletons.get(singletons.SERVER_CURSOR_SQL_DATABASE_INDEX, make_server_cursor_database)
+
+
 def make_server_cursor_database(backup=False, instance_name=None):
   """
   Returns a database object that uses a server-side cursor when talking to the database.
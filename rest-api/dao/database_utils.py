@@ -4,6 +4,8 @@ import re
 
 from dao.database_factory import get_database
 from datetime import datetime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 _DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 # MySQL uses %i for minutes
@@ -57,3 +59,23 @@ def replace_null_safe_equals(sql):
   if _is_sqlite():
     return re.sub(_NULL_SAFE_PATTERN, r"is", sql)
   return sql
+
+
+class Explain(Executable, ClauseElement):
+  """An EXPLAIN of a SELECT statement (MySQL), executable like any other statement."""
+  def __init__(self, statement):
+    self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+  return 'EXPLAIN ' + compiler.process(element.statement, **kw)
+
+
+def estimate_row_count(session, query):
+  """Returns the optimizer's estimate of the number of rows an ORM query returns, from the rows and
+  filtered columns of its MySQL query plan, without running the query."""
+  estimate = 1.0
+  for row in session.execute(Explain(query.statement)):
+    estimate *= (row['rows'] or 0) * (row['filtered'] if row['filtered'] is not None else 100) / 100
+  return int(round(estimate))
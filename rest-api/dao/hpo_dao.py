@@ -24,8 +24,8 @@ class HPODao(CacheAllDao):
 
   def __init__(self):
     super(HPODao, self).__init__(HPO, cache_index=HPO_CACHE_INDEX,
-                                 cache_ttl_seconds=600, index_field_keys=['name'],
-                                 order_by_ending=_ORDER_BY_ENDING)
+                                 cache_ttl_seconds=60, index_field_keys=['name'],
+                                 order_by_ending=_ORDER_BY_ENDING, incremental_refresh=True)
 
   def _validate_update(self, session, obj, existing_obj):
     # HPOs aren't versioned; suppress the normal check here.
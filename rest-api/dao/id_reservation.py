@@ -0,0 +1,159 @@
+"""Reserves random IDs for new rows from per-server pools of IDs already checked to be unused.
+
+Participants, questionnaire responses and physical measurements get random 9-digit IDs, so that
+IDs don't reveal how many there are. Rather than trying an INSERT with a fresh random ID and
+retrying when it collides with an existing row, each pool draws a batch of random candidates,
+drops those already in use with one query, and hands out the rest. A reserved ID can still be
+taken by another server before it is inserted; callers retry with a new ID when that happens, and
+report it with record_collisions.
+
+get_id_reservation_stats returns counters for each pool, including the fraction of candidates
+found to be in use (which grows as the tables fill the ID space) and how often callers had to wait
+for a pool to be refilled.
+"""
+
+import collections
+import logging
+import random
+import re
+import threading
+
+from werkzeug.exceptions import ServiceUnavailable
+
+# Range of possible values for random IDs.
+_MIN_ID = 100000000
+_MAX_ID = 999999999
+
+# Number of random candidates drawn (and checked with one query) when a pool is refilled.
+ID_RESERVATION_BATCH_SIZE = 100
+# Maximum number of refills in a row that may find no unused IDs before a reservation gives up.
+MAX_REFILL_ATTEMPTS = 20
+
+# Duplicate key errors from SQLite (naming the table.column) and MySQL (quoting the value).
+_SQLITE_DUPLICATE_RE = re.compile(r'UNIQUE constraint failed: (.+)')
+_MYSQL_DUPLICATE_RE = re.compile(r"Duplicate entry '([^']*)'")
+
+
+class _IdPool(object):
+  """Unused IDs for one column of a table, and counters for them."""
+
+  def __init__(self, model_type, field):
+    self.model_type = model_type
+    self.field = field
+    self._lock = threading.Lock()
+    self._ids = []
+    # Candidates drawn, and those found to be in use already.
+    self.drawn = 0
+    self.taken = 0
+    self.refills = 0
+    # Reservations that found the pool empty, and had to wait for it to be refilled.
+    self.depletions = 0
+    self.reserved = 0
+    # Inserts with an ID from this pool that failed because another server had used it.
+    self.insert_collisions = 0
+
+  def reserve(self, dao):
+    with self._lock:
+      if not self._ids:
+        self.depletions += 1
+        for _ in range(MAX_REFILL_ATTEMPTS):
+          self._refill(dao)
+          if self._ids:
+            break
+        else:
+          logging.warning('No unused %s.%s found in %d batches of %d.', self.model_type.__name__,
+                          self.field, MAX_REFILL_ATTEMPTS, ID_RESERVATION_BATCH_SIZE)
+          raise ServiceUnavailable('Giving up after %d attempts to reserve an ID.' %
+                                   MAX_REFILL_ATTEMPTS)
+      self.reserved += 1
+      return self._ids.pop()
+
+  def _refill(self, dao):
+    candidates = [random.randint(_MIN_ID, _MAX_ID) for _ in range(ID_RESERVATION_BATCH_SIZE)]
+    column = getattr(self.model_type, self.field)
+    with dao.session() as session:
+      taken_ids = set(row[0] for row in
+                      session.query(column).filter(column.in_(set(candidates))))
+    unused_ids = collections.OrderedDict.fromkeys(
+        candidate for candidate in candidates if candidate not in taken_ids)
+    self.drawn += len(candidates)
+    self.taken += len(candidates) - len(unused_ids)
+    self.refills += 1
+    # Hand them out in the order they were drawn.
+    self._ids.extend(reversed(unused_ids))
+
+  def record_collision(self):
+    with self._lock:
+      self.insert_collisions += 1
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        'available': len(self._ids),
+        'drawn': self.drawn,
+        'taken': self.taken,
+        'collision_rate': float(self.taken) / self.drawn if self.drawn else 0.0,
+        'refills': self.refills,
+        'depletions': self.depletions,
+        'reserved': self.reserved,
+        'insert_collisions': self.insert_collisions,
+      }
+
+
+# (model name, field) -> _IdPool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(model_type, field):
+  key = (model_type.__name__, field)
+  pool = _pools.get(key)
+  if pool is None:
+    with _pools_lock:
+      pool = _pools.setdefault(key, _IdPool(model_type, field))
+  return pool
+
+
+def reserve_id(dao, field):
+  """Returns a random ID not used by any row of dao's table in the given field when it was checked.
+
+  Raises ServiceUnavailable if no unused ID can be found.
+  """
+  return _get_pool(dao.model_type, field).reserve(dao)
+
+
+def record_collisions(dao, tried_ids, error):
+  """Records that an insert with the reserved IDs in tried_ids ((field, ID) pairs) failed with
+  the IntegrityError error, for each field whose ID the error reports as a duplicate.
+
+  Errors that don't name one of the tried IDs (e.g. duplicates in other unique columns) aren't
+  counted as collisions.
+  """
+  for field in _get_colliding_fields(dao, tried_ids, error):
+    _get_pool(dao.model_type, field).record_collision()
+
+
+def _get_colliding_fields(dao, tried_ids, error):
+  # The original DBAPI error, as the IntegrityError's message includes the statement's columns.
+  message = str(getattr(error, 'orig', error))
+  match = _SQLITE_DUPLICATE_RE.search(message)
+  if match:
+    columns = set(column.strip().split('.')[-1] for column in match.group(1).split(','))
+    return set(field for field, _ in tried_ids
+               if getattr(dao.model_type, field).property.columns[0].name in columns)
+  match = _MYSQL_DUPLICATE_RE.search(message)
+  if match:
+    # Values of composite keys (e.g. participant_history's) are joined with dashes.
+    values = match.group(1).split('-')
+    return set(field for field, tried_id in tried_ids if str(tried_id) in values)
+  return set()
+
+
+def get_id_reservation_stats():
+  """Returns {(model name, field): counters} for the ID pools in use."""
+  return {key: pool.get_stats() for key, pool in _pools.items()}
+
+
+def reset_id_pools_for_tests():
+  with _pools_lock:
+    _pools.clear()
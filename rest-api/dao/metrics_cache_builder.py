@@ -0,0 +1,671 @@
+"""Builds the rows of the metrics cache tables from a single scan of participants.
+
+Each Metrics*CacheDao.get_metrics_cache_sql() statement is run once per HPO, and evaluates grouped
+participant subqueries against every calendar day. MetricsCacheBuilder instead reads participant
+and participant_summary (and race answers) once for all HPOs, records the days on which each
+participant starts and stops being counted in each stratum, and turns those changes into daily
+counts with a running sum. The rows it inserts are the same as the SQL's.
+
+MetricsCacheBuilder.update_cache can also insert a new version of a cache by copying the rows of
+the newest complete version that participant changes since can't have affected, and only computing
+the rest (reading only the participants of HPOs with changes).
+"""
+
+import bisect
+import collections
+import datetime
+import logging
+import threading
+
+from sqlalchemy import and_, func, literal, not_, or_, select
+
+from dao import database_factory
+from dao.metrics_cache_dao import MetricsEnrollmentStatusCacheDao, MetricsGenderCacheDao, \
+  MetricsAgeCacheDao, MetricsRaceCacheDao, MetricsRegionCacheDao, MetricsLifecycleCacheDao, \
+  MetricsLanguageCacheDao, MetricsCacheVersionDao
+from model.calendar import Calendar
+from model.code import Code
+from model.metrics_cache import MetricsEnrollmentStatusCache, MetricsGenderCache, \
+  MetricsAgeCache, MetricsRaceCache, MetricsRegionCache, MetricsLifecycleCache, \
+  MetricsLanguageCache
+from model.participant import Participant, ParticipantHistory
+from model.participant_summary import ParticipantSummary
+from model.questionnaire import QuestionnaireQuestion
+from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from participant_enums import QuestionnaireStatus, WithdrawalStatus
+
+# Number of cache rows inserted per statement.
+_INSERT_BATCH_SIZE = 5000
+
+# Participants modified up to this long before a cache version was inserted are treated as changed
+# by update_cache: the scan a version is built from may predate its date_inserted, transactions may
+# have been in flight during it, and date_inserted is in local time.
+_CHANGE_DETECTION_MARGIN = datetime.timedelta(days=1)
+
+# update_cache computes a version in full instead if the last one computed in full was inserted
+# this long before, bringing up to date any days that changes it assumes can't happen (such as a
+# participant's dates moving later) have affected.
+_FULL_REBUILD_INTERVAL = datetime.timedelta(days=28)
+
+# Enrollment statuses in the order the SQL unions them, for stable row order.
+_ENROLLMENT_STATUSES = ('core', 'registered', 'consented')
+
+# Answers to the race question that are counted on their own, by cache column.
+_RACE_ANSWER_COLUMNS = [
+  ('american_indian_alaska_native', 'WhatRaceEthnicity_AIAN'),
+  ('asian', 'WhatRaceEthnicity_Asian'),
+  ('black_african_american', 'WhatRaceEthnicity_Black'),
+  ('middle_eastern_north_african', 'WhatRaceEthnicity_MENA'),
+  ('native_hawaiian_other_pacific_islander', 'WhatRaceEthnicity_NHPI'),
+  ('white', 'WhatRaceEthnicity_White'),
+  ('hispanic_latino_spanish', 'WhatRaceEthnicity_Hispanic'),
+  ('none_of_these_fully_describe_me', 'WhatRaceEthnicity_RaceEthnicityNoneOfThese'),
+  ('prefer_not_to_answer', 'PMI_PreferNotToAnswer'),
+]
+# Answers that count towards multi_ancestry when more than one is checked.
+_ANCESTRY_ANSWERS = ['WhatRaceEthnicity_Hispanic', 'WhatRaceEthnicity_Black',
+                     'WhatRaceEthnicity_White', 'WhatRaceEthnicity_AIAN',
+                     'WhatRaceEthnicity_Asian', 'WhatRaceEthnicity_MENA',
+                     'WhatRaceEthnicity_NHPI']
+_RACE_COLUMNS = ([column for column, _ in _RACE_ANSWER_COLUMNS] +
+                 ['multi_ancestry', 'no_ancestry_checked'])
+
+# Lifecycle cache columns, in table order.
+_LIFECYCLE_COLUMNS = ['registered', 'consent_enrollment', 'consent_complete', 'ppi_basics',
+                      'ppi_overall_health', 'ppi_lifestyle', 'ppi_healthcare_access',
+                      'ppi_medical_history', 'ppi_medications', 'ppi_family_health',
+                      'ppi_baseline_complete', 'physical_measurement', 'sample_received',
+                      'full_participant']
+
+# Fields read for each participant. Times are truncated to dates, as DATE() does in the SQL.
+_ParticipantDates = collections.namedtuple('_ParticipantDates', [
+  'participant_id', 'hpo_id', 'has_summary', 'sign_up', 'summary_sign_up', 'member', 'core',
+  'gender_identity_id', 'date_of_birth', 'language_en', 'language_es', 'language_unset',
+  'has_state', 'state', 'basics_submitted', 'consent_for_study_enrollment', 'basics',
+  'overall_health', 'lifestyle', 'healthcare_access', 'medical_history', 'medications',
+  'family_health', 'physical_measurements', 'sample_times'])
+
+
+def _date(value):
+  return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def _latest(*dates):
+  """Returns the day from which all of dates have passed, or None if any never happens."""
+  if any(date is None for date in dates):
+    return None
+  return max(dates)
+
+
+def _earliest(*dates):
+  """Returns the day from which any of dates has passed, or None if none happens."""
+  dates = [date for date in dates if date is not None]
+  return min(dates) if dates else None
+
+
+def _mysql_age_start(dob, years):
+  """Returns the first day on which the age computed by the age cache SQL is at least years.
+
+  The SQL computes ages as the year of FROM_DAYS(TO_DAYS(day) - TO_DAYS(dob)); FROM_DAYS counts
+  from year 0 (0000-01-01 is day 1, and days before 0001-01-01 are all year 0).
+  """
+  if years == 0:
+    return datetime.date.min
+  try:
+    return dob + datetime.timedelta(days=datetime.date(years, 1, 1).toordinal() + 365)
+  except OverflowError:
+    return None
+
+
+class _DailyCounts(object):
+  """Counts for each day from start_date to end_date, built from the days on which things are
+  added to and removed from the count."""
+
+  def __init__(self, start_date, num_days):
+    self._start_date = start_date
+    self._deltas = [0] * (num_days + 1)
+
+  def add(self, start, end=None, count=1):
+    """Adds count on the days in [start, end); end None means through end_date."""
+    if start is None:
+      return
+    last = len(self._deltas) - 1
+    first = 0 if start <= self._start_date else min((start - self._start_date).days, last)
+    if end is not None:
+      last = max(min((end - self._start_date).days, last), 0) if end > self._start_date else 0
+    if first < last:
+      self._deltas[first] += count
+      self._deltas[last] -= count
+
+  def totals(self):
+    """Returns the count on each day."""
+    totals = []
+    total = 0
+    for delta in self._deltas[:-1]:
+      total += delta
+      totals.append(total)
+    return totals
+
+
+class MetricsCacheBuilder(object):
+  """Inserts the rows of metrics cache tables computed from one scan of the participant data.
+
+  The participants of each HPO are read (from database, by default the main one) the first time a
+  cache's rows for that HPO are computed, and reused for the others. Caches may be inserted from
+  several threads at once.
+  """
+
+  def __init__(self, hpos, test_hpo_id, test_email_pattern, start_date, end_date, database=None):
+    self._hpos = [(hpo.hpoId, hpo.name) for hpo in hpos]
+    self._test_hpo_id = test_hpo_id
+    self._test_email_pattern = test_email_pattern
+    self._start_date = start_date
+    self._end_date = end_date
+    self._days = None
+    self._participants_by_hpo = {}
+    self._race_answers = {}
+    self._changed_hpos = {}
+    self._database = database or database_factory.get_database()
+    self._scan_lock = threading.Lock()
+
+  def insert_cache(self, dao, date_inserted, dry_run=False):
+    """Inserts dao's cache rows with the given date_inserted, as its get_metrics_cache_sql()
+    would for each HPO, and records the version as complete.
+
+    Returns the number of rows inserted; with dry_run, the rows are computed but not inserted.
+    """
+    rows = self._insert_rows(dao, date_inserted, None, dry_run)
+    if not dry_run:
+      MetricsCacheVersionDao().mark_complete(dao, date_inserted)
+    return rows
+
+  def _insert_rows(self, dao, date_inserted, first_days, dry_run):
+    """Inserts dao's cache rows with the given date_inserted; if first_days is provided, rows are
+    only inserted for an HPO from first_days[HPO ID] on."""
+    model_type, make_rows = self._get_row_builder(dao)
+    days = self._get_days()
+    hpo_days = []
+    for hpo_id, hpo_name in self._hpos:
+      if first_days is None:
+        hpo_days.append((hpo_id, hpo_name, days))
+      else:
+        remaining_days = days[bisect.bisect_left(days, first_days[hpo_id]):]
+        if remaining_days:
+          hpo_days.append((hpo_id, hpo_name, remaining_days))
+    self._scan([hpo_id for hpo_id, _, _ in hpo_days])
+    rows = []
+    for hpo_id, hpo_name, days in hpo_days:
+      common_values = {'date_inserted': date_inserted, 'hpo_id': str(hpo_id),
+                       'hpo_name': hpo_name}
+      for row in make_rows(dao, self._participants_by_hpo.get(hpo_id, []), days):
+        row.update(common_values)
+        rows.append(row)
+    table = model_type.__table__
+    if dry_run:
+      return len(rows)
+    for start in range(0, len(rows), _INSERT_BATCH_SIZE):
+      with dao.session() as session:
+        session.execute(table.insert(), rows[start:start + _INSERT_BATCH_SIZE])
+    logging.info('Inserted %d rows into %s.', len(rows), table.name)
+    return len(rows)
+
+  def update_cache(self, dao, date_inserted, dry_run=False):
+    """Inserts a new version of dao's cache rows with the given date_inserted, recomputing only
+    the rows that may have changed since dao's newest complete version, and records the new version
+    as complete.
+
+    For each HPO, the complete version's rows are copied up to the first day affected by changes
+    to the HPO's participants since it was inserted (or through the last day it has rows for the
+    HPO, if there were none), and the rest are computed as insert_cache does. HPOs the complete
+    version has no rows for (or has under another name) are computed in full, as are all HPOs if
+    there is no complete version or the last version computed in full was inserted over
+    _FULL_REBUILD_INTERVAL earlier. Returns the number of rows inserted; with dry_run, the rows to
+    copy are counted and the others computed, but nothing is inserted.
+    """
+    model_type, _ = self._get_row_builder(dao)
+    table = model_type.__table__
+    with dao.session() as session:
+      base_version = MetricsCacheVersionDao().get_complete_version_with_session(session, dao)
+      if (base_version is None or
+          date_inserted - base_version.rebuiltDateInserted >= _FULL_REBUILD_INTERVAL):
+        return self.insert_cache(dao, date_inserted, dry_run=dry_run)
+      version_filter = self._get_version_filter(dao, table, base_version.dateInserted)
+      last_days = dict(((hpo_id, hpo_name), last_day) for hpo_id, hpo_name, last_day in
+                       session.query(table.c.hpo_id, table.c.hpo_name, func.max(table.c.date))
+                       .filter(*version_filter)
+                       .group_by(table.c.hpo_id, table.c.hpo_name))
+    if not last_days:
+      return self.insert_cache(dao, date_inserted, dry_run=dry_run)
+    changed_hpos = self._get_changed_hpos(base_version.dateInserted - _CHANGE_DETECTION_MARGIN)
+    first_days = {}
+    num_changed = 0
+    for hpo_id, hpo_name in self._hpos:
+      last_day = last_days.get((str(hpo_id), hpo_name))
+      if last_day is None:
+        first_days[hpo_id] = self._start_date
+      else:
+        next_day = last_day + datetime.timedelta(days=1)
+        first_days[hpo_id] = min(next_day, changed_hpos.get(hpo_id, next_day))
+        if first_days[hpo_id] < next_day:
+          num_changed += 1
+
+    hpo_ids_by_first_day = collections.defaultdict(list)
+    for hpo_id, first_day in first_days.iteritems():
+      if first_day > self._start_date:
+        hpo_ids_by_first_day[first_day].append(str(hpo_id))
+    copied = 0
+    with dao.session() as session:
+      for first_day, hpo_ids in sorted(hpo_ids_by_first_day.iteritems()):
+        copied_rows = (select([literal(date_inserted, column.type).label(column.name)
+                               if column is table.c.date_inserted else column
+                               for column in table.columns])
+                       .where(and_(table.c.hpo_id.in_(hpo_ids), table.c.date < first_day,
+                                   *version_filter)))
+        if dry_run:
+          copied += session.execute(
+              select([func.count()]).select_from(copied_rows.alias())).scalar()
+        else:
+          result = session.execute(table.insert().from_select(
+              [column.name for column in table.columns], copied_rows))
+          copied += result.rowcount
+    logging.info('Copied %d rows of %s from version %s; %d of %d HPOs changed.', copied,
+                 table.name, base_version.dateInserted, num_changed, len(self._hpos))
+    rows = copied + self._insert_rows(dao, date_inserted, first_days, dry_run)
+    if not dry_run:
+      MetricsCacheVersionDao().mark_complete(dao, date_inserted, base_version.rebuiltDateInserted)
+    return rows
+
+  @staticmethod
+  def _get_version_filter(dao, table, date_inserted):
+    """Returns conditions selecting the rows of dao's cache version inserted at date_inserted."""
+    conditions = [table.c.date_inserted == date_inserted]
+    if isinstance(dao, MetricsAgeCacheDao):
+      conditions.append(table.c.type == str(dao.cache_type))
+    return conditions
+
+  def _get_row_builder(self, dao):
+    """Returns the model type of dao's cache and the method making its rows for an HPO."""
+    builders = {
+      MetricsEnrollmentStatusCacheDao: (MetricsEnrollmentStatusCache,
+                                        self._make_enrollment_status_rows),
+      MetricsGenderCacheDao: (MetricsGenderCache, self._make_gender_rows),
+      MetricsAgeCacheDao: (MetricsAgeCache, self._make_age_rows),
+      MetricsRaceCacheDao: (MetricsRaceCache, self._make_race_rows),
+      MetricsRegionCacheDao: (MetricsRegionCache, self._make_region_rows),
+      MetricsLifecycleCacheDao: (MetricsLifecycleCache, self._make_lifecycle_rows),
+      MetricsLanguageCacheDao: (MetricsLanguageCache, self._make_language_rows),
+    }
+    return builders[type(dao)]
+
+  def _get_changed_hpos(self, since):
+    """Returns {HPO ID: earliest day whose counts may have changed} for the HPOs of participants
+    whose participant or participant_summary rows were modified at or after since.
+
+    Every cache counts a participant only from their sign up, consent, questionnaire, physical
+    measurements or sample dates, so their changes can only affect counts from the earliest of
+    those (assuming that changes don't move them later). Summary changes (e.g. to gender identity,
+    date of birth or state) can move the participant to another stratum on all of those days, and a
+    changed participant row (e.g. a new pairing or a withdrawal) affects them in the participant's
+    HPO and in HPOs they were paired with before.
+    """
+    with self._scan_lock:
+      if since not in self._changed_hpos:
+        self._changed_hpos[since] = self._read_changed_hpos(since)
+      return self._changed_hpos[since]
+
+  def _read_changed_hpos(self, since):
+    ps = ParticipantSummary
+    changed_hpos = {}
+    with self._database.session() as session:
+      participant_changed = Participant.lastModified >= since
+      query = (select([Participant.participantId, Participant.hpoId, participant_changed,
+                       Participant.signUpTime, ps.signUpTime, ps.enrollmentStatusMemberTime,
+                       ps.enrollmentStatusCoreStoredSampleTime] +
+                      self._get_summary_time_columns())
+               .select_from(Participant.__table__
+                            .outerjoin(ps.__table__, Participant.participantId == ps.participantId))
+               .where(or_(participant_changed, ps.lastModified >= since)))
+      first_days = {}
+      for row in session.execute(query):
+        participant_id, hpo_id, is_participant_changed = row[:3]
+        first_day = _earliest(*[_date(value) for value in row[3:]]) or self._start_date
+        if is_participant_changed:
+          first_days[participant_id] = first_day
+        changed_hpos[hpo_id] = min(first_day, changed_hpos.get(hpo_id, first_day))
+      if first_days:
+        # Participants that changed pairing are no longer counted in their old HPOs.
+        old_pairings = (session.query(ParticipantHistory.participantId, ParticipantHistory.hpoId)
+                        .join(Participant,
+                              Participant.participantId == ParticipantHistory.participantId)
+                        .filter(participant_changed)
+                        .distinct())
+        for participant_id, hpo_id in old_pairings:
+          first_day = first_days[participant_id]
+          changed_hpos[hpo_id] = min(first_day, changed_hpos.get(hpo_id, first_day))
+    return changed_hpos
+
+  def _get_days(self):
+    """Returns the calendar days from start_date to end_date."""
+    with self._scan_lock:
+      if self._days is None:
+        with self._database.session() as session:
+          self._days = [day for day, in session.query(Calendar.day)
+                        .filter(Calendar.day >= self._start_date, Calendar.day <= self._end_date)
+                        .order_by(Calendar.day)]
+      return self._days
+
+  def _scan(self, hpo_ids):
+    """Reads the participants of those of hpo_ids that weren't read yet."""
+    with self._scan_lock:
+      unread_hpo_ids = [hpo_id for hpo_id in hpo_ids if hpo_id not in self._participants_by_hpo]
+      if unread_hpo_ids:
+        self._read_participants(unread_hpo_ids)
+
+  def _read_participants(self, hpo_ids):
+    hpo_filter = None
+    if set(hpo_ids) != set(hpo_id for hpo_id, _ in self._hpos):
+      hpo_filter = Participant.hpoId.in_(hpo_ids)
+    participants_by_hpo = {hpo_id: [] for hpo_id in hpo_ids}
+    race_answers = collections.defaultdict(list)
+    with self._database.session() as session:
+      for row in session.execute(self._get_participant_query(hpo_filter)):
+        participant = self._make_participant(row)
+        if participant.hpo_id in participants_by_hpo:
+          participants_by_hpo[participant.hpo_id].append(participant)
+      question_code_id = MetricsRaceCacheDao.get_race_code_ids()['Race_WhatRaceEthnicity']
+      answers = (session.query(QuestionnaireResponse.participantId,
+                               QuestionnaireResponseAnswer.valueCodeId)
+                 .filter(QuestionnaireQuestion.questionnaireQuestionId ==
+                         QuestionnaireResponseAnswer.questionId,
+                         QuestionnaireQuestion.codeId == question_code_id,
+                         QuestionnaireResponseAnswer.questionnaireResponseId ==
+                         QuestionnaireResponse.questionnaireResponseId))
+      if hpo_filter is not None:
+        answers = answers.filter(Participant.participantId == QuestionnaireResponse.participantId,
+                                 hpo_filter)
+      for participant_id, code_id in answers:
+        race_answers[participant_id].append(code_id)
+    self._race_answers.update(race_answers)
+    # Set last, as it marks the HPOs as read.
+    self._participants_by_hpo.update(participants_by_hpo)
+
+  def _get_participant_query(self, hpo_filter=None):
+    ps = ParticipantSummary
+    columns = [
+      Participant.participantId, Participant.hpoId, ps.participantId, Participant.signUpTime,
+      ps.signUpTime, ps.enrollmentStatusMemberTime, ps.enrollmentStatusCoreStoredSampleTime,
+      ps.genderIdentityId, ps.dateOfBirth,
+      # Matched with LIKE as the SQL does, to get the database's case sensitivity.
+      ps.primaryLanguage.like('%en%'), ps.primaryLanguage.like('%es%'),
+      ps.primaryLanguage.is_(None), Code.codeId, Code.value, ps.questionnaireOnTheBasics,
+    ] + self._get_summary_time_columns()
+    return (select(columns)
+            .select_from(Participant.__table__
+                         .outerjoin(ps.__table__, Participant.participantId == ps.participantId)
+                         .outerjoin(Code.__table__, ps.stateId == Code.codeId))
+            .where(and_(Participant.hpoId != self._test_hpo_id,
+                        Participant.isGhostId.isnot(True),
+                        or_(ps.email.is_(None), not_(ps.email.like(self._test_email_pattern))),
+                        Participant.withdrawalStatus == WithdrawalStatus.NOT_WITHDRAWN,
+                        *([hpo_filter] if hpo_filter is not None else []))))
+
+  @staticmethod
+  def _get_summary_time_columns():
+    """Returns the participant_summary times read as _ParticipantDates fields, in order."""
+    ps = ParticipantSummary
+    return [
+      ps.consentForStudyEnrollmentTime, ps.questionnaireOnTheBasicsTime,
+      ps.questionnaireOnOverallHealthTime, ps.questionnaireOnLifestyleTime,
+      ps.questionnaireOnHealthcareAccessTime, ps.questionnaireOnMedicalHistoryTime,
+      ps.questionnaireOnMedicationsTime, ps.questionnaireOnFamilyHealthTime,
+      ps.physicalMeasurementsTime, ps.sampleStatus1ED10Time, ps.sampleStatus2ED10Time,
+      ps.sampleStatus1ED04Time, ps.sampleStatus1SALTime, ps.sampleStatus1SAL2Time,
+    ]
+
+  @staticmethod
+  def _make_participant(row):
+    (participant_id, hpo_id, summary_participant_id, sign_up, summary_sign_up, member, core,
+     gender_identity_id, date_of_birth, language_en, language_es, language_unset, state_code_id,
+     state, basics_status) = row[:15]
+    dates = [_date(value) for value in row[15:]]
+    return _ParticipantDates(
+        participant_id=participant_id, hpo_id=hpo_id,
+        has_summary=summary_participant_id is not None, sign_up=_date(sign_up),
+        summary_sign_up=_date(summary_sign_up), member=_date(member), core=_date(core),
+        gender_identity_id=gender_identity_id, date_of_birth=_date(date_of_birth),
+        language_en=bool(language_en), language_es=bool(language_es),
+        language_unset=bool(language_unset), has_state=state_code_id is not None, state=state,
+        basics_submitted=(basics_status is not None and
+                          int(basics_status) == int(QuestionnaireStatus.SUBMITTED)),
+        consent_for_study_enrollment=dates[0], basics=dates[1], overall_health=dates[2],
+        lifestyle=dates[3], healthcare_access=dates[4], medical_history=dates[5],
+        medications=dates[6], family_health=dates[7], physical_measurements=dates[8],
+        sample_times=dates[9:])
+
+  def _new_counts(self):
+    return _DailyCounts(self._start_date, (self._end_date - self._start_date).days + 1)
+
+  def _day_totals(self, counts, days):
+    """Yields (day, count) for each of days (calendar days) from counts."""
+    totals = counts.totals()
+    for day in days:
+      yield day, totals[(day - self._start_date).days]
+
+  @staticmethod
+  def _enrollment_intervals(participant):
+    """Returns {enrollment status: (first day, day after last)} as the enrollment status and
+    language caches count them."""
+    return {
+      'registered': (participant.sign_up, participant.member),
+      'consented': (participant.member, participant.core),
+      'core': (participant.core, None),
+    }
+
+  @staticmethod
+  def _cumulative_enrollment_intervals(participant):
+    """Like _enrollment_intervals, but only from sign up, as the gender and age caches count."""
+    return {
+      'registered': (participant.sign_up, participant.member),
+      'consented': (_latest(participant.sign_up, participant.member), participant.core),
+      'core': (_latest(participant.sign_up, participant.core), None),
+    }
+
+  def _make_enrollment_status_rows(self, _, participants, days):
+    counts = {status: self._new_counts() for status in _ENROLLMENT_STATUSES}
+    for participant in participants:
+      for status, (start, end) in self._enrollment_intervals(participant).iteritems():
+        counts[status].add(start, end)
+    rows = []
+    for (day, registered), (_, consented), (_, core) in zip(
+        self._day_totals(counts['registered'], days), self._day_totals(counts['consented'], days),
+        self._day_totals(counts['core'], days)):
+      rows.append({'date': day, 'registered_count': registered, 'consented_count': consented,
+                   'core_count': core})
+    return rows
+
+  def _make_stratified_rows(self, strata, participants, days, get_intervals, value_column):
+    """Returns a row for each calendar day, enrollment status and stratum.
+
+    strata is a list of (stratum name, function returning a list of (first day, day after last)
+    intervals in which a participant is in the stratum).
+    """
+    rows = []
+    for status in _ENROLLMENT_STATUSES:
+      for name, get_stratum_intervals in strata:
+        counts = self._new_counts()
+        for participant in participants:
+          start, end = get_intervals(participant)[status]
+          if start is None:
+            continue
+          for stratum_start, stratum_end in get_stratum_intervals(participant):
+            counts.add(_latest(start, stratum_start),
+                       end if stratum_end is None else min(end or stratum_end, stratum_end))
+        for day, count in self._day_totals(counts, days):
+          rows.append({'enrollment_status': status, 'date': day, 'name': name,
+                       value_column: count})
+    return rows
+
+  def _make_gender_rows(self, _, participants, days):
+    strata = [(gender_name, self._make_matcher('gender_identity_id', code_id))
+              for gender_name, code_id in MetricsGenderCacheDao.get_gender_code_ids()]
+    rows = self._make_stratified_rows(strata, participants, days,
+                                      self._cumulative_enrollment_intervals, 'gender_count')
+    for row in rows:
+      row['gender_name'] = row.pop('name')
+    return rows
+
+  def _make_age_rows(self, dao, participants, days):
+    strata = [('UNSET', self._make_matcher('date_of_birth', None))]
+    for age_range in dao.age_ranges:
+      age_borders = [int(border) for border in filter(None, age_range.split('-'))]
+      strata.append((age_range, self._make_age_matcher(*age_borders)))
+    rows = self._make_stratified_rows(strata, participants, days,
+                                      self._cumulative_enrollment_intervals, 'age_count')
+    for row in rows:
+      row['age_range'] = row.pop('name')
+      row['type'] = str(dao.cache_type)
+    return rows
+
+  @staticmethod
+  def _make_matcher(field, value):
+    """Returns a function giving all days for participants with field equal to value."""
+    def get_intervals(participant):
+      if getattr(participant, field) == value:
+        return [(datetime.date.min, None)]
+      return []
+    return get_intervals
+
+  @staticmethod
+  def _make_age_matcher(min_age, max_age=None):
+    def get_intervals(participant):
+      if participant.date_of_birth is None:
+        return []
+      start = _mysql_age_start(participant.date_of_birth, min_age)
+      end = None if max_age is None else _mysql_age_start(participant.date_of_birth, max_age + 1)
+      if start is None:
+        return []
+      return [(start, end)]
+    return get_intervals
+
+  def _make_language_rows(self, _, participants, days):
+    strata = [(name, self._make_matcher(field, True))
+              for name, field in (('EN', 'language_en'), ('ES', 'language_es'),
+                                  ('UNSET', 'language_unset'))]
+    rows = self._make_stratified_rows(strata, participants, days, self._enrollment_intervals,
+                                      'language_count')
+    for row in rows:
+      row['language_name'] = row.pop('name')
+    return rows
+
+  def _make_region_rows(self, _, participants, days):
+    """Counts participants with a summary and a state by state, on days with any."""
+    counts = collections.OrderedDict()
+    for participant in participants:
+      if not (participant.has_summary and participant.has_state):
+        continue
+      intervals = {
+        'core': (participant.core, None),
+        'registered': (participant.summary_sign_up, participant.member),
+        'consented': (participant.member, participant.core),
+      }
+      for status in _ENROLLMENT_STATUSES:
+        key = (status, participant.state)
+        if key not in counts:
+          counts[key] = self._new_counts()
+        counts[key].add(*intervals[status])
+    rows = []
+    for (status, state), state_counts in sorted(counts.iteritems()):
+      for day, count in self._day_totals(state_counts, days):
+        if count:
+          rows.append({'enrollment_status': status, 'date': day,
+                       'state_name': 'UNSET' if state is None else state, 'state_count': count})
+    return rows
+
+  def _make_race_rows(self, _, participants, days):
+    """Counts participants who submitted The Basics by their race answers, on each day since sign
+    up, grouped by the combination of enrollment status flags they have on the day."""
+    code_ids = MetricsRaceCacheDao.get_race_code_ids()
+    # (registered, consented, core) -> (participant counts, counts for each _RACE_COLUMNS column)
+    counts = collections.OrderedDict()
+    for participant in participants:
+      if not (participant.has_summary and participant.basics_submitted) or \
+          participant.sign_up is None:
+        continue
+      race_values = self._get_race_values(self._race_answers.get(participant.participant_id, []),
+                                          code_ids)
+      member, core = participant.member, participant.core
+      segment_starts = sorted(set([participant.sign_up] +
+                                  [day for day in (member, core)
+                                   if day is not None and day > participant.sign_up]))
+      for start, end in zip(segment_starts, segment_starts[1:] + [None]):
+        flags = (member is None or member > start,
+                 member is not None and member <= start and (core is None or core > start),
+                 core is not None and core <= start)
+        if flags not in counts:
+          counts[flags] = (self._new_counts(), [self._new_counts() for _ in _RACE_COLUMNS])
+        participant_counts, column_counts = counts[flags]
+        participant_counts.add(start, end)
+        for column_count, value in zip(column_counts, race_values):
+          if value:
+            column_count.add(start, end, value)
+    rows = []
+    for flags, (participant_counts, column_counts) in sorted(counts.iteritems()):
+      column_totals = [counts.totals() for counts in column_counts]
+      for day, count in self._day_totals(participant_counts, days):
+        if not count:
+          continue
+        index = (day - self._start_date).days
+        row = {'registered_flag': flags[0], 'consent_flag': flags[1], 'core_flag': flags[2],
+               'date': day}
+        for column, totals in zip(_RACE_COLUMNS, column_totals):
+          row[column] = totals[index]
+        rows.append(row)
+    return rows
+
+  @staticmethod
+  def _get_race_values(answer_code_ids, code_ids):
+    """Returns the participant's value (0 or 1) for each of _RACE_COLUMNS."""
+    # Participants without answers are joined to a single NULL answer.
+    answer_code_ids = answer_code_ids or [None]
+    checked = set(answer_code_ids)
+    single_answer = len(answer_code_ids) == 1
+    values = [int(single_answer and code_ids[answer] in checked)
+              for _, answer in _RACE_ANSWER_COLUMNS]
+    values.append(int(sum(code_ids[answer] in checked for answer in _ANCESTRY_ANSWERS) > 1))
+    values.append(int((single_answer and code_ids['PMI_Skip'] in checked) or None in checked))
+    return values
+
+  def _make_lifecycle_rows(self, _, participants, days):
+    """Counts participants who have reached each lifecycle step, on every day if there are any."""
+    if not participants:
+      return []
+    counts = [self._new_counts() for _ in _LIFECYCLE_COLUMNS]
+    for participant in participants:
+      consent = participant.consent_for_study_enrollment
+      reached = [
+        participant.sign_up,
+        consent,
+        participant.member,
+        _latest(participant.basics, consent),
+        _latest(participant.overall_health, consent),
+        _latest(participant.lifestyle, consent),
+        _latest(participant.healthcare_access, consent),
+        _latest(participant.medical_history, consent),
+        _latest(participant.medications, consent),
+        _latest(participant.family_health, consent),
+        _latest(participant.lifestyle, participant.overall_health, participant.basics, consent),
+        _latest(participant.physical_measurements, consent),
+        _earliest(*participant.sample_times),
+        participant.core,
+      ]
+      for column_counts, day in zip(counts, reached):
+        column_counts.add(day)
+    column_totals = [column_counts.totals() for column_counts in counts]
+    rows = []
+    for day in days:
+      index = (day - self._start_date).days
+      row = {'date': day}
+      for column, totals in zip(_LIFECYCLE_COLUMNS, column_totals):
+        row[column] = totals[index]
+      rows.append(row)
+    return rows
@@ -1,17 +1,150 @@
 from model.metrics_cache import MetricsEnrollmentStatusCache, MetricsGenderCache, MetricsAgeCache, \
-  MetricsRaceCache, MetricsRegionCache, MetricsLifecycleCache, MetricsLanguageCache
+  MetricsRaceCache, MetricsRegionCache, MetricsLifecycleCache, MetricsLanguageCache, \
+  MetricsPublicPayloadCache, MetricsCacheVersion
 from dao.base_dao import BaseDao
 from dao.hpo_dao import HPODao
 from dao.code_dao import CodeDao
 from participant_enums import TEST_HPO_NAME, TEST_EMAIL_PATTERN
 from code_constants import PPI_SYSTEM
 from census_regions import census_regions
+from json_encoder import RdrJsonEncoder
+import collections
 import datetime
+import functools
+import inspect
 import json
+import threading
+import zlib
+from protorpc import messages
 from sqlalchemy import func, or_
 from participant_enums import Stratifications, AGE_BUCKETS_METRICS_V2_API, \
   AGE_BUCKETS_PUBLIC_METRICS_EXPORT_API, MetricsCacheType
 
+# Approximate most bytes (of results as JSON) kept by the get_latest_version_from_cache result
+# cache, shared by all the metrics cache DAOs.
+RESULT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+class _ResultCache(object):
+  """An LRU cache of get_latest_version_from_cache results, bounded by their size as JSON.
+
+  Each result is tagged with the date_inserted of the serving version it was read from. When a
+  newer version of a cache is seen, all results from older versions of it are dropped.
+  """
+
+  def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # (cache name, arguments) -> (date_inserted, result, size)
+    self._results = collections.OrderedDict()
+    # cache name -> latest date_inserted seen
+    self._versions = {}
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, cache_name, args, date_inserted, compute):
+    """Returns the result for cache_name and args from the version inserted at date_inserted,
+    calling compute() to get it if it isn't cached. Results must not be modified by callers."""
+    key = (cache_name, args)
+    with self._lock:
+      if self._versions.get(cache_name) != date_inserted:
+        self._drop_version_locked(cache_name, date_inserted)
+      entry = self._results.get(key)
+      if entry is not None:
+        del self._results[key]
+        self._results[key] = entry
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+    result = compute()
+    size = len(json.dumps(result, default=str))
+    if size > self.max_bytes:
+      return result
+    with self._lock:
+      # Don't cache results of versions that were replaced while computing.
+      if self._versions.get(cache_name) == date_inserted and key not in self._results:
+        self._results[key] = (date_inserted, result, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+          _, (_, _, evicted_size) = self._results.popitem(last=False)
+          self._bytes -= evicted_size
+          self.evictions += 1
+    return result
+
+  def _drop_version_locked(self, cache_name, date_inserted):
+    latest = self._versions.get(cache_name)
+    if latest is not None and date_inserted is not None and date_inserted < latest:
+      # A reader that saw an older version (e.g. on a lagging replica); don't evict the newer one.
+      return
+    self._versions[cache_name] = date_inserted
+    for key, (_, _, size) in self._results.items():
+      if key[0] == cache_name:
+        del self._results[key]
+        self._bytes -= size
+
+  def get_stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+              'entries': len(self._results), 'bytes': self._bytes}
+
+  def clear(self):
+    with self._lock:
+      self._results.clear()
+      self._versions.clear()
+      self._bytes = self.hits = self.misses = self.evictions = 0
+
+
+_result_cache = _ResultCache()
+
+
+def get_result_cache_stats():
+  """Returns hit, miss and eviction counts, and the number and size of the cached results of the
+  metrics cache DAOs' get_latest_version_from_cache methods."""
+  return _result_cache.get_stats()
+
+
+def reset_result_cache_for_tests():
+  _result_cache.clear()
+
+
+def _normalize_argument(value):
+  if isinstance(value, (list, tuple, set)):
+    return tuple(sorted(str(item) for item in value))
+  if isinstance(value, messages.Enum):
+    return str(value)
+  return value
+
+
+def _cached_result(get_latest_version_from_cache):
+  """Decorates a metrics cache DAO's get_latest_version_from_cache to reuse its results until a
+  new version of the cache is inserted. Results are only reused while the serving version is
+  recorded as complete in metrics_cache_version.
+
+  Results are keyed by the DAO's cache and cache type and the method's arguments (with lists
+  sorted, so awardees or enrollment statuses in any order share results).
+  """
+  @functools.wraps(get_latest_version_from_cache)
+  def wrapper(self, *args, **kwargs):
+    call_args = inspect.getcallargs(get_latest_version_from_cache, self, *args, **kwargs)
+    del call_args['self']
+    key = tuple(sorted((name, _normalize_argument(value))
+                       for name, value in call_args.iteritems()))
+    with self.session() as session:
+      serving_version = self.get_serving_version_with_session(session)
+      complete_version = MetricsCacheVersionDao().get_complete_version_with_session(session, self)
+    if (serving_version is None or complete_version is None or
+        serving_version.dateInserted != complete_version.dateInserted):
+      # The newest version is still being written (or its refresh failed), so results from it may
+      # be partial.
+      return get_latest_version_from_cache(self, *args, **kwargs)
+    cache_name = '%s %s' % (self.model_type.__tablename__, self.cache_type)
+    return _result_cache.get(cache_name, key, serving_version.dateInserted,
+                             lambda: get_latest_version_from_cache(self, *args, **kwargs))
+  return wrapper
+
+
 class MetricsEnrollmentStatusCacheDao(BaseDao):
   def __init__(self, cache_type=MetricsCacheType.METRICS_V2_API):
     super(MetricsEnrollmentStatusCacheDao, self).__init__(MetricsEnrollmentStatusCache)
@@ -66,6 +199,7 @@ class MetricsEnrollmentStatusCacheDao(BaseDao):
 
         return query.all()
 
+  @_cached_result
   def get_latest_version_from_cache(self, start_date, end_date, hpo_ids=None):
     buckets = self.get_active_buckets(start_date, end_date, hpo_ids)
     if buckets is None:
@@ -308,6 +442,7 @@ class MetricsGenderCacheDao(BaseDao):
 
       return results
 
+  @_cached_result
   def get_latest_version_from_cache(self, start_date, end_date, hpo_ids=None,
                                     enrollment_statuses=None):
     buckets = self.get_active_buckets(start_date, end_date, hpo_ids, enrollment_statuses)
@@ -356,8 +491,12 @@ class MetricsGenderCacheDao(BaseDao):
       client_json.append(new_item)
     return client_json
 
-  def get_metrics_cache_sql(self):
+  @staticmethod
+  def get_gender_code_ids():
+    """Returns (gender name, gender identity code ID) for each gender in the cache.
 
+    The code ID is None for the participants with no gender identity.
+    """
     gender_code_dict = {
       'GenderIdentity_Woman': 354,
       'GenderIdentity_Man': 356,
@@ -373,19 +512,27 @@ class MetricsGenderCacheDao(BaseDao):
       if code is not None:
         gender_code_dict[k] = code.codeId
 
-    sql = """insert into metrics_gender_cache """
-    gender_names = ['UNSET', 'Woman', 'Man', 'Transgender', 'PMI_Skip', 'Non-Binary',
-                    'Other/Additional Options', 'Prefer not to say']
-    gender_conditions = [
-      ' ps.gender_identity_id IS NULL ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['GenderIdentity_Woman']) + ' ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['GenderIdentity_Man']) + ' ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['GenderIdentity_Transgender']) + ' ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['PMI_Skip']) + ' ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['GenderIdentity_NonBinary']) + ' ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['GenderIdentity_AdditionalOptions']) + ' ',
-      ' ps.gender_identity_id=' + str(gender_code_dict['PMI_PreferNotToAnswer']) + ' ',
+    return [
+      ('UNSET', None),
+      ('Woman', gender_code_dict['GenderIdentity_Woman']),
+      ('Man', gender_code_dict['GenderIdentity_Man']),
+      ('Transgender', gender_code_dict['GenderIdentity_Transgender']),
+      ('PMI_Skip', gender_code_dict['PMI_Skip']),
+      ('Non-Binary', gender_code_dict['GenderIdentity_NonBinary']),
+      ('Other/Additional Options', gender_code_dict['GenderIdentity_AdditionalOptions']),
+      ('Prefer not to say', gender_code_dict['PMI_PreferNotToAnswer']),
     ]
+
+  def get_metrics_cache_sql(self):
+    sql = """insert into metrics_gender_cache """
+    gender_names = []
+    gender_conditions = []
+    for gender_name, code_id in self.get_gender_code_ids():
+      gender_names.append(gender_name)
+      if code_id is None:
+        gender_conditions.append(' ps.gender_identity_id IS NULL ')
+      else:
+        gender_conditions.append(' ps.gender_identity_id=' + str(code_id) + ' ')
     sub_queries = []
     sql_template = """
       SELECT
@@ -578,6 +725,7 @@ class MetricsAgeCacheDao(BaseDao):
 
       return results
 
+  @_cached_result
   def get_latest_version_from_cache(self, start_date, end_date, hpo_ids=None,
                                     enrollment_statuses=None):
     buckets = self.get_active_buckets(start_date, end_date, hpo_ids, enrollment_statuses)
@@ -935,6 +1083,7 @@ class MetricsRaceCacheDao(BaseDao):
 
         return query.all()
 
+  @_cached_result
   def get_latest_version_from_cache(self, start_date, end_date, hpo_ids=None,
                                     enrollment_statuses=None):
     buckets = self.get_active_buckets(start_date, end_date, hpo_ids, enrollment_statuses)
@@ -1003,8 +1152,9 @@ class MetricsRaceCacheDao(BaseDao):
       client_json.append(new_item)
     return client_json
 
-  def get_metrics_cache_sql(self):
-
+  @staticmethod
+  def get_race_code_ids():
+    """Returns the code IDs of the race question and its answers, by code value."""
     race_code_dict = {
       'Race_WhatRaceEthnicity': 193,
       'WhatRaceEthnicity_Hispanic': 207,
@@ -1023,7 +1173,10 @@ class MetricsRaceCacheDao(BaseDao):
       code = CodeDao().get_code(PPI_SYSTEM, k)
       if code is not None:
         race_code_dict[k] = code.codeId
+    return race_code_dict
 
+  def get_metrics_cache_sql(self):
+    race_code_dict = self.get_race_code_ids()
     sql = """
           insert into metrics_race_cache
             SELECT
@@ -1220,6 +1373,7 @@ class MetricsRegionCacheDao(BaseDao):
         return query.group_by(MetricsRegionCache.date, MetricsRegionCache.hpoName,
                               MetricsRegionCache.stateName).all()
 
+  @_cached_result
   def get_latest_version_from_cache(self, cutoff, stratification, hpo_ids=None,
                                     enrollment_statuses=None):
     stratification = Stratifications(str(stratification))
@@ -1542,6 +1696,7 @@ class MetricsLifecycleCacheDao(BaseDao):
         client_json.append(new_item)
       return client_json
 
+  @_cached_result
   def get_latest_version_from_cache(self, cutoff, hpo_ids=None):
     buckets = self.get_active_buckets(cutoff, hpo_ids)
     if buckets is None:
@@ -1786,6 +1941,7 @@ class MetricsLanguageCacheDao(BaseDao):
         return query.group_by(MetricsLanguageCache.date, MetricsLanguageCache.hpoName,
                               MetricsLanguageCache.languageName).all()
 
+  @_cached_result
   def get_latest_version_from_cache(self, start_date, end_date, hpo_ids=None,
                                     enrollment_statuses=None):
 
@@ -1923,3 +2079,125 @@ class MetricsLanguageCacheDao(BaseDao):
     sql = sql + ' UNION '.join(sub_queries)
 
     return sql
+
+
+def compress_payload(results):
+  """Returns results as gzipped JSON."""
+  compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(json.dumps(results, cls=RdrJsonEncoder)) + compressor.flush()
+
+
+def decompress_payload(payload):
+  """Returns the JSON string in a gzipped payload."""
+  return zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+
+
+class MetricsPublicPayloadCacheDao(BaseDao):
+  """Stores PublicMetrics API responses rendered for common parameters, each tagged with the
+  serving version of the metrics cache it was rendered from, so it is only served until that cache
+  is refreshed."""
+
+  # The cache each stratification that can be pre-rendered is read from.
+  _SOURCE_DAOS = {
+    Stratifications.TOTAL: MetricsEnrollmentStatusCacheDao,
+    Stratifications.ENROLLMENT_STATUS: MetricsEnrollmentStatusCacheDao,
+    Stratifications.GENDER_IDENTITY: MetricsGenderCacheDao,
+    Stratifications.AGE_RANGE: MetricsAgeCacheDao,
+    Stratifications.RACE: MetricsRaceCacheDao,
+    Stratifications.GEO_STATE: MetricsRegionCacheDao,
+    Stratifications.GEO_CENSUS: MetricsRegionCacheDao,
+    Stratifications.GEO_AWARDEE: MetricsRegionCacheDao,
+    Stratifications.LANGUAGE: MetricsLanguageCacheDao,
+    Stratifications.LIFECYCLE: MetricsLifecycleCacheDao,
+    Stratifications.PRIMARY_CONSENT: MetricsLifecycleCacheDao,
+  }
+  PRERENDERED_STRATIFICATIONS = sorted(_SOURCE_DAOS.keys(), key=str)
+
+  def __init__(self):
+    super(MetricsPublicPayloadCacheDao, self).__init__(MetricsPublicPayloadCache)
+
+  def get_serving_version_with_session(self, session, stratification):
+    """Returns the date_inserted of the serving version of the cache stratification is read from,
+    or None if it can't be pre-rendered or the cache is empty."""
+    source_dao_type = self._SOURCE_DAOS.get(stratification)
+    if source_dao_type is None:
+      return None
+    source_dao = source_dao_type(MetricsCacheType.PUBLIC_METRICS_EXPORT_API)
+    serving_version = source_dao.get_serving_version_with_session(session)
+    return serving_version.dateInserted if serving_version is not None else None
+
+  def get_payload(self, stratification, start_date, end_date):
+    """Returns the gzipped response for stratification over the dates (for all awardees and
+    enrollment statuses), if one was rendered from the serving version of its cache."""
+    with self.session() as session:
+      date_inserted = self.get_serving_version_with_session(session, stratification)
+      if date_inserted is None:
+        return None
+      row = (session.query(MetricsPublicPayloadCache.payload)
+             .filter(MetricsPublicPayloadCache.dateInserted == date_inserted,
+                     MetricsPublicPayloadCache.stratification == str(stratification),
+                     MetricsPublicPayloadCache.startDate == start_date,
+                     MetricsPublicPayloadCache.endDate == end_date)
+             .first())
+      return row.payload if row is not None else None
+
+  def insert_payload(self, date_inserted, stratification, start_date, end_date, results):
+    """Stores results, rendered from the cache version inserted at date_inserted, compressed."""
+    with self.session() as session:
+      session.merge(MetricsPublicPayloadCache(dateInserted=date_inserted,
+                                              stratification=str(stratification),
+                                              startDate=start_date, endDate=end_date,
+                                              payload=compress_payload(results)))
+
+  def delete_old_records(self, n_days_ago=7):
+    with self.session() as session:
+      last_inserted_record = (session.query(MetricsPublicPayloadCache.dateInserted)
+                              .order_by(MetricsPublicPayloadCache.dateInserted.desc())
+                              .first())
+      if last_inserted_record is not None:
+        seven_days_ago = last_inserted_record.dateInserted - datetime.timedelta(days=n_days_ago)
+        session.query(MetricsPublicPayloadCache)\
+          .filter(MetricsPublicPayloadCache.dateInserted < seven_days_ago)\
+          .delete(synchronize_session=False)
+
+
+def get_cache_version_name(dao):
+  """Returns the name a metrics cache DAO's versions are recorded under in metrics_cache_version."""
+  name = dao.model_type.__tablename__
+  if isinstance(dao, MetricsAgeCacheDao):
+    name = '%s %s' % (name, dao.cache_type)
+  return name
+
+
+class MetricsCacheVersionDao(BaseDao):
+  """Records which versions of the metrics caches were completely written."""
+
+  def __init__(self):
+    super(MetricsCacheVersionDao, self).__init__(MetricsCacheVersion)
+
+  def get_complete_version_with_session(self, session, cache_dao):
+    """Returns the MetricsCacheVersion of cache_dao's newest complete version, or None."""
+    return (session.query(MetricsCacheVersion)
+            .filter(MetricsCacheVersion.cacheName == get_cache_version_name(cache_dao))
+            .order_by(MetricsCacheVersion.dateInserted.desc())
+            .first())
+
+  def mark_complete(self, cache_dao, date_inserted, rebuilt_date_inserted=None):
+    """Records that all of cache_dao's rows with date_inserted were written. rebuilt_date_inserted
+    is the version computed in full that it was updated from, if it was updated incrementally."""
+    with self.session() as session:
+      session.merge(MetricsCacheVersion(cacheName=get_cache_version_name(cache_dao),
+                                        dateInserted=date_inserted,
+                                        rebuiltDateInserted=rebuilt_date_inserted or
+                                        date_inserted))
+
+  def delete_old_records(self, n_days_ago=7):
+    with self.session() as session:
+      last_inserted_record = (session.query(MetricsCacheVersion.dateInserted)
+                              .order_by(MetricsCacheVersion.dateInserted.desc())
+                              .first())
+      if last_inserted_record is not None:
+        seven_days_ago = last_inserted_record.dateInserted - datetime.timedelta(days=n_days_ago)
+        session.query(MetricsCacheVersion)\
+          .filter(MetricsCacheVersion.dateInserted < seven_days_ago)\
+          .delete(synchronize_session=False)
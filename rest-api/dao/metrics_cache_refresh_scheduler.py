@@ -0,0 +1,100 @@
+"""Runs the units of a metrics cache refresh on a bounded pool of worker threads.
+
+A refresh unit inserts the rows of one cache (or, when refreshing with each cache's SQL, of one
+cache for one HPO), and uses one database connection at a time. The number of workers is capped by
+the run's connection budget, so a refresh never holds more connections than that.
+"""
+
+import Queue
+import collections
+import logging
+import sys
+import threading
+import time
+
+# Number of slowest units listed by format_slowest_units.
+SLOWEST_UNITS_REPORTED = 10
+
+# name identifies the unit in logs and reports; run(dry_run=False) inserts the unit's rows and
+# returns how many there were (with dry_run, computes them without writing anything).
+RefreshUnit = collections.namedtuple('RefreshUnit', ['name', 'run'])
+
+
+class UnitResult(collections.namedtuple('UnitResult', ['name', 'rows', 'duration', 'error'])):
+  """The outcome of running a RefreshUnit: rows it inserted (None if it failed), the seconds it
+  took, and the exception it raised (or None)."""
+
+
+class MetricsCacheRefreshScheduler(object):
+  """Runs RefreshUnits concurrently on up to `workers` threads, and no more than
+  `connection_budget` (if set)."""
+
+  def __init__(self, workers=1, connection_budget=None):
+    if connection_budget is not None:
+      workers = min(workers, connection_budget)
+    self.workers = max(1, workers)
+
+  def run(self, units, dry_run=False):
+    """Runs units, returning a UnitResult for each, in the same order.
+
+    Units are started in order. If one fails, no further units are started, and once the running
+    ones finish its exception is re-raised.
+    """
+    units = list(units)
+    results = [None] * len(units)
+    pending = Queue.Queue()
+    for index, unit in enumerate(units):
+      pending.put((index, unit))
+    failures = []
+
+    def work():
+      while not failures:
+        try:
+          index, unit = pending.get_nowait()
+        except Queue.Empty:
+          return
+        results[index] = self._run_unit(unit, dry_run, failures)
+
+    workers = min(self.workers, len(units))
+    logging.info('Running %d metrics cache refresh units on %d workers%s.', len(units), workers,
+                 ' (dry run)' if dry_run else '')
+    if workers <= 1:
+      work()
+    else:
+      threads = [threading.Thread(target=work, name='metrics-cache-refresh-%d' % i)
+                 for i in range(workers)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    if failures:
+      exc_type, exc_value, exc_traceback = failures[0]
+      raise exc_type, exc_value, exc_traceback
+    return results
+
+  @staticmethod
+  def _run_unit(unit, dry_run, failures):
+    start = time.time()
+    try:
+      rows = unit.run(dry_run=dry_run)
+    except Exception:  # pylint: disable=broad-except
+      failures.append(sys.exc_info())
+      logging.exception('Metrics cache refresh unit %s failed.', unit.name)
+      return UnitResult(unit.name, None, time.time() - start, sys.exc_info()[1])
+    duration = time.time() - start
+    logging.info('Metrics cache refresh unit %s: %s rows in %.1fs.', unit.name, rows, duration)
+    return UnitResult(unit.name, rows, duration, None)
+
+
+def format_slowest_units(results, count=SLOWEST_UNITS_REPORTED):
+  """Returns lines describing the count slowest of results (UnitResults that ran), slowest first,
+  followed by a total."""
+  results = [result for result in results if result is not None]
+  slowest = sorted(results, key=lambda result: result.duration, reverse=True)[:count]
+  lines = ['%8.1fs %10s rows  %s' % (result.duration,
+                                     'failed' if result.error else result.rows, result.name)
+           for result in slowest]
+  lines.append('%8.1fs %10d rows  total of %d units' % (
+      sum(result.duration for result in results),
+      sum(result.rows or 0 for result in results), len(results)))
+  return lines
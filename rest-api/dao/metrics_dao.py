@@ -1,8 +1,11 @@
+import array
 import clock
 import json
 import logging
+import sys
+import zlib
 
-from model.metrics import MetricsVersion, MetricsBucket
+from model.metrics import MetricsVersion, MetricsBucket, MetricsName, MetricsBlock
 from dao.base_dao import BaseDao, UpsertableDao
 from werkzeug.exceptions import PreconditionFailed
 from sqlalchemy.orm import subqueryload
@@ -17,6 +20,13 @@ METRICS_LOCK_TIMEOUT = timedelta(hours=24)
 # but we'll keep them around in case we need to poke at them for a few days.)
 _METRICS_EXPIRATION = timedelta(days=3)
 
+# Buckets are packed into blocks of this many dates, each starting on a multiple of it (counting
+# days from 0001-01-01), so that the block for any date can be found without an index.
+METRICS_BLOCK_DAYS = 32
+# Stands in for the count of a metric on a date whose bucket didn't include that metric (or for
+# which there was no bucket at all).
+_MISSING_COUNT = -2 ** 31
+
 class MetricsVersionDao(BaseDao):
   def __init__(self):
     super(MetricsVersionDao, self).__init__(MetricsVersion)
@@ -111,3 +121,147 @@ class MetricsBucketDao(UpsertableDao):
     if model.hpoId:
       facets['hpoId'] = model.hpoId
     return {'facets': facets, 'entries': json.loads(model.metrics)}
+
+
+def get_block_start_date(bucket_date):
+  """Returns the first date of the block a bucket for bucket_date is packed into."""
+  ordinal = bucket_date.toordinal()
+  return bucket_date.fromordinal(ordinal - (ordinal - 1) % METRICS_BLOCK_DAYS)
+
+
+def pack_counts(metric_ids, rows):
+  """Packs rows of counts (one row per date, with a count for each of metric_ids) as a compressed
+  array of little-endian 32-bit integers: the number of rows, the number of metric IDs, the metric
+  IDs and then each row.
+  """
+  counts = array.array('i', [len(rows), len(metric_ids)])
+  counts.extend(metric_ids)
+  for row in rows:
+    counts.extend(row)
+  if sys.byteorder != 'little':
+    counts.byteswap()
+  return zlib.compress(counts.tostring())
+
+
+def unpack_counts(packed):
+  """Returns (metric IDs, rows of counts) packed by pack_counts."""
+  counts = array.array('i')
+  counts.fromstring(zlib.decompress(packed))
+  if sys.byteorder != 'little':
+    counts.byteswap()
+  num_rows, num_metrics = counts[0], counts[1]
+  start = 2 + num_metrics
+  return (counts[2:start].tolist(),
+          [counts[start + i * num_metrics:start + (i + 1) * num_metrics].tolist()
+           for i in xrange(num_rows)])
+
+
+class MetricsBlockDao(BaseDao):
+  """Stores a MetricsVersion's buckets as blocks of packed counts (see pack_counts) per HPO and
+  range of dates, with the names of the metrics counted in a dictionary of MetricsNames; serves
+  the same client JSON as MetricsBucketDao from them.
+  """
+
+  def __init__(self):
+    super(MetricsBlockDao, self).__init__(MetricsBlock)
+
+  def get_id(self, obj):
+    return [obj.metricsVersionId, obj.hpoId, obj.startDate]
+
+  def pack_version(self, version_id):
+    """Replaces the buckets for a version with blocks and names. Returns the number of blocks."""
+    with self.session() as session:
+      metric_ids = {}
+      num_blocks = 0
+      hpo_ids = [hpo_id for hpo_id, in (session.query(MetricsBucket.hpoId)
+                                        .filter(MetricsBucket.metricsVersionId == version_id)
+                                        .distinct())]
+      # Read one HPO's buckets at a time; there may be too many for memory across all of them.
+      for hpo_id in hpo_ids:
+        buckets = (session.query(MetricsBucket.date, MetricsBucket.metrics)
+                   .filter(MetricsBucket.metricsVersionId == version_id)
+                   .filter(MetricsBucket.hpoId == hpo_id)
+                   .order_by(MetricsBucket.date)
+                   .all())
+        block_start_date = None
+        entries_by_date = {}
+        for bucket_date, metrics in buckets:
+          start_date = get_block_start_date(bucket_date)
+          if start_date != block_start_date:
+            if entries_by_date:
+              session.add(self._make_block(version_id, hpo_id, block_start_date, entries_by_date,
+                                           metric_ids))
+              num_blocks += 1
+            block_start_date = start_date
+            entries_by_date = {}
+          entries_by_date[bucket_date] = json.loads(metrics)
+        if entries_by_date:
+          session.add(self._make_block(version_id, hpo_id, block_start_date, entries_by_date,
+                                       metric_ids))
+          num_blocks += 1
+      for name, metric_id in metric_ids.iteritems():
+        session.add(MetricsName(metricsVersionId=version_id, metricId=metric_id, name=name))
+      (session.query(MetricsBucket)
+       .filter(MetricsBucket.metricsVersionId == version_id)
+       .delete(synchronize_session=False))
+    logging.info('Packed metrics version %d into %d blocks of %d metrics.', version_id,
+                 num_blocks, len(metric_ids))
+    return num_blocks
+
+  @staticmethod
+  def _make_block(version_id, hpo_id, start_date, entries_by_date, metric_ids):
+    """Returns a MetricsBlock for the metric entries of the buckets in the block starting on
+    start_date, adding IDs for any new metric names to metric_ids."""
+    names = sorted(set(name for entries in entries_by_date.itervalues() for name in entries))
+    for name in names:
+      metric_ids.setdefault(name, len(metric_ids))
+    dates = [start_date + timedelta(days=i) for i in xrange(METRICS_BLOCK_DAYS)]
+    rows = []
+    for bucket_date in dates:
+      entries = entries_by_date.get(bucket_date, {})
+      rows.append([entries.get(name, _MISSING_COUNT) for name in names])
+    return MetricsBlock(metricsVersionId=version_id, hpoId=hpo_id, startDate=start_date,
+                        endDate=dates[-1],
+                        counts=pack_counts([metric_ids[name] for name in names], rows))
+
+  def get_active_client_json(self, start_date, end_date):
+    """Returns the client JSON for the serving version's buckets from start_date to end_date, as
+    MetricsBucketDao.to_client_json would return it for get_active_buckets; or None if there is
+    no serving version or its buckets haven't been packed into blocks.
+    """
+    with self.session() as session:
+      version = MetricsVersionDao().get_serving_version_with_session(session)
+      if version is None:
+        return None
+      version_id = version.metricsVersionId
+      names = dict(session.query(MetricsName.metricId, MetricsName.name)
+                   .filter(MetricsName.metricsVersionId == version_id))
+      if not names:
+        return None
+      blocks = (session.query(MetricsBlock.hpoId, MetricsBlock.startDate, MetricsBlock.counts)
+                .filter(MetricsBlock.metricsVersionId == version_id)
+                .filter(MetricsBlock.startDate <= end_date)
+                .filter(MetricsBlock.endDate >= start_date)
+                .all())
+    buckets = []
+    for hpo_id, block_start_date, packed in blocks:
+      metric_ids, rows = unpack_counts(packed)
+      block_names = [names[metric_id] for metric_id in metric_ids]
+      for i, counts in enumerate(rows):
+        bucket_date = block_start_date + timedelta(days=i)
+        if bucket_date < start_date or bucket_date > end_date:
+          continue
+        # Dates without buckets have only missing counts.
+        if not counts or _MISSING_COUNT in counts:
+          entries = {name: count for name, count in zip(block_names, counts)
+                     if count != _MISSING_COUNT}
+          if not entries:
+            continue
+        else:
+          entries = dict(zip(block_names, counts))
+        facets = {'date': bucket_date.isoformat()}
+        if hpo_id:
+          facets['hpoId'] = hpo_id
+        buckets.append((bucket_date, hpo_id, {'facets': facets, 'entries': entries}))
+    buckets.sort(key=lambda bucket: bucket[:2])
+    return [client_json for _, _, client_json in buckets]
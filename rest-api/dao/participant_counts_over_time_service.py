@@ -1,5 +1,9 @@
 from werkzeug.exceptions import BadRequest
 import datetime
+import functools
+import logging
+
+import config
 from model.participant_summary import ParticipantSummary
 from participant_enums import EnrollmentStatus, TEST_HPO_NAME, TEST_EMAIL_PATTERN
 from participant_enums import WithdrawalStatus, MetricsCacheType, Stratifications
@@ -7,7 +11,10 @@ from dao.hpo_dao import HPODao
 from dao.base_dao import BaseDao
 from dao.metrics_cache_dao import MetricsEnrollmentStatusCacheDao, MetricsGenderCacheDao, \
   MetricsAgeCacheDao, MetricsRaceCacheDao, MetricsRegionCacheDao, MetricsLifecycleCacheDao, \
-  MetricsLanguageCacheDao
+  MetricsLanguageCacheDao, MetricsCacheVersionDao
+from dao.metrics_cache_builder import MetricsCacheBuilder
+from dao.metrics_cache_refresh_scheduler import MetricsCacheRefreshScheduler, RefreshUnit, \
+  format_slowest_units
 
 CACHE_START_DATE = datetime.datetime.strptime('2017-01-01', '%Y-%m-%d').date()
 
@@ -18,38 +25,100 @@ class ParticipantCountsOverTimeService(BaseDao):
     self.test_hpo_id = HPODao().get_by_name(TEST_HPO_NAME).hpoId
     self.test_email_pattern = TEST_EMAIL_PATTERN
 
-  def refresh_metrics_cache_data(self):
-
-    self.refresh_data_for_metrics_cache(MetricsEnrollmentStatusCacheDao())
-    self.refresh_data_for_metrics_cache(MetricsGenderCacheDao())
-    self.refresh_data_for_metrics_cache(MetricsAgeCacheDao(MetricsCacheType.METRICS_V2_API))
-    self.refresh_data_for_metrics_cache(MetricsAgeCacheDao(
-      MetricsCacheType.PUBLIC_METRICS_EXPORT_API))
-    self.refresh_data_for_metrics_cache(MetricsRaceCacheDao())
-    self.refresh_data_for_metrics_cache(MetricsRegionCacheDao())
-    self.refresh_data_for_metrics_cache(MetricsLanguageCacheDao())
-    self.refresh_data_for_metrics_cache(MetricsLifecycleCacheDao())
+  def refresh_metrics_cache_data(self, dry_run=False):
+    """Refreshes all the metrics caches, running their refresh units on a
+    MetricsCacheRefreshScheduler configured with METRICS_CACHE_REFRESH_WORKERS and
+    METRICS_CACHE_REFRESH_CONNECTIONS.
 
-  def refresh_data_for_metrics_cache(self, dao):
+    Returns a UnitResult for each unit. With dry_run, nothing is written, and the slowest units
+    are logged.
+    """
     updated_time = datetime.datetime.now()
-    hpo_dao = HPODao()
-    hpo_list = hpo_dao.get_all()
-    for hpo in hpo_list:
-      self.insert_cache_by_hpo(dao, hpo.hpoId, updated_time)
-
+    daos = [
+      MetricsEnrollmentStatusCacheDao(),
+      MetricsGenderCacheDao(),
+      MetricsAgeCacheDao(MetricsCacheType.METRICS_V2_API),
+      MetricsAgeCacheDao(MetricsCacheType.PUBLIC_METRICS_EXPORT_API),
+      MetricsRaceCacheDao(),
+      MetricsRegionCacheDao(),
+      MetricsLanguageCacheDao(),
+      MetricsLifecycleCacheDao(),
+    ]
+    # All the caches are built from the same scan of the participant data.
+    builder = self.make_cache_builder()
+    units = []
+    for dao in daos:
+      units.extend(self.get_refresh_units(dao, updated_time, builder))
+    scheduler = MetricsCacheRefreshScheduler(
+        config.getSetting(config.METRICS_CACHE_REFRESH_WORKERS, 1),
+        config.getSetting(config.METRICS_CACHE_REFRESH_CONNECTIONS, None))
+    results = scheduler.run(units, dry_run)
+    if dry_run:
+      logging.info('Slowest metrics cache refresh units:\n%s',
+                   '\n'.join(format_slowest_units(results)))
+    else:
+      for dao in daos:
+        self._mark_sql_refresh_complete(dao, updated_time)
+        dao.delete_old_records()
+      MetricsCacheVersionDao().delete_old_records()
+    return results
+
+  def make_cache_builder(self):
+    """Returns a MetricsCacheBuilder reading participants from the backup database."""
+    return MetricsCacheBuilder(HPODao().get_all(), self.test_hpo_id, self.test_email_pattern,
+                               CACHE_START_DATE, self._get_cache_end_date(), self._database)
+
+  def refresh_data_for_metrics_cache(self, dao, builder=None):
+    updated_time = datetime.datetime.now()
+    for unit in self.get_refresh_units(dao, updated_time, builder):
+      unit.run()
+    self._mark_sql_refresh_complete(dao, updated_time)
     dao.delete_old_records()
 
-  def insert_cache_by_hpo(self, dao, hpo_id, updated_time):
+  @staticmethod
+  def _mark_sql_refresh_complete(dao, updated_time):
+    """Records dao's version inserted by all of its refresh units as complete, if they ran its SQL
+    (MetricsCacheBuilder does so itself)."""
+    if config.getSetting(config.METRICS_CACHE_SQL_REFRESH, False):
+      MetricsCacheVersionDao().mark_complete(dao, updated_time)
+
+  def get_refresh_units(self, dao, updated_time, builder=None):
+    """Returns the RefreshUnits inserting dao's cache rows with date_inserted updated_time: one
+    per HPO with METRICS_CACHE_SQL_REFRESH, otherwise one using builder (or a new builder)."""
+    name = dao.model_type.__tablename__
+    if isinstance(dao, MetricsAgeCacheDao):
+      name = '%s %s' % (name, dao.cache_type)
+    if config.getSetting(config.METRICS_CACHE_SQL_REFRESH, False):
+      return [RefreshUnit('%s %s' % (name, hpo.name),
+                          functools.partial(self.insert_cache_by_hpo, dao, hpo.hpoId, updated_time))
+              for hpo in HPODao().get_all()]
+    builder = builder or self.make_cache_builder()
+    if config.getSetting(config.METRICS_CACHE_INCREMENTAL_REFRESH, False):
+      insert = builder.update_cache
+    else:
+      insert = builder.insert_cache
+    return [RefreshUnit(name, functools.partial(insert, dao, updated_time))]
+
+  @staticmethod
+  def _get_cache_end_date():
+    return datetime.datetime.now().date() + datetime.timedelta(days=10)
+
+  def insert_cache_by_hpo(self, dao, hpo_id, updated_time, dry_run=False):
+    """Runs dao's cache SQL for an HPO, returning the number of rows inserted. With dry_run, the
+    insert is rolled back."""
     sql = dao.get_metrics_cache_sql()
     start_date = CACHE_START_DATE
-    end_date = datetime.datetime.now().date() + datetime.timedelta(days=10)
+    end_date = self._get_cache_end_date()
 
     params = {'hpo_id': hpo_id, 'test_hpo_id': self.test_hpo_id,
               'not_withdraw': int(WithdrawalStatus.NOT_WITHDRAWN),
               'test_email_pattern': self.test_email_pattern, 'start_date': start_date,
               'end_date': end_date, 'date_inserted': updated_time}
     with dao.session() as session:
-      session.execute(sql, params)
+      rows = session.execute(sql, params).rowcount
+      if dry_run:
+        session.rollback()
+      return rows
 
   def get_filtered_results(self, stratification, start_date, end_date, history, awardee_ids,
                            enrollment_statuses, sample_time_def):
@@ -1,12 +1,14 @@
+import collections
 import datetime
+import logging
+import operator
 import re
 import threading
+import time
 
 import clock
 import config
-from api_util import format_json_date, format_json_enum, format_json_code, format_json_hpo, \
-  format_json_org, format_json_site
-from code_constants import PPI_SYSTEM, UNSET, BIOBANK_TESTS
+from code_constants import PPI_SYSTEM, UNSET, UNMAPPED, BIOBANK_TESTS
 from dao.base_dao import UpdatableDao
 from dao.code_dao import CodeDao
 from dao.database_utils import get_sql_and_params_for_array, replace_null_safe_equals
@@ -21,7 +23,7 @@ from participant_enums import QuestionnaireStatus, PhysicalMeasurementsStatus, S
   EnrollmentStatus, SuspensionStatus, WithdrawalStatus, get_bucketed_age, EhrStatus, \
   BiobankOrderStatus
 from query import OrderBy, PropertyType
-from sqlalchemy import or_
+from sqlalchemy import inspect, or_
 from werkzeug.exceptions import BadRequest, NotFound
 
 
@@ -157,6 +159,153 @@ def _get_sample_sql_and_params(now):
 
   return sql, params
 
+# Rebuilds the biobank_stored_sample_aggregate staging table, with one row per participant and test.
+_DELETE_SAMPLE_AGGREGATES_SQL = """
+  DELETE FROM biobank_stored_sample_aggregate
+"""
+
+_INSERT_SAMPLE_AGGREGATES_SQL = """
+  INSERT INTO biobank_stored_sample_aggregate
+    (biobank_id, test, min_status, num_confirmed, max_confirmed, max_confirmed_usable,
+     max_disposed)
+  SELECT
+    biobank_id,
+    test,
+    MIN(status),
+    COUNT(confirmed),
+    MAX(confirmed),
+    MAX(CASE WHEN status < :disposed_bad THEN confirmed ELSE NULL END),
+    MAX(disposed)
+  FROM
+    biobank_stored_sample
+  WHERE
+    biobank_id IS NOT NULL
+    %(filter_sql)s
+  GROUP BY
+    biobank_id, test
+"""
+
+# Batch size for update_from_biobank_stored_samples with biobank_ids.
+_SAMPLE_UPDATE_BATCH_SIZE = 1000
+
+_PARTICIPANT_SAMPLE_FILTER_SQL = """
+    AND biobank_id = (SELECT biobank_id FROM participant_summary
+                      WHERE participant_id = :participant_id)
+"""
+
+# Set-based equivalents of _SAMPLE_SQL and _WHERE_SQL, reading a test's aggregates from a join of
+# biobank_stored_sample_aggregate aliased as agg_<test>.
+_SAMPLE_AGGREGATE_JOIN_SQL = """
+    LEFT JOIN biobank_stored_sample_aggregate agg_%(test)s
+      ON agg_%(test)s.biobank_id = ps.biobank_id AND agg_%(test)s.test = %(sample_param_ref)s
+"""
+
+_SAMPLE_AGGREGATE_SET_SQL = """,
+    ps.sample_status_%(test)s =
+      CASE WHEN agg_%(test)s.biobank_id IS NULL THEN :unset
+           WHEN agg_%(test)s.min_status >= :disposed_bad THEN :disposed
+           ELSE :received END,
+    ps.sample_status_%(test)s_time =
+      CASE WHEN agg_%(test)s.biobank_id IS NULL THEN NULL
+           WHEN agg_%(test)s.min_status >= :disposed_bad THEN agg_%(test)s.max_disposed
+           ELSE agg_%(test)s.max_confirmed_usable END
+"""
+
+_SAMPLE_AGGREGATE_WHERE_SQL = """
+    NOT ps.sample_status_%(test)s_time <=> agg_%(test)s.max_confirmed
+"""
+
+_COUNTS_FROM_AGGREGATES_SQL = """
+  UPDATE
+    participant_summary ps
+    LEFT JOIN (
+      SELECT
+        biobank_id,
+        SUM(CASE WHEN test IN {baseline_tests_sql} THEN num_confirmed ELSE 0 END)
+          AS num_baseline_samples,
+        MAX(CASE WHEN test IN {dna_tests_sql} AND num_confirmed > 0 THEN 1 ELSE 0 END)
+          AS has_dna_samples
+      FROM
+        biobank_stored_sample_aggregate
+      GROUP BY
+        biobank_id
+    ) counts ON counts.biobank_id = ps.biobank_id
+  SET
+    ps.num_baseline_samples_arrived = {num_baseline_samples_sql},
+    ps.samples_to_isolate_dna = {samples_to_isolate_dna_sql},
+    ps.last_modified = :now
+  WHERE
+    (ps.num_baseline_samples_arrived != {num_baseline_samples_sql} OR
+     ps.samples_to_isolate_dna != {samples_to_isolate_dna_sql})
+"""
+
+_NUM_BASELINE_SAMPLES_SQL = 'COALESCE(counts.num_baseline_samples, 0)'
+_SAMPLES_TO_ISOLATE_DNA_SQL = \
+  'CASE WHEN counts.has_dna_samples = 1 THEN :received ELSE :unset END'
+
+
+def _get_sample_aggregate_sql_and_params(now):
+  """Gets SQL and params to update status and time fields on the participant summary for each
+  biobank sample from biobank_stored_sample_aggregate, in a single pass over participant_summary.
+  """
+  params = {
+      'received': int(SampleStatus.RECEIVED),
+      'unset': int(SampleStatus.UNSET),
+      'disposed': int(SampleStatus.DISPOSED),
+      # DA-871: use first bad disposed reason code value.
+      'disposed_bad': int(SampleStatus.SAMPLE_NOT_RECEIVED),
+      'now': now
+  }
+  join_sql = ''
+  set_sql = ''
+  where_sqls = []
+  for i, test in enumerate(BIOBANK_TESTS):
+    sample_param = 'sample%d' % i
+    params[sample_param] = test
+    substitutions = {'test': test.lower(), 'sample_param_ref': ':%s' % sample_param}
+    join_sql += _SAMPLE_AGGREGATE_JOIN_SQL % substitutions
+    set_sql += _SAMPLE_AGGREGATE_SET_SQL % substitutions
+    where_sqls.append(_SAMPLE_AGGREGATE_WHERE_SQL % substitutions)
+  sql = """
+  UPDATE
+    participant_summary ps
+    {join_sql}
+  SET
+    ps.last_modified = :now
+    {set_sql}
+  WHERE
+    ({where_sql})
+  """.format(join_sql=join_sql, set_sql=set_sql, where_sql=' OR '.join(where_sqls))
+  return sql, params
+
+
+def _get_counts_from_aggregates_sql_and_params(now):
+  baseline_tests_sql, params = get_sql_and_params_for_array(
+      config.getSettingList(config.BASELINE_SAMPLE_TEST_CODES), 'baseline')
+  dna_tests_sql, dna_params = get_sql_and_params_for_array(
+      config.getSettingList(config.DNA_SAMPLE_TEST_CODES), 'dna')
+  params.update(dna_params)
+  params.update({
+      'received': int(SampleStatus.RECEIVED),
+      'unset': int(SampleStatus.UNSET),
+      'now': now
+  })
+  sql = _COUNTS_FROM_AGGREGATES_SQL.format(baseline_tests_sql=baseline_tests_sql,
+                                           dna_tests_sql=dna_tests_sql,
+                                           num_baseline_samples_sql=_NUM_BASELINE_SAMPLES_SQL,
+                                           samples_to_isolate_dna_sql=_SAMPLES_TO_ISOLATE_DNA_SQL)
+  return sql, params
+
+
+def _execute_timed(session, stage, sql, params, stage_totals):
+  """Executes one stage of a multi-statement update, adding the number of rows it affected and
+  how long it took to stage_totals[stage]."""
+  start_time = time.time()
+  result = session.execute(sql, params)
+  rows, seconds = stage_totals.get(stage, (0, 0.0))
+  stage_totals[stage] = (rows + result.rowcount, seconds + time.time() - start_time)
+
+
 def _get_baseline_sql_and_params():
   tests_sql, params = get_sql_and_params_for_array(
       config.getSettingList(config.BASELINE_SAMPLE_TEST_CODES), 'baseline')
@@ -351,18 +500,80 @@ class ParticipantSummaryDao(UpdatableDao):
       return super(ParticipantSummaryDao, self).make_query_filter(field_name + 'Id', code.codeId)
     return super(ParticipantSummaryDao, self).make_query_filter(field_name, value)
 
-  def update_from_biobank_stored_samples(self, participant_id=None):
+  def update_from_biobank_stored_samples(self, participant_id=None, biobank_ids=None):
     """Rewrites sample-related summary data. Call this after updating BiobankStoredSamples.
-    If participant_id is provided, only that participant will have their summary updated."""
+    If participant_id is provided, only that participant will have their summary updated.
+    If biobank_ids is provided, only participants with those biobank IDs will, in transactions of
+    _SAMPLE_UPDATE_BATCH_SIZE participants each.
+
+    Samples are first aggregated per participant and test into biobank_stored_sample_aggregate,
+    which the summary updates then join on; the time taken by each stage is logged."""
+    now = clock.CLOCK.now()
+    stage_totals = collections.OrderedDict()
+    if biobank_ids is not None:
+      biobank_ids = sorted(biobank_ids)
+      for start in range(0, len(biobank_ids), _SAMPLE_UPDATE_BATCH_SIZE):
+        biobank_ids_sql, filter_params = get_sql_and_params_for_array(
+            biobank_ids[start:start + _SAMPLE_UPDATE_BATCH_SIZE], 'biobank_id')
+        self._update_from_biobank_stored_samples(
+            now, 'AND biobank_id IN %s' % biobank_ids_sql,
+            '{alias}biobank_id IN %s' % biobank_ids_sql, filter_params, stage_totals)
+    elif participant_id:
+      self._update_from_biobank_stored_samples(
+          now, _PARTICIPANT_SAMPLE_FILTER_SQL, '{alias}participant_id = :participant_id',
+          {'participant_id': participant_id}, stage_totals)
+    else:
+      self._update_from_biobank_stored_samples(now, '', None, {}, stage_totals)
+    for stage, (rows, seconds) in stage_totals.iteritems():
+      logging.info('%s: %d rows in %.2f s.', stage, rows, seconds)
+
+  def _update_from_biobank_stored_samples(self, now, aggregate_filter_sql, summary_filter_sql,
+                                          filter_params, stage_totals):
+    """Updates the summaries matching summary_filter_sql (a condition on participant_summary, with
+    an {alias} for its table alias) from the samples matching aggregate_filter_sql, in one
+    transaction. Adds the rows affected and time taken by each stage to stage_totals."""
+    aggregate_sql = _INSERT_SAMPLE_AGGREGATES_SQL % {'filter_sql': aggregate_filter_sql}
+    aggregate_params = {'disposed_bad': int(SampleStatus.SAMPLE_NOT_RECEIVED)}
+    sample_sql, sample_params = _get_sample_aggregate_sql_and_params(now)
+    counts_sql, counts_params = _get_counts_from_aggregates_sql_and_params(now)
+    enrollment_status_sql = _ENROLLMENT_STATUS_SQL
+    enrollment_status_params = self._get_enrollment_status_params(now)
+    sample_status_time_sql = _get_sample_status_time_sql_and_params()
+    sample_status_time_params = {}
+
+    # Add the filter to all update statements.
+    if summary_filter_sql:
+      sample_sql += ' AND ' + summary_filter_sql.format(alias='ps.')
+      counts_sql += ' AND ' + summary_filter_sql.format(alias='ps.')
+      enrollment_status_sql += ' AND ' + summary_filter_sql.format(alias='')
+      sample_status_time_sql += ' AND ' + summary_filter_sql.format(alias='a.')
+    for params in (aggregate_params, sample_params, counts_params, enrollment_status_params,
+                   sample_status_time_params):
+      params.update(filter_params)
+    sample_sql = replace_null_safe_equals(sample_sql)
+
+    with self.session() as session:
+      for stage, sql, params in (
+          ('Cleared sample aggregates', _DELETE_SAMPLE_AGGREGATES_SQL, {}),
+          ('Aggregated samples', aggregate_sql, aggregate_params),
+          ('Updated sample statuses', sample_sql, sample_params),
+          ('Updated sample counts', counts_sql, counts_params),
+          ('Updated enrollment statuses', enrollment_status_sql, enrollment_status_params),
+          # TODO: Change this to the optimized sql in _update_dv_stored_samples()
+          ('Updated core stored sample times', sample_status_time_sql,
+           sample_status_time_params)):
+        _execute_timed(session, stage, sql, params, stage_totals)
+
+  def _update_from_biobank_stored_samples_by_subquery(self):
+    """Does what update_from_biobank_stored_samples does (for all participants) with correlated
+    subqueries against biobank_stored_sample for each test, as it used to. Kept to check the
+    results of the set-based update against in tests."""
     now = clock.CLOCK.now()
     sample_sql, sample_params = _get_sample_sql_and_params(now)
 
     baseline_tests_sql, baseline_tests_params = _get_baseline_sql_and_params()
     dna_tests_sql, dna_tests_params = _get_dna_isolates_sql_and_params()
 
-    sample_status_time_sql = _get_sample_status_time_sql_and_params()
-    sample_status_time_params = {}
-
     counts_sql = """
     UPDATE
       participant_summary
@@ -380,38 +591,22 @@ class ParticipantSummaryDao(UpdatableDao):
     counts_params.update(baseline_tests_params)
     counts_params.update(dna_tests_params)
 
-    enrollment_status_sql = _ENROLLMENT_STATUS_SQL
-    enrollment_status_params = {'submitted': int(QuestionnaireStatus.SUBMITTED),
-                                'unset': int(QuestionnaireStatus.UNSET),
-                                'num_baseline_ppi_modules': self._get_num_baseline_ppi_modules(),
-                                'completed': int(PhysicalMeasurementsStatus.COMPLETED),
-                                'received': int(SampleStatus.RECEIVED),
-                                'full_participant': int(EnrollmentStatus.FULL_PARTICIPANT),
-                                'member': int(EnrollmentStatus.MEMBER),
-                                'interested': int(EnrollmentStatus.INTERESTED),
-                                'now': now}
-
-    # If participant_id is provided, add the participant ID filter to all update statements.
-    if participant_id:
-      sample_sql += ' AND participant_id = :participant_id'
-      sample_params['participant_id'] = participant_id
-      counts_sql += ' AND participant_id = :participant_id'
-      counts_params['participant_id'] = participant_id
-      enrollment_status_sql += ' AND participant_id = :participant_id'
-      enrollment_status_params['participant_id'] = participant_id
-      sample_status_time_sql += ' AND a.participant_id = :participant_id'
-      sample_status_time_params['participant_id'] = participant_id
-
-    sample_sql = replace_null_safe_equals(sample_sql)
-    counts_sql = replace_null_safe_equals(counts_sql)
-
-
     with self.session() as session:
-      session.execute(sample_sql, sample_params)
-      session.execute(counts_sql, counts_params)
-      session.execute(enrollment_status_sql, enrollment_status_params)
-      # TODO: Change this to the optimized sql in _update_dv_stored_samples()
-      session.execute(sample_status_time_sql, sample_status_time_params)
+      session.execute(replace_null_safe_equals(sample_sql), sample_params)
+      session.execute(replace_null_safe_equals(counts_sql), counts_params)
+      session.execute(_ENROLLMENT_STATUS_SQL, self._get_enrollment_status_params(now))
+      session.execute(_get_sample_status_time_sql_and_params(), {})
+
+  def _get_enrollment_status_params(self, now):
+    return {'submitted': int(QuestionnaireStatus.SUBMITTED),
+            'unset': int(QuestionnaireStatus.UNSET),
+            'num_baseline_ppi_modules': self._get_num_baseline_ppi_modules(),
+            'completed': int(PhysicalMeasurementsStatus.COMPLETED),
+            'received': int(SampleStatus.RECEIVED),
+            'full_participant': int(EnrollmentStatus.FULL_PARTICIPANT),
+            'member': int(EnrollmentStatus.MEMBER),
+            'interested': int(EnrollmentStatus.INTERESTED),
+            'now': now}
 
   def _get_num_baseline_ppi_modules(self):
     return len(config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
@@ -560,55 +755,35 @@ class ParticipantSummaryDao(UpdatableDao):
     return is_distinct_visit
 
   def to_client_json(self, model):
-    result = model.asdict()
-    # Participants that withdrew more than 48 hours ago should have fields other than
-    # WITHDRAWN_PARTICIPANT_FIELDS cleared.
-    if (model.withdrawalStatus == WithdrawalStatus.NO_USE and
-        (model.withdrawalTime is None or
-         model.withdrawalTime < clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME)):
-      result = {k: result.get(k) for k in WITHDRAWN_PARTICIPANT_FIELDS}
-
-    elif model.withdrawalStatus != WithdrawalStatus.NO_USE and \
-      model.suspensionStatus == SuspensionStatus.NO_CONTACT:
-      for i in SUSPENDED_PARTICIPANT_FIELDS:
-        result[i] = UNSET
-
-    result['participantId'] = to_client_participant_id(model.participantId)
-    biobank_id = result.get('biobankId')
-    if biobank_id:
-      result['biobankId'] = to_client_biobank_id(biobank_id)
-    date_of_birth = result.get('dateOfBirth')
-    if date_of_birth:
-      result['ageRange'] = get_bucketed_age(date_of_birth, clock.CLOCK.now())
-    else:
-      result['ageRange'] = UNSET
-
-    if result.get('primaryLanguage') is None:
-      result['primaryLanguage'] = UNSET
-
-    if 'organizationId' in result:
-      result['organization'] = result['organizationId']
-      del result['organizationId']
-      format_json_org(result, self.organization_dao, 'organization')
+    return self.to_client_json_list([model])[0]
 
-    format_json_hpo(result, self.hpo_dao, 'hpoId')
-    result['awardee'] = result['hpoId']
-    _initialize_field_type_sets()
-    for fieldname in _DATE_FIELDS:
-      format_json_date(result, fieldname)
-    for fieldname in _CODE_FIELDS:
-      format_json_code(result, self.code_dao, fieldname)
-    for fieldname in _ENUM_FIELDS:
-      format_json_enum(result, fieldname)
-    for fieldname in _SITE_FIELDS:
-      format_json_site(result, self.site_dao, fieldname)
-    if (model.withdrawalStatus == WithdrawalStatus.NO_USE or
-        model.suspensionStatus == SuspensionStatus.NO_CONTACT):
-      result['recontactMethod'] = 'NO_CONTACT'
-    # Strip None values.
-    result = {k: v for k, v in result.iteritems() if v is not None}
+  def to_client_json_list(self, models):
+    """Converts a page of participant summaries to client JSON in a single pass.
 
-    return result
+    Uses field plans built once from the mapper (see _ClientJsonPlan), and shares code, site, HPO
+    and organization lookups between the rows.
+    """
+    full_plan, withdrawn_plan = _get_client_json_plans()
+    lookups = _ClientJsonLookups(self)
+    now = clock.CLOCK.now()
+    withdrawn_cutoff = now - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME
+    results = []
+    for model in models:
+      no_contact = model.suspensionStatus == SuspensionStatus.NO_CONTACT
+      if model.withdrawalStatus == WithdrawalStatus.NO_USE:
+        # Participants that withdrew more than 48 hours ago should have fields other than
+        # WITHDRAWN_PARTICIPANT_FIELDS cleared.
+        if model.withdrawalTime is None or model.withdrawalTime < withdrawn_cutoff:
+          result = withdrawn_plan.to_client_json(model, lookups, now, False)
+        else:
+          result = full_plan.to_client_json(model, lookups, now, False)
+        result['recontactMethod'] = 'NO_CONTACT'
+      else:
+        result = full_plan.to_client_json(model, lookups, now, no_contact)
+        if no_contact:
+          result['recontactMethod'] = 'NO_CONTACT'
+      results.append(result)
+    return results
 
   def _decode_token(self, query_def, fields):
     """ If token exists in participant_summary api, decode and use lastModified to add a buffer
@@ -662,3 +837,168 @@ def _initialize_field_type_sets():
               if fk._get_colspec() == 'code.code_id':
                 _CODE_FIELDS.add(prop_name)
                 break
+
+
+# Names of ParticipantSummary fields that to_client_json converts specially, rather than by type.
+_SPECIAL_CLIENT_JSON_FIELDS = frozenset(['participantId', 'biobankId', 'organizationId', 'hpoId'])
+_client_json_plans = []
+
+
+def _get_client_json_plans():
+  """Returns (full plan, plan for participants withdrawn more than 48 hours ago), building them
+  on first use for the same reason as _initialize_field_type_sets."""
+  if not _client_json_plans:
+    with _fields_lock:
+      if not _client_json_plans:
+        exclude = set(getattr(ParticipantSummary, 'dictalchemy_exclude', None) or [])
+        field_names = [attr.key for attr in inspect(ParticipantSummary).column_attrs
+                       if attr.key not in exclude and not attr.key.startswith('_')]
+        _client_json_plans.extend([_ClientJsonPlan(field_names),
+                                   _ClientJsonPlan(WITHDRAWN_PARTICIPANT_FIELDS)])
+  return _client_json_plans
+
+
+class _ClientJsonPlan(object):
+  """Precomputed steps for converting the given ParticipantSummary fields to client JSON.
+
+  Fields are grouped by how they are formatted, with their positions in the tuple read by a
+  single attrgetter, so that each row is converted with a few tight loops instead of dict
+  operations and type checks per field.
+  """
+
+  def __init__(self, field_names):
+    _initialize_field_type_sets()
+    self.get_values = operator.attrgetter(*field_names)
+    # Reads loaded values straight from the instance dict, skipping SQLAlchemy's descriptors.
+    self.get_loaded_values = operator.itemgetter(*field_names)
+    site_id_fields = {site_field + 'Id': site_field for site_field in _SITE_FIELDS}
+    index = {field_name: i for i, field_name in enumerate(field_names)}
+    self.participant_id_index = index['participantId']
+    self.biobank_id_index = index.get('biobankId')
+    self.organization_id_index = index.get('organizationId')
+    self.hpo_id_index = index.get('hpoId')
+    self.date_of_birth_index = index.get('dateOfBirth')
+    self.plain_fields = []
+    self.date_fields = []
+    self.enum_fields = []
+    self.code_fields = []
+    self.site_fields = []
+    for i, field_name in enumerate(field_names):
+      if field_name in _SPECIAL_CLIENT_JSON_FIELDS:
+        continue
+      elif field_name in _DATE_FIELDS:
+        self.date_fields.append((i, field_name))
+      elif field_name in _ENUM_FIELDS:
+        self.enum_fields.append((i, field_name))
+      elif field_name in _CODE_FIELDS:
+        self.code_fields.append((i, field_name, field_name[:-2]))
+      elif field_name in site_id_fields:
+        self.site_fields.append((i, site_id_fields[field_name]))
+      else:
+        self.plain_fields.append((i, field_name))
+    # Enum, code and site fields that aren't in field_names are still returned, as UNSET.
+    self.unset_fields = ([field_name for field_name in _ENUM_FIELDS if field_name not in index] +
+                         [field_name[:-2] for field_name in _CODE_FIELDS
+                          if field_name not in index] +
+                         [field_name for field_name in _SITE_FIELDS
+                          if field_name + 'Id' not in index])
+
+  def to_client_json(self, model, lookups, now, suspended):
+    try:
+      values = self.get_loaded_values(model.__dict__)
+    except KeyError:
+      # Some fields are unloaded or were never set; let the descriptors handle them.
+      values = self.get_values(model)
+    result = dict.fromkeys(self.unset_fields, UNSET)
+    for i, field_name in self.plain_fields:
+      value = values[i]
+      if value is not None:
+        result[field_name] = value
+    if suspended:
+      for field_name in SUSPENDED_PARTICIPANT_FIELDS:
+        result[field_name] = UNSET
+    if result.get('primaryLanguage') is None:
+      result['primaryLanguage'] = UNSET
+    for i, field_name in self.date_fields:
+      value = values[i]
+      if value is not None:
+        result[field_name] = value.isoformat()
+    for i, field_name in self.enum_fields:
+      value = values[i]
+      result[field_name] = UNSET if value is None else str(value)
+    for i, id_field_name, field_name in self.code_fields:
+      value = values[i]
+      if value:
+        result[field_name] = lookups.get_code_value(value)
+      else:
+        result[field_name] = UNSET
+        if value is not None:
+          result[id_field_name] = value
+    for i, field_name in self.site_fields:
+      value = values[i]
+      result[field_name] = UNSET if value is None else lookups.get_site_google_group(value)
+
+    result['participantId'] = to_client_participant_id(values[self.participant_id_index])
+    if self.biobank_id_index is not None:
+      biobank_id = values[self.biobank_id_index]
+      if biobank_id:
+        result['biobankId'] = to_client_biobank_id(biobank_id)
+      elif biobank_id is not None:
+        result['biobankId'] = biobank_id
+    date_of_birth = (values[self.date_of_birth_index]
+                     if self.date_of_birth_index is not None else None)
+    result['ageRange'] = lookups.get_age_range(date_of_birth, now) if date_of_birth else UNSET
+    if self.organization_id_index is not None:
+      organization_id = values[self.organization_id_index]
+      result['organization'] = (lookups.get_organization_external_id(organization_id)
+                                if organization_id else UNSET)
+    hpo_id = values[self.hpo_id_index] if self.hpo_id_index is not None else None
+    result['hpoId'] = result['awardee'] = lookups.get_hpo_name(hpo_id) if hpo_id else UNSET
+    return result
+
+
+class _ClientJsonLookups(object):
+  """Remembers the client values of the codes, sites, HPOs and organizations referenced by a page
+  of participant summaries, so each is only fetched from its DAO's cache once per page; likewise
+  the age range for each date of birth."""
+
+  def __init__(self, dao):
+    self._dao = dao
+    self._age_ranges = {}
+    self._code_values = {}
+    self._site_google_groups = {}
+    self._hpo_names = {}
+    self._organization_external_ids = {}
+
+  def get_age_range(self, date_of_birth, now):
+    age_range = self._age_ranges.get(date_of_birth)
+    if age_range is None:
+      age_range = self._age_ranges[date_of_birth] = get_bucketed_age(date_of_birth, now)
+    return age_range
+
+  def get_code_value(self, code_id):
+    value = self._code_values.get(code_id)
+    if value is None:
+      code = self._dao.code_dao.get(code_id)
+      value = self._code_values[code_id] = code.value if code.mapped else UNMAPPED
+    return value
+
+  def get_site_google_group(self, site_id):
+    google_group = self._site_google_groups.get(site_id)
+    if google_group is None:
+      google_group = self._dao.site_dao.get(site_id).googleGroup
+      self._site_google_groups[site_id] = google_group
+    return google_group
+
+  def get_hpo_name(self, hpo_id):
+    name = self._hpo_names.get(hpo_id)
+    if name is None:
+      name = self._hpo_names[hpo_id] = self._dao.hpo_dao.get(hpo_id).name
+    return name
+
+  def get_organization_external_id(self, organization_id):
+    external_id = self._organization_external_ids.get(organization_id)
+    if external_id is None:
+      external_id = self._dao.organization_dao.get(organization_id).externalId
+      self._organization_external_ids[organization_id] = external_id
+    return external_id
@@ -1,5 +1,7 @@
 import clock
+import collections
 import json
+import threading
 
 import fhirclient.models.questionnaire
 from sqlalchemy.orm import subqueryload
@@ -11,6 +13,108 @@ from model.code import CodeType
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireConcept
 from model.questionnaire import QuestionnaireQuestion
 
+# Most questionnaire versions whose structure is kept by QuestionnaireHistoryDao.get_structure.
+STRUCTURE_CACHE_MAX_SIZE = 256
+
+StructureQuestion = collections.namedtuple('StructureQuestion',
+                                           ['questionnaireQuestionId', 'linkId', 'codeId'])
+StructureConcept = collections.namedtuple('StructureConcept', ['codeId'])
+
+
+class QuestionnaireStructure(object):
+  """The questions and concepts of a version of a questionnaire, as needed to validate and apply
+  responses to it. Versions of questionnaires don't change, so structures are shared (and must not
+  be modified, other than to fill in answer_dispatch) by their users.
+  """
+
+  def __init__(self, history):
+    self.questionnaireId = history.questionnaireId
+    self.version = history.version
+    self.questions_by_id = {
+        question.questionnaireQuestionId: StructureQuestion(question.questionnaireQuestionId,
+                                                            question.linkId, question.codeId)
+        for question in history.questions}
+    self.concepts = tuple(StructureConcept(concept.codeId) for concept in history.concepts)
+    # {question ID: handler} for answers that update participant summaries, compiled by
+    # QuestionnaireResponseDao the first time a response to this version is inserted.
+    self.answer_dispatch = None
+
+  def get_questions(self, question_ids):
+    """Returns the questions with the given IDs (each once), ignoring IDs not in the questionnaire.
+    """
+    return [self.questions_by_id[question_id] for question_id in sorted(set(question_ids))
+            if question_id in self.questions_by_id]
+
+
+class _StructureCache(object):
+  """An LRU cache of QuestionnaireStructures by questionnaire ID and version.
+
+  QuestionnaireDao drops the cached versions of a questionnaire when it is inserted or updated, so
+  that a version looked up before it was written (or rewritten, as in tests) isn't kept.
+  """
+
+  def __init__(self, max_size=STRUCTURE_CACHE_MAX_SIZE):
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    # (questionnaire ID, version) -> QuestionnaireStructure
+    self._structures = collections.OrderedDict()
+    # Incremented by invalidate(), so that loads which started before an invalidation aren't stored.
+    self._generation = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, questionnaire_id, version, load):
+    """Returns the structure for a questionnaire version, calling load() to get its history (or
+    None if there is none) if it isn't cached."""
+    key = (questionnaire_id, version)
+    with self._lock:
+      structure = self._structures.get(key)
+      if structure is not None:
+        del self._structures[key]
+        self._structures[key] = structure
+        self.hits += 1
+        return structure
+      self.misses += 1
+      generation = self._generation
+    history = load()
+    if history is None:
+      return None
+    structure = QuestionnaireStructure(history)
+    with self._lock:
+      if generation == self._generation:
+        self._structures[key] = structure
+        while len(self._structures) > self.max_size:
+          self._structures.popitem(last=False)
+    return structure
+
+  def invalidate(self, questionnaire_id):
+    with self._lock:
+      self._generation += 1
+      for key in [key for key in self._structures if key[0] == questionnaire_id]:
+        del self._structures[key]
+
+  def get_stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._structures)}
+
+  def clear(self):
+    with self._lock:
+      self._structures.clear()
+      self._generation += 1
+      self.hits = self.misses = 0
+
+
+_structure_cache = _StructureCache()
+
+
+def get_structure_cache_stats():
+  """Returns hit and miss counts and the number of entries of the questionnaire structure cache."""
+  return _structure_cache.get_stats()
+
+
+def reset_structure_cache_for_tests():
+  _structure_cache.clear()
+
 
 class QuestionnaireDao(UpdatableDao):
 
@@ -80,6 +184,7 @@ class QuestionnaireDao(UpdatableDao):
     history = self._make_history(questionnaire, concepts, questions)
     history.questionnaireId = questionnaire.questionnaireId
     QuestionnaireHistoryDao().insert_with_session(session, history)
+    _structure_cache.invalidate(questionnaire.questionnaireId)
     return questionnaire
 
   def _do_update(self, session, obj, existing_obj):
@@ -99,6 +204,7 @@ class QuestionnaireDao(UpdatableDao):
                                                   self._make_history(questionnaire,
                                                                      questionnaire.concepts,
                                                                      questionnaire.questions))
+    _structure_cache.invalidate(questionnaire.questionnaireId)
 
   @classmethod
   def from_client_json(cls,
@@ -219,6 +325,14 @@ class QuestionnaireHistoryDao(BaseDao):
     with self.session() as session:
       return self.get_with_children_with_session(session, questionnaireIdAndVersion)
 
+  def get_structure_with_session(self, session, questionnaireIdAndVersion):
+    """Returns the (cached) QuestionnaireStructure of a questionnaire version, or None if there
+    is no such version."""
+    questionnaire_id, version = questionnaireIdAndVersion
+    return _structure_cache.get(
+        questionnaire_id, version,
+        lambda: self.get_with_children_with_session(session, questionnaireIdAndVersion))
+
 
 class QuestionnaireConceptDao(BaseDao):
 
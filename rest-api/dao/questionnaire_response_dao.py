@@ -1,5 +1,6 @@
 import clock
 import config
+import functools
 import json
 import logging
 import pytz
@@ -8,8 +9,9 @@ import os
 from datetime import datetime
 from cloudstorage import cloudstorage_api
 import fhirclient.models.questionnaireresponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import subqueryload
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, HTTPException, ServiceUnavailable
 
 from code_constants import PPI_SYSTEM, RACE_QUESTION_CODE, CONSENT_FOR_STUDY_ENROLLMENT_MODULE, \
   DVEHR_SHARING_QUESTION_CODE, CONSENT_FOR_DVEHR_MODULE, DVEHRSHARING_CONSENT_CODE_NOT_SURE, \
@@ -18,11 +20,12 @@ from code_constants import EHR_CONSENT_QUESTION_CODE, CONSENT_PERMISSION_YES_COD
 from code_constants import CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_MODULE, PPI_EXTRA_SYSTEM
 from code_constants import CABOR_SIGNATURE_QUESTION_CODE, DVEHRSHARING_CONSENT_CODE_YES
 from config_api import is_config_admin
-from dao.base_dao import BaseDao
+from dao.base_dao import BaseDao, MAX_INSERT_ATTEMPTS
 from dao.code_dao import CodeDao
+from dao.id_reservation import reserve_id, record_collisions
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
-from dao.questionnaire_dao import QuestionnaireHistoryDao, QuestionnaireQuestionDao
+from dao.questionnaire_dao import QuestionnaireHistoryDao
 from field_mappings import FieldType, QUESTION_CODE_TO_FIELD, QUESTIONNAIRE_MODULE_CODE_TO_FIELD
 from model.code import CodeType
 from model.questionnaire import QuestionnaireQuestion
@@ -52,6 +55,110 @@ def count_completed_ppi_modules(participant_summary):
              if getattr(participant_summary, field) == QuestionnaireStatus.SUBMITTED)
 
 
+class _AnswerSummaryState(object):
+  """Changes to a participant summary gathered from the answers in a questionnaire response.
+
+  Each answer that affects the summary is passed to one of the handler methods below, chosen by
+  the code of its question (see _QUESTION_CODE_HANDLERS). value_codes holds the codes for the
+  answers' valueCodeIds, looked up once for the whole response.
+  """
+
+  def __init__(self, participant_summary, created, authored, value_codes, something_changed):
+    self.participant_summary = participant_summary
+    self.created = created
+    self.authored = authored
+    self.value_codes = value_codes
+    self.something_changed = something_changed
+    self.race_codes = []
+    self.ehr_consent = False
+    self.dvehr_consent = QuestionnaireStatus.SUBMITTED_NO_CONSENT
+
+  def update_field(self, answer, field_name, field_type):
+    if field_type == FieldType.CODE:
+      new_value = answer.valueCodeId
+    elif field_type == FieldType.STRING:
+      new_value = answer.valueString
+    elif field_type == FieldType.DATE:
+      new_value = answer.valueDate
+    else:
+      raise BadRequest("Don't know how to map field of type %s" % field_type)
+    if new_value is not None and getattr(self.participant_summary, field_name) != new_value:
+      setattr(self.participant_summary, field_name, new_value)
+      self.something_changed = True
+
+  def add_race(self, answer):
+    self.race_codes.append(self.value_codes.get(answer.valueCodeId))
+
+  def set_dvehr_consent(self, answer):
+    code = self.value_codes.get(answer.valueCodeId)
+    if code and code.value == DVEHRSHARING_CONSENT_CODE_YES:
+      self.dvehr_consent = QuestionnaireStatus.SUBMITTED
+    elif code and code.value == DVEHRSHARING_CONSENT_CODE_NOT_SURE:
+      self.dvehr_consent = QuestionnaireStatus.SUBMITTED_NOT_SURE
+
+  def set_ehr_consent(self, answer):
+    code = self.value_codes.get(answer.valueCodeId)
+    if code and code.value == CONSENT_PERMISSION_YES_CODE:
+      self.ehr_consent = True
+
+  def set_cabor_signature(self, answer):
+    if answer.valueUri or answer.valueString:
+      # TODO: validate the URI? [DA-326]
+      if not self.participant_summary.consentForCABoR:
+        self.participant_summary.consentForCABoR = True
+        self.participant_summary.consentForCABoRTime = self.created
+        self.participant_summary.consentForCABoRAuthored = self.authored
+        self.something_changed = True
+
+
+# _AnswerSummaryState handlers for answers to questions, by the value of the questions' PPI codes.
+# Questions mapped to summary fields in QUESTION_CODE_TO_FIELD take precedence.
+_QUESTION_CODE_HANDLERS = {
+  RACE_QUESTION_CODE: _AnswerSummaryState.add_race,
+  DVEHR_SHARING_QUESTION_CODE: _AnswerSummaryState.set_dvehr_consent,
+  EHR_CONSENT_QUESTION_CODE: _AnswerSummaryState.set_ehr_consent,
+  CABOR_SIGNATURE_QUESTION_CODE: _AnswerSummaryState.set_cabor_signature,
+}
+_QUESTION_CODE_HANDLERS.update(
+    (code_value, functools.partial(_AnswerSummaryState.update_field, field_name=field_name,
+                                   field_type=field_type))
+    for code_value, (field_name, field_type) in QUESTION_CODE_TO_FIELD.iteritems())
+
+
+def _get_answer_dispatch(questionnaire_structure, code_dao):
+  """Returns {question ID: handler} for the questions in a questionnaire version whose answers
+  update participant summaries, compiling it the first time it's needed.
+
+  It isn't kept if any question's code is missing from the code cache (e.g. a code added on another
+  server that this one's cache hasn't picked up yet), so it's compiled again next time.
+  """
+  answer_dispatch = questionnaire_structure.answer_dispatch
+  if answer_dispatch is None:
+    questions = questionnaire_structure.questions_by_id.values()
+    codes = code_dao.get_with_ids([question.codeId for question in questions])
+    answer_dispatch = {}
+    for question, code in zip(questions, codes):
+      if code and code.system == PPI_SYSTEM:
+        handler = _QUESTION_CODE_HANDLERS.get(code.value)
+        if handler:
+          answer_dispatch[question.questionnaireQuestionId] = handler
+    if all(codes):
+      # Compiling it again in another thread is harmless; the result is the same.
+      questionnaire_structure.answer_dispatch = answer_dispatch
+  return answer_dispatch
+
+
+class _ParticipantSummaryUpdate(object):
+  """A participant locked for update in a session, and the changes to its summary made by the
+  questionnaire responses inserted for it in that session so far."""
+
+  def __init__(self, participant):
+    self.participant = participant
+    self.participant_summary = participant.participantSummary
+    self.something_changed = False
+    self.module_changed = False
+
+
 class QuestionnaireResponseDao(BaseDao):
 
   def __init__(self):
@@ -113,24 +220,29 @@ class QuestionnaireResponseDao(BaseDao):
           logging.error('Questionnaire response contains invalid link ID %s.' % section['linkId'])
 
 
-  def insert_with_session(self, session, questionnaire_response):
+  def insert_with_session(self, session, questionnaire_response, summary_update=None):
+    """Inserts a questionnaire response and updates its participant's summary.
 
-    # Look for a questionnaire that matches any of the questionnaire history records.
-    questionnaire_history = (
+    If summary_update is given (see insert_for_participant), the participant has already been
+    locked in this session, and its summary is saved by the caller once all of its responses have
+    been inserted.
+    """
+
+    # Look for a questionnaire that matches any of the questionnaire history records. Its
+    # structure is cached, as versions of questionnaires don't change.
+    questionnaire_structure = (
         QuestionnaireHistoryDao().
-        get_with_children_with_session(session, [questionnaire_response.questionnaireId,
-                                                 questionnaire_response.questionnaireVersion]))
+        get_structure_with_session(session, [questionnaire_response.questionnaireId,
+                                             questionnaire_response.questionnaireVersion]))
 
-    if not questionnaire_history:
+    if not questionnaire_structure:
       raise BadRequest('Questionnaire with ID %s, version %s is not found' %
                        (questionnaire_response.questionnaireId,
                         questionnaire_response.questionnaireVersion))
 
-    # Get the questions from the questionnaire history record.
-    q_question_ids = set([
-        question.questionnaireQuestionId for question in questionnaire_history.questions])
+    # Check that the answers are to questions in the questionnaire.
     for answer in questionnaire_response.answers:
-      if answer.questionId not in q_question_ids:
+      if answer.questionId not in questionnaire_structure.questions_by_id:
         raise BadRequest('Questionnaire response contains question ID %s not in questionnaire.' %
                          answer.questionId)
 
@@ -145,7 +257,7 @@ class QuestionnaireResponseDao(BaseDao):
 
     # Gather the question ids and records that match the questions in the response
     question_ids = [answer.questionId for answer in questionnaire_response.answers]
-    questions = QuestionnaireQuestionDao().get_all_with_session(session, question_ids)
+    questions = questionnaire_structure.get_questions(question_ids)
 
     # DA-623: raise error when response link ids do not match our question link ids.
     # Gather the valid link ids for this question
@@ -154,8 +266,9 @@ class QuestionnaireResponseDao(BaseDao):
     self._validate_link_ids_from_resource_json_group(resource_json, link_ids)
 
     code_ids = [question.codeId for question in questions]
-    current_answers = (QuestionnaireResponseAnswerDao().
-        get_current_answers_for_concepts(session, questionnaire_response.participantId, code_ids))
+    # _update_participant_summary adds the questionnaire's concepts to code_ids; only answers to the
+    # questions in the response are superseded by it.
+    question_code_ids = list(code_ids)
 
     # IMPORTANT: update the participant summary first to grab an exclusive lock on the participant
     # row. If you insetad do this after the insert of the questionnaire response, MySQL will get a
@@ -163,53 +276,47 @@ class QuestionnaireResponseDao(BaseDao):
     # to get the exclusive lock if another thread is updating the participant. See DA-269.
     # (We need to lock both participant and participant summary because the summary row may not
     # exist yet.)
+    save_summary = summary_update is None
+    if save_summary:
+      summary_update = self._lock_participant(session, questionnaire_response.participantId)
+    elif summary_update.participant.participantId != questionnaire_response.participantId:
+      raise BadRequest('Questionnaire response is not for participant %d.' %
+                       summary_update.participant.participantId)
     self._update_participant_summary(
-        session, questionnaire_response, code_ids, questions, questionnaire_history, resource_json)
+        summary_update, questionnaire_response, code_ids, questionnaire_structure, resource_json)
+    if save_summary:
+      self._save_participant_summary(session, summary_update)
 
     super(QuestionnaireResponseDao, self).insert_with_session(session, questionnaire_response)
     # Mark existing answers for the questions in this response given previously by this participant
-    # as ended.
-    for answer in current_answers:
-      answer.endTime = questionnaire_response.created
-      session.merge(answer)
+    # as ended. This happens after the participant is locked above, in a single UPDATE.
+    QuestionnaireResponseAnswerDao().end_current_answers_for_concepts(
+        session, questionnaire_response.participantId, question_code_ids,
+        questionnaire_response.created,
+        exclude_response_id=questionnaire_response.questionnaireResponseId)
 
     return questionnaire_response
 
-  def _get_field_value(self, field_type, answer):
-    if field_type == FieldType.CODE:
-      return answer.valueCodeId
-    if field_type == FieldType.STRING:
-      return answer.valueString
-    if field_type == FieldType.DATE:
-      return answer.valueDate
-    raise BadRequest("Don't know how to map field of type %s" % field_type)
-
-  def _update_field(self, participant_summary, field_name, field_type, answer):
-    value = getattr(participant_summary, field_name)
-    new_value = self._get_field_value(field_type, answer)
-    if new_value is not None and value != new_value:
-      setattr(participant_summary, field_name, new_value)
-      return True
-    return False
+  def _lock_participant(self, session, participant_id):
+    """Locks a participant (and its summary) for update, returning a _ParticipantSummaryUpdate."""
+    # Block on other threads modifying the participant or participant summary.
+    participant = ParticipantDao().get_for_update(session, participant_id)
+
+    if participant is None:
+      raise BadRequest('Participant with ID %d is not found.' % participant_id)
+    return _ParticipantSummaryUpdate(participant)
 
   def _update_participant_summary(
-      self, session, questionnaire_response, code_ids, questions, questionnaire_history,
+      self, summary_update, questionnaire_response, code_ids, questionnaire_structure,
       resource_json):
     """Updates the participant summary based on questions answered and modules completed
-    in the questionnaire response.
+    in the questionnaire response. The summary is saved by _save_participant_summary.
 
     If no participant summary exists already, only a response to the study enrollment consent
     questionnaire can be submitted, and it must include first and last name and e-mail address.
     """
-
-    # Block on other threads modifying the participant or participant summary.
-    participant = ParticipantDao().get_for_update(session, questionnaire_response.participantId)
-
-    if participant is None:
-      raise BadRequest('Participant with ID %d is not found.' %
-                        questionnaire_response.participantId)
-
-    participant_summary = participant.participantSummary
+    participant = summary_update.participant
+    participant_summary = summary_update.participant_summary
 
     authored = questionnaire_response.authored
     # If authored is a datetime and has tzinfo, convert to utc and remove tzinfo.
@@ -217,7 +324,7 @@ class QuestionnaireResponseDao(BaseDao):
     if authored and isinstance(authored, datetime) and authored.tzinfo:
       authored = authored.astimezone(pytz.utc).replace(tzinfo=None)
 
-    code_ids.extend([concept.codeId for concept in questionnaire_history.concepts])
+    code_ids.extend([concept.codeId for concept in questionnaire_structure.concepts])
 
     code_dao = CodeDao()
 
@@ -236,71 +343,47 @@ class QuestionnaireResponseDao(BaseDao):
     else:
       raise_if_withdrawn(participant_summary)
 
-    # Fetch the codes for all questions and concepts
-    codes = code_dao.get_with_ids(code_ids)
-
-    code_map = {code.codeId: code for code in codes if code.system == PPI_SYSTEM}
-    question_map = {question.questionnaireQuestionId: question for question in questions}
-    race_code_ids = []
-    ehr_consent = False
-    dvehr_consent = QuestionnaireStatus.SUBMITTED_NO_CONSENT
-    # Set summary fields for answers that have questions with codes found in QUESTION_CODE_TO_FIELD
-    for answer in questionnaire_response.answers:
-      question = question_map.get(answer.questionId)
-      if question:
-        code = code_map.get(question.codeId)
-        if code:
-          summary_field = QUESTION_CODE_TO_FIELD.get(code.value)
-          if summary_field:
-            if something_changed:
-              self._update_field(participant_summary, summary_field[0], summary_field[1], answer)
-            else:
-              something_changed = self._update_field(participant_summary, summary_field[0],
-                                                     summary_field[1], answer)
-          elif code.value == RACE_QUESTION_CODE:
-            race_code_ids.append(answer.valueCodeId)
-
-          elif code.value == DVEHR_SHARING_QUESTION_CODE:
-            code = code_dao.get(answer.valueCodeId)
-            if code and code.value == DVEHRSHARING_CONSENT_CODE_YES:
-              dvehr_consent = QuestionnaireStatus.SUBMITTED
-            elif code and code.value == DVEHRSHARING_CONSENT_CODE_NOT_SURE:
-              dvehr_consent = QuestionnaireStatus.SUBMITTED_NOT_SURE
-          elif code.value == EHR_CONSENT_QUESTION_CODE:
-            code = code_dao.get(answer.valueCodeId)
-            if code and code.value == CONSENT_PERMISSION_YES_CODE:
-              ehr_consent = True
-          elif code.value == CABOR_SIGNATURE_QUESTION_CODE:
-            if answer.valueUri or answer.valueString:
-              # TODO: validate the URI? [DA-326]
-              if not participant_summary.consentForCABoR:
-                participant_summary.consentForCABoR = True
-                participant_summary.consentForCABoRTime = questionnaire_response.created
-                participant_summary.consentForCABoRAuthored = authored
-                something_changed = True
+    # Set summary fields from the answers to questions that have handlers, resolving the codes
+    # that the answers' values refer to in one lookup.
+    answer_dispatch = _get_answer_dispatch(questionnaire_structure, code_dao)
+    handled_answers = [(answer, answer_dispatch[answer.questionId])
+                       for answer in questionnaire_response.answers
+                       if answer.questionId in answer_dispatch]
+    value_code_ids = list(set(answer.valueCodeId for answer, _ in handled_answers
+                              if answer.valueCodeId is not None))
+    value_codes = dict(zip(value_code_ids, code_dao.get_with_ids(value_code_ids)))
+    state = _AnswerSummaryState(participant_summary, questionnaire_response.created, authored,
+                                value_codes, something_changed)
+    for answer, handler in handled_answers:
+      handler(state, answer)
+    something_changed = state.something_changed
 
     # If race was provided in the response in one or more answers, set the new value.
-    if race_code_ids:
-      race_codes = [code_dao.get(code_id) for code_id in race_code_ids]
-      race = get_race(race_codes)
+    if state.race_codes:
+      race = get_race(state.race_codes)
       if race != participant_summary.race:
         participant_summary.race = race
         something_changed = True
 
+    # Fetch the codes for the questionnaire's concepts.
+    concept_code_ids = [concept.codeId for concept in questionnaire_structure.concepts]
+    code_map = {code.codeId: code for code in code_dao.get_with_ids(concept_code_ids)
+                if code and code.system == PPI_SYSTEM}
+
     # Set summary fields to SUBMITTED for questionnaire concepts that are found in
     # QUESTIONNAIRE_MODULE_CODE_TO_FIELD
     module_changed = False
-    for concept in questionnaire_history.concepts:
+    for concept in questionnaire_structure.concepts:
       code = code_map.get(concept.codeId)
       if code:
         summary_field = QUESTIONNAIRE_MODULE_CODE_TO_FIELD.get(code.value)
         if summary_field:
           new_status = QuestionnaireStatus.SUBMITTED
           setattr(participant_summary, summary_field + 'Authored', authored)
-          if code.value == CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_MODULE and not ehr_consent:
+          if code.value == CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_MODULE and not state.ehr_consent:
             new_status = QuestionnaireStatus.SUBMITTED_NO_CONSENT
           elif code.value == CONSENT_FOR_DVEHR_MODULE:
-            new_status = dvehr_consent
+            new_status = state.dvehr_consent
           elif code.value == CONSENT_FOR_STUDY_ENROLLMENT_MODULE:
             # set language of consent to participant summary
             for extension in resource_json.get('extension', []):
@@ -319,12 +402,6 @@ class QuestionnaireResponseDao(BaseDao):
             something_changed = True
             module_changed = True
 
-    if module_changed:
-      participant_summary.numCompletedBaselinePPIModules = \
-          count_completed_baseline_ppi_modules(participant_summary)
-      participant_summary.numCompletedPPIModules = \
-          count_completed_ppi_modules(participant_summary)
-
     if something_changed:
       first_last = (
         participant_summary.firstName, participant_summary.lastName)
@@ -338,7 +415,22 @@ class QuestionnaireResponseDao(BaseDao):
         raise BadRequest(
           'Email address (%s), or phone number (%s) required for consenting.'
           % tuple(['present' if part else 'missing' for part in email_phone]))
+      summary_update.participant_summary = participant_summary
+      summary_update.something_changed = True
+    if module_changed:
+      summary_update.module_changed = True
 
+  def _save_participant_summary(self, session, summary_update):
+    """Saves the changes made to a participant summary by _update_participant_summary, once all of
+    the participant's responses in the session have been applied to it."""
+    participant_summary = summary_update.participant_summary
+    if summary_update.module_changed:
+      participant_summary.numCompletedBaselinePPIModules = \
+          count_completed_baseline_ppi_modules(participant_summary)
+      participant_summary.numCompletedPPIModules = \
+          count_completed_ppi_modules(participant_summary)
+
+    if summary_update.something_changed:
       ParticipantSummaryDao().update_enrollment_status(participant_summary)
       participant_summary.lastModified = clock.CLOCK.now()
       session.merge(participant_summary)
@@ -349,6 +441,67 @@ class QuestionnaireResponseDao(BaseDao):
         participant_summary.loginPhoneNumber.startswith(TEST_LOGIN_PHONE_NUMBER_PREFIX):
         ParticipantDao().switch_to_test_account(session, participant_summary.participantId)
 
+  def insert_for_participant(self, participant_id, response_factories):
+    """Inserts questionnaire responses for a participant in one transaction, locking the participant
+    and saving its summary once for all of them.
+
+    Each of response_factories returns a new QuestionnaireResponse model (or raises an
+    HTTPException if its resource is invalid); they are called again for every attempt at the
+    transaction. If a response can't be inserted, the transaction is retried without it.
+    Returns, for each factory, its inserted response or the HTTPException that kept it out.
+    """
+    results = [None] * len(response_factories)
+    pending = range(len(response_factories))
+    failed_attempts = 0
+    while pending:
+      responses = {}
+      for index in list(pending):
+        try:
+          response = response_factories[index]()
+          if not response.questionnaireResponseId:
+            # Reserved outside the session below, as reserving may query the table.
+            response.questionnaireResponseId = reserve_id(self, 'questionnaireResponseId')
+          responses[index] = response
+        except HTTPException as e:
+          results[index] = e
+          pending.remove(index)
+      if not pending:
+        break
+      current_index = None
+      try:
+        with self.session() as session:
+          summary_update = self._lock_participant(session, participant_id)
+          for current_index in pending:
+            self.insert_with_session(session, responses[current_index], summary_update)
+          current_index = None
+          self._save_participant_summary(session, summary_update)
+      except HTTPException as e:
+        if current_index is None:
+          # The participant couldn't be locked or its summary saved; none of them can be inserted.
+          for index in pending:
+            results[index] = e
+          break
+        results[current_index] = e
+        pending.remove(current_index)
+        continue
+      except IntegrityError as e:
+        # Most likely a reserved ID was taken by another server; try again with new ones.
+        failed_attempts += 1
+        record_collisions(self, [('questionnaireResponseId', response.questionnaireResponseId)
+                                 for response in responses.itervalues()], e)
+        logging.warning('Failed insert of %d responses for participant %d: %s', len(pending),
+                        participant_id, e.message)
+        if failed_attempts < MAX_INSERT_ATTEMPTS:
+          continue
+        error = ServiceUnavailable('Giving up after %d insert attempts.' % MAX_INSERT_ATTEMPTS)
+        for index in pending:
+          results[index] = error
+        break
+      for index in pending:
+        results[index] = responses[index]
+      break
+    return results
+
   def insert(self, obj):
     if obj.questionnaireResponseId:
       return super(QuestionnaireResponseDao, self).insert(obj)
@@ -578,3 +731,29 @@ class QuestionnaireResponseAnswerDao(BaseDao):
         .filter(QuestionnaireResponseAnswer.endTime == None)
         .filter(QuestionnaireQuestion.codeId.in_(code_ids))
         .all())
+
+  def end_current_answers_for_concepts(self, session, participant_id, code_ids, end_time,
+                                       exclude_response_id=None):
+    """Sets the end time of any answers the participant has previously given to questions with the
+    specified code IDs that haven't ended yet (other than those in the response with ID
+    exclude_response_id). Returns the number of answers ended.
+
+    The answers are found with a join, then updated by primary key: MySQL 5.7 runs IN subqueries
+    in a single-table UPDATE as dependent subqueries, scanning (and locking) the whole table.
+    """
+    if not code_ids:
+      return 0
+    query = (session.query(QuestionnaireResponseAnswer.questionnaireResponseAnswerId)
+             .join(QuestionnaireResponse)
+             .join(QuestionnaireQuestion)
+             .filter(QuestionnaireResponse.participantId == participant_id)
+             .filter(QuestionnaireResponseAnswer.endTime == None)
+             .filter(QuestionnaireQuestion.codeId.in_(code_ids)))
+    if exclude_response_id is not None:
+      query = query.filter(QuestionnaireResponse.questionnaireResponseId != exclude_response_id)
+    answer_ids = [row[0] for row in query]
+    if not answer_ids:
+      return 0
+    return (session.query(QuestionnaireResponseAnswer)
+            .filter(QuestionnaireResponseAnswer.questionnaireResponseAnswerId.in_(answer_ids))
+            .update({QuestionnaireResponseAnswer.endTime: end_time}, synchronize_session=False))
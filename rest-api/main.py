@@ -26,7 +26,8 @@ from api.participant_summary_api import ParticipantSummaryApi, ParticipantSummar
 from api.physical_measurements_api import PhysicalMeasurementsApi, sync_physical_measurements
 from api.public_metrics_api import PublicMetricsApi
 from api.questionnaire_api import QuestionnaireApi
-from api.questionnaire_response_api import QuestionnaireResponseApi, ParticipantQuestionnaireAnswers
+from api.questionnaire_response_api import QuestionnaireResponseApi, \
+  QuestionnaireResponseBatchApi, ParticipantQuestionnaireAnswers
 from config import get_config, get_db_config
 from flask import Flask, got_request_exception
 from flask_restful import Api
@@ -156,6 +157,11 @@ api.add_resource(QuestionnaireResponseApi,
                  endpoint='participant.questionnaire_response',
                  methods=['POST', 'GET'])
 
+api.add_resource(QuestionnaireResponseBatchApi,
+                 PREFIX + 'QuestionnaireResponse/$batch',
+                 endpoint='questionnaire_response_batch',
+                 methods=['POST'])
+
 api.add_resource(ParticipantQuestionnaireAnswers,
                  PREFIX + 'Participant/<participant_id:p_id>/QuestionnaireAnswers/<string:module>',
                  endpoint='participant.questionnaire_answers',
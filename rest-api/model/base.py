@@ -35,6 +35,11 @@ def model_update_listener(mapper, connection, target):
   """ On update auto set `modified` column value """
   target.modified = clock.CLOCK.now()
 
+# pylint: disable=unused-argument
+def model_modified_listener(mapper, connection, target):
+  """ On insert or update auto set `modified` column value, for tables without `created` """
+  target.modified = clock.CLOCK.now()
+
 def get_column_name(model_type, field_name):
   return getattr(model_type, field_name).property.columns[0].name
 
@@ -67,3 +67,25 @@ class BiobankStoredSample(Base):
 
   # Sample family ID
   family_id = Column('family_id', String(80), nullable=True)
+
+
+class BiobankStoredSampleAggregate(Base):
+  """Aggregates of BiobankStoredSamples per participant and test.
+
+  A staging table for ParticipantSummaryDao.update_from_biobank_stored_samples, which rebuilds it
+  from biobank_stored_sample and then joins it into participant_summary, rather than querying
+  biobank_stored_sample separately for every test of every participant. Its contents are only
+  meaningful during an update.
+  """
+  __tablename__ = 'biobank_stored_sample_aggregate'
+  biobankId = Column('biobank_id', Integer, primary_key=True, autoincrement=False)
+  test = Column('test', String(80), primary_key=True)
+  # The lowest status among the samples; disposal statuses are all above RECEIVED.
+  minStatus = Column('min_status', Enum(SampleStatus))
+  # The number of samples with a confirmed time.
+  numConfirmed = Column('num_confirmed', Integer, nullable=False)
+  maxConfirmed = Column('max_confirmed', UTCDateTime)
+  # The latest confirmed time among samples with a status below SAMPLE_NOT_RECEIVED (that is,
+  # not disposed of with a bad outcome).
+  maxConfirmedUsable = Column('max_confirmed_usable', UTCDateTime)
+  maxDisposed = Column('max_disposed', UTCDateTime)
@@ -1,7 +1,8 @@
 from protorpc import messages
-from model.base import Base
-from model.utils import Enum, UTCDateTime
-from sqlalchemy import Column, Integer, String, UnicodeText, Boolean, UniqueConstraint
+from model.base import Base, model_modified_listener
+from model.utils import Enum, UTCDateTime, UTCDateTime6
+from sqlalchemy import Column, Integer, String, UnicodeText, Boolean, UniqueConstraint, Index, \
+  event
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.ext.declarative import declared_attr
@@ -67,6 +68,13 @@ class Code(_CodeBase, Base):
   """
   __tablename__ = 'code'
 
+  # Last insert or update time, used to refresh CodeDao's cache incrementally. (Not on _CodeBase,
+  # since code_history rows are never updated.)
+  modified = Column('modified', UTCDateTime6)
+
+  # Bookkeeping for the cache; left out of asdict() and fromdict().
+  dictalchemy_exclude = ['modified']
+
   @declared_attr
   def children(cls):
     return relationship(
@@ -82,6 +90,10 @@ class Code(_CodeBase, Base):
     UniqueConstraint('system', 'value'),
   )
 
+Index('code_modified', Code.modified)
+event.listen(Code, 'before_insert', model_modified_listener)
+event.listen(Code, 'before_update', model_modified_listener)
+
 class CodeHistory(_CodeBase, Base):
   """A version of a code.
 
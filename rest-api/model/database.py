@@ -20,9 +20,10 @@ from model.hpo import HPO
 from model.log_position import LogPosition
 from model.measurements import PhysicalMeasurements, Measurement
 from model.metric_set import AggregateMetrics, MetricSet
-from model.metrics import MetricsVersion, MetricsBucket
+from model.metrics import MetricsVersion, MetricsBucket, MetricsName, MetricsBlock
 from model.metrics_cache import MetricsEnrollmentStatusCache, MetricsAgeCache, MetricsRaceCache, \
-  MetricsRegionCache, MetricsGenderCache, MetricsLanguageCache, MetricsLifecycleCache
+  MetricsRegionCache, MetricsGenderCache, MetricsLanguageCache, MetricsLifecycleCache, \
+  MetricsPublicPayloadCache, MetricsCacheVersion
 from model.organization import Organization
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireQuestion
 from model.questionnaire import QuestionnaireConcept
@@ -1,8 +1,8 @@
 from model.site_enums import ObsoleteStatus
 from participant_enums import OrganizationType
-from model.base import Base
-from model.utils import Enum, UTCDateTime
-from sqlalchemy import Column, Integer, String, UniqueConstraint
+from model.base import Base, model_modified_listener
+from model.utils import Enum, UTCDateTime, UTCDateTime6
+from sqlalchemy import Column, Integer, String, UniqueConstraint, Index, event
 from sqlalchemy.orm import relationship
 
 class HPO(Base):
@@ -16,12 +16,22 @@ class HPO(Base):
   organizations = relationship('Organization', cascade='all, delete-orphan',
                                order_by='Organization.externalId')
   isObsolete = Column('is_obsolete', Enum(ObsoleteStatus))
+  # Last insert or update time, used to refresh HPODao's cache incrementally.
+  modified = Column('modified', UTCDateTime6)
+
+  # Bookkeeping for the cache; left out of asdict() and fromdict().
+  dictalchemy_exclude = ['modified']
 
   __table_args__ = (
     UniqueConstraint('name'),
   )
 
 
+Index('hpo_modified', HPO.modified)
+event.listen(HPO, 'before_insert', model_modified_listener)
+event.listen(HPO, 'before_update', model_modified_listener)
+
+
 class HpoCountsReport(Base):
   """Daily record of the table_counts_with_upload_timestamp_for_hpo_sites BigQuery view
 
@@ -10,7 +10,8 @@ BUCKETS = {'buckets': {}}
 class MetricsVersion(Base):
   """A version containing a set of metrics in the database, generated by a pipeline.
 
-  Contains buckets with metrics grouped by HPO ID and date.
+  Contains buckets with metrics grouped by HPO ID and date; once packed (see MetricsBlockDao), the
+  same metrics are stored as blocks of counts instead, with names for the metrics they count.
   """
   __tablename__ = 'metrics_version'
   metricsVersionId = Column('metrics_version_id', Integer, primary_key=True)
@@ -19,6 +20,8 @@ class MetricsVersion(Base):
   date = Column('date', UTCDateTime, default=clock.CLOCK.now, nullable=False)
   dataVersion = Column('data_version', Integer, nullable=False)
   buckets = relationship('MetricsBucket', cascade='all, delete-orphan', passive_deletes=True)
+  names = relationship('MetricsName', cascade='all, delete-orphan', passive_deletes=True)
+  blocks = relationship('MetricsBlock', cascade='all, delete-orphan', passive_deletes=True)
 
 
 class MetricsBucket(Base):
@@ -31,3 +34,29 @@ class MetricsBucket(Base):
   date = Column('date', Date, primary_key=True)
   hpoId = Column('hpo_id', String(20), primary_key=True) # Set to '' for cross-HPO metrics
   metrics = Column('metrics', BLOB, nullable=False)
+
+
+class MetricsName(Base):
+  """The name of a metric counted in a MetricsVersion's blocks, which refer to it by metricId."""
+  __tablename__ = 'metrics_name'
+  metricsVersionId = Column('metrics_version_id', Integer,
+                            ForeignKey('metrics_version.metrics_version_id', ondelete='CASCADE'),
+                            primary_key=True)
+  metricId = Column('metric_id', Integer, primary_key=True, autoincrement=False)
+  name = Column('name', String(255), nullable=False)
+
+
+class MetricsBlock(Base):
+  """A block belonging to a MetricsVersion, containing the counts for each metric for a particular
+  HPO ID on each date from startDate to endDate (inclusive), in the format written by
+  dao.metrics_dao.pack_counts.
+  """
+  __tablename__ = 'metrics_block'
+  metricsVersionId = Column('metrics_version_id', Integer,
+                            ForeignKey('metrics_version.metrics_version_id', ondelete='CASCADE'),
+                            primary_key=True)
+  hpoId = Column('hpo_id', String(20), primary_key=True) # Set to '' for cross-HPO metrics
+  startDate = Column('start_date', Date, primary_key=True)
+  endDate = Column('end_date', Date, nullable=False)
+  # A MEDIUMBLOB on MySQL.
+  counts = Column('counts', BLOB(2 ** 24 - 1), nullable=False)
@@ -2,7 +2,7 @@ import clock
 
 from model.base import Base
 from model.utils import UTCDateTime
-from sqlalchemy import Column, Integer, Date, String, Boolean
+from sqlalchemy import Column, Integer, Date, String, Boolean, BLOB
 
 class MetricsEnrollmentStatusCache(Base):
   """Contains enrollment status metrics data grouped by HPO ID and date.
@@ -119,3 +119,31 @@ class MetricsLifecycleCache(Base):
   physicalMeasurement = Column('physical_measurement', Integer, nullable=False)
   sampleReceived = Column('sample_received', Integer, nullable=False)
   fullParticipant = Column('full_participant', Integer, nullable=False)
+
+
+class MetricsPublicPayloadCache(Base):
+  """Contains gzipped PublicMetrics API responses (for all awardees and enrollment statuses),
+  rendered from the version of a metrics cache inserted at date_inserted.
+  """
+  __tablename__ = 'metrics_public_payload_cache'
+  dateInserted = Column('date_inserted', UTCDateTime, nullable=False, primary_key=True)
+  stratification = Column('stratification', String(50), primary_key=True)
+  startDate = Column('start_date', Date, nullable=False, primary_key=True)
+  endDate = Column('end_date', Date, nullable=False, primary_key=True)
+  # A MEDIUMBLOB on MySQL.
+  payload = Column('payload', BLOB(2 ** 24 - 1), nullable=False)
+
+
+class MetricsCacheVersion(Base):
+  """Records that the version of a metrics cache inserted at date_inserted is complete.
+
+  A version's rows are inserted in several transactions, so the newest date_inserted in a cache
+  table may belong to a version that is still being written, or whose refresh failed.
+  """
+  __tablename__ = 'metrics_cache_version'
+  # The cache's table name, followed by its type for the age cache (whose table holds two caches).
+  cacheName = Column('cache_name', String(80), primary_key=True)
+  dateInserted = Column('date_inserted', UTCDateTime, nullable=False, primary_key=True)
+  # The date_inserted of the version this one was (incrementally) updated from that was computed
+  # in full; its own date_inserted if it was computed in full.
+  rebuiltDateInserted = Column('rebuilt_date_inserted', UTCDateTime, nullable=False)
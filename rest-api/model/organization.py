@@ -1,7 +1,7 @@
-from model.base import Base
+from model.base import Base, model_modified_listener
 from model.site_enums import ObsoleteStatus
-from model.utils import Enum
-from sqlalchemy import Column, Integer, String, ForeignKey
+from model.utils import Enum, UTCDateTime6
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, event
 from sqlalchemy.orm import relationship
 
 class Organization(Base):
@@ -18,3 +18,13 @@ class Organization(Base):
   # Sites belonging to this organization.
   sites = relationship('Site', cascade='all, delete-orphan', order_by='Site.googleGroup')
   isObsolete = Column('is_obsolete', Enum(ObsoleteStatus))
+  # Last insert or update time, used to refresh OrganizationDao's cache incrementally.
+  modified = Column('modified', UTCDateTime6)
+
+  # Bookkeeping for the cache; left out of asdict() and fromdict().
+  dictalchemy_exclude = ['modified']
+
+
+Index('organization_modified', Organization.modified)
+event.listen(Organization, 'before_insert', model_modified_listener)
+event.listen(Organization, 'before_update', model_modified_listener)
@@ -1,7 +1,8 @@
-from model.base import Base
-from sqlalchemy import Column, Integer, String, Date, Float, ForeignKey, UnicodeText
+from model.base import Base, model_modified_listener
+from sqlalchemy import Column, Integer, String, Date, Float, ForeignKey, UnicodeText, Index, \
+  event
 from site_enums import SiteStatus, EnrollingStatus, DigitalSchedulingStatus, ObsoleteStatus
-from model.utils import Enum
+from model.utils import Enum, UTCDateTime6
 
 class Site(Base):
   __tablename__ = 'site'
@@ -37,3 +38,13 @@ class Site(Base):
   adminEmails = Column('admin_emails', String(4096))
   link = Column('link', String(255))
   isObsolete = Column('is_obsolete', Enum(ObsoleteStatus))
+  # Last insert or update time, used to refresh SiteDao's cache incrementally.
+  modified = Column('modified', UTCDateTime6)
+
+  # Bookkeeping for the cache; left out of asdict() and fromdict().
+  dictalchemy_exclude = ['modified']
+
+
+Index('site_modified', Site.modified)
+event.listen(Site, 'before_insert', model_modified_listener)
+event.listen(Site, 'before_update', model_modified_listener)
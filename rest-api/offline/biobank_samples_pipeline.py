@@ -5,7 +5,11 @@ Also updates ParticipantSummary data related to samples.
 
 import csv
 import datetime
+import itertools
+import json
 import logging
+import os
+import re
 import pytz
 
 from cloudstorage import cloudstorage_api
@@ -13,7 +17,7 @@ from cloudstorage import cloudstorage_api
 import clock
 import config
 from code_constants import RACE_QUESTION_CODE, RACE_AIAN_CODE, PPI_SYSTEM
-from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao, UpsertCounts
 from dao.code_dao import CodeDao
 from dao.database_utils import replace_isodate, parse_datetime
 from dao.participant_summary_dao import ParticipantSummaryDao
@@ -29,11 +33,21 @@ _FILENAME_DATE_FORMAT = '%Y-%m-%d'
 # The output of the reconciliation report goes into this subdirectory within the upload bucket.
 _REPORT_SUBDIR = 'reconciliation'
 _GENOMIC_SUBDIR_PREFIX = 'genomic_water_line_test'
+# Rows of the samples CSV read, parsed and upserted at a time.
 _BATCH_SIZE = 1000
+# Progress through a samples CSV is saved in a file with this appended to the CSV's name, every
+# this many batches.
+_CHECKPOINT_SUFFIX = '.checkpoint'
+_CHECKPOINT_INTERVAL_BATCHES = 10
 
 # Biobank provides timestamps without time zone info, which should be in central time (see DA-235).
 _INPUT_TIMESTAMP_FORMAT = '%Y/%m/%d %H:%M:%S'  # like 2016/11/30 14:32:18
+_INPUT_TIMESTAMP_RE = re.compile(r'^(\d{4})/(\d{1,2})/(\d{1,2}) (\d{1,2}):(\d{2}):(\d{2})$')
 _US_CENTRAL = pytz.timezone('US/Central')
+# UTC offsets of US/Central local times, by local time truncated to the hour (US/Central changes
+# offset on the hour). Cleared when it reaches the maximum size.
+_central_utc_offsets = {}
+_MAX_CACHED_UTC_OFFSETS = 100000
 
 # The timestamp found at the end of input CSV files.
 INPUT_CSV_TIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
@@ -59,6 +73,15 @@ class DataError(RuntimeError):
 
 
 def upsert_from_latest_csv():
+  """Imports the latest samples CSV, then updates sample data in participant summaries.
+
+  Only the summaries of participants whose samples were inserted or changed are updated, unless
+  BIOBANK_SAMPLES_FULL_SUMMARY_REFRESH is set in the config (for backfills, e.g. after changing
+  which tests count as baseline).
+
+  Progress through the CSV is checkpointed in GCS next to it, so if the import fails part way
+  through, the next run resumes after the last checkpointed row.
+  """
   csv_file, csv_filename, timestamp = get_last_biobank_sample_file_info()
 
   now = clock.CLOCK.now()
@@ -68,11 +91,35 @@ def upsert_from_latest_csv():
         % (csv_filename, timestamp, now),
         external=True)
 
-  csv_reader = csv.DictReader(csv_file, delimiter='\t')
-  written = _upsert_samples_from_csv(csv_reader)
-  ParticipantSummaryDao().update_from_biobank_stored_samples()
+  checkpoint = _GcsCheckpoint(csv_filename + _CHECKPOINT_SUFFIX)
+  written = _upsert_samples_and_update_summaries(csv_file, checkpoint)
   return written, timestamp
 
+
+def upsert_from_file(path, processes=0):
+  """Imports a samples CSV from the local filesystem, as upsert_from_latest_csv does from GCS.
+
+  If processes is more than 1, rows are parsed in a pool of that many processes (which App Engine
+  does not allow, so this is only for imports run elsewhere, e.g. backfills). Progress is
+  checkpointed in path + _CHECKPOINT_SUFFIX.
+  """
+  with open(path, 'rb') as csv_file:
+    return _upsert_samples_and_update_summaries(
+        csv_file, _LocalCheckpoint(path + _CHECKPOINT_SUFFIX), processes)
+
+
+def _upsert_samples_and_update_summaries(csv_file, checkpoint, processes=0):
+  written, changed_biobank_ids = _upsert_samples_from_file(csv_file, checkpoint, processes)
+  if config.getSetting(config.BIOBANK_SAMPLES_FULL_SUMMARY_REFRESH, False):
+    ParticipantSummaryDao().update_from_biobank_stored_samples()
+  else:
+    logging.info('Updating summaries for %d participants with changed samples.',
+                 len(changed_biobank_ids))
+    ParticipantSummaryDao().update_from_biobank_stored_samples(biobank_ids=changed_biobank_ids)
+  # Only forget the file's progress once summaries reflect all of it.
+  checkpoint.delete()
+  return written
+
 def get_last_biobank_sample_file_info():
   """Finds the latest CSV & updates/inserts BiobankStoredSamples from its rows."""
   bucket_name = config.getSetting(config.BIOBANK_SAMPLES_BUCKET_NAME)  # raises if missing
@@ -142,55 +189,230 @@ class CsvColumns(object):
          BIOBANK_ORDER_IDENTIFIER, TEST_CODE,
          CREATE_DATE, STATUS, DISPOSAL_DATE, SAMPLE_FAMILY)
 
-def _upsert_samples_from_csv(csv_reader):
-  """Inserts/updates BiobankStoredSamples from a csv.DictReader."""
-  missing_cols = set(CsvColumns.ALL) - set(csv_reader.fieldnames)
+
+class _Checkpoint(object):
+  """Progress through a samples CSV, saved as JSON so that an interrupted import can resume.
+
+  Records the byte offset just past the last row whose samples were written, the number of samples
+  written so far and the biobank IDs with changed samples (whose summaries still need updating).
+  """
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    """Returns (offset, written, changed_biobank_ids), or None if there is no saved progress."""
+    contents = self._read()
+    if not contents:
+      return None
+    progress = json.loads(contents)
+    return progress['offset'], progress['written'], set(progress['changed_biobank_ids'])
+
+  def save(self, offset, written, changed_biobank_ids):
+    self._write(json.dumps({'offset': offset, 'written': written,
+                            'changed_biobank_ids': sorted(changed_biobank_ids)}))
+
+  def delete(self):
+    raise NotImplementedError()
+
+  def _read(self):
+    raise NotImplementedError()
+
+  def _write(self, contents):
+    raise NotImplementedError()
+
+
+class _GcsCheckpoint(_Checkpoint):
+  def delete(self):
+    try:
+      cloudstorage_api.delete(self.path)
+    except cloudstorage_api.errors.NotFoundError:
+      pass
+
+  def _read(self):
+    try:
+      with cloudstorage_api.open(self.path) as checkpoint_file:
+        return checkpoint_file.read()
+    except cloudstorage_api.errors.NotFoundError:
+      return None
+
+  def _write(self, contents):
+    with cloudstorage_api.open(self.path, mode='w') as checkpoint_file:
+      checkpoint_file.write(contents)
+
+
+class _LocalCheckpoint(_Checkpoint):
+  def delete(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+  def _read(self):
+    if not os.path.exists(self.path):
+      return None
+    with open(self.path) as checkpoint_file:
+      return checkpoint_file.read()
+
+  def _write(self, contents):
+    with open(self.path, 'w') as checkpoint_file:
+      checkpoint_file.write(contents)
+
+
+def _read_fieldnames(csv_file):
+  """Reads the header row of a samples CSV, returning the column names and the header's length."""
+  header = csv_file.readline()
+  fieldnames = next(csv.reader([header], delimiter='\t'), [])
+  missing_cols = set(CsvColumns.ALL) - set(fieldnames)
   if missing_cols:
-    raise DataError(
-        'CSV is missing columns %s, had columns %s.' % (missing_cols, csv_reader.fieldnames))
+    raise DataError('CSV is missing columns %s, had columns %s.' % (missing_cols, fieldnames))
+  return fieldnames, len(header)
+
+
+def _read_batches(csv_file, offset, batch_size=_BATCH_SIZE):
+  """Yields (lines, end offset) for batches of batch_size lines of csv_file, starting at offset.
+
+  Rows are split on newlines, so (as in Biobank's files) values may not contain line breaks.
+  """
+  csv_file.seek(offset)
+  lines = []
+  for line in iter(csv_file.readline, ''):
+    offset += len(line)
+    lines.append(line)
+    if len(lines) >= batch_size:
+      yield lines, offset
+      lines = []
+  if lines:
+    yield lines, offset
+
+
+def _parse_batch(args):
+  """Parses a batch of CSV lines, returning (dicts of BiobankStoredSample fields, end offset).
+
+  Returns plain dicts (and takes a single tuple) so that it can run in a multiprocessing.Pool.
+  """
+  lines, end_offset, fieldnames, biobank_id_prefix = args
+  sample_dicts = []
+  try:
+    for row in csv.DictReader(lines, fieldnames=fieldnames, delimiter='\t'):
+      sample = _create_sample_from_row(row, biobank_id_prefix)
+      if sample:
+        sample_dicts.append(sample.asdict())
+  except ValueError, e:
+    raise DataError(e)
+  return sample_dicts, end_offset
+
+
+def _imap_in_order(pool, func, iterable, window):
+  """Like pool.imap, but only reads window items of iterable ahead of the results consumed."""
+  iterator = iter(iterable)
+  while True:
+    items = list(itertools.islice(iterator, window))
+    if not items:
+      return
+    for result in pool.imap(func, items):
+      yield result
+
+
+def _upsert_samples_from_file(csv_file, checkpoint, processes=0):
+  """Inserts/updates BiobankStoredSamples from a tab-separated samples CSV file.
+
+  The file is read a batch of rows at a time and each batch's samples are upserted before the
+  next are read. If processes is more than 1, batches are parsed in a pool of that many processes
+  while earlier batches are upserted. Progress is saved to checkpoint as batches are written and
+  resumed from it if present.
+
+  Returns the number of samples written and the set of biobank IDs with samples that were
+  inserted or changed.
+  """
+  fieldnames, offset = _read_fieldnames(csv_file)
   samples_dao = BiobankStoredSampleDao()
   biobank_id_prefix = get_biobank_id_prefix()
+  counts = UpsertCounts(0, 0, 0)
   written = 0
+  changed_biobank_ids = set()
+  # Batches after the checkpoint may have been written without their changes being recorded, so
+  # when resuming, samples in as many batches as there are between checkpoints count as changed.
+  batches_to_treat_as_changed = 0
+  progress = checkpoint.load()
+  if progress:
+    offset, written, changed_biobank_ids = progress
+    batches_to_treat_as_changed = _CHECKPOINT_INTERVAL_BATCHES
+    logging.info('Resuming import at byte %d, after %d samples written.', offset, written)
+
+  batches = ((lines, end_offset, fieldnames, biobank_id_prefix)
+             for lines, end_offset in _read_batches(csv_file, offset))
+  # Imported here, as it isn't available on App Engine; only offline runs use more processes.
+  import multiprocessing
+  pool = multiprocessing.Pool(processes) if processes > 1 else None
   try:
-    samples = []
+    if pool:
+      parsed_batches = _imap_in_order(pool, _parse_batch, batches, 2 * processes)
+    else:
+      parsed_batches = itertools.imap(_parse_batch, batches)
     with ParticipantDao().session() as session:
-
-      for row in csv_reader:
-        sample = _create_sample_from_row(row, biobank_id_prefix)
-        if sample:
-          # DA-601 - Ensure biobank_id exists before accepting a sample record.
-          if session.query(Participant).filter(
-                      Participant.biobankId == sample.biobankId).count() < 1:
-            logging.error('Bio bank Id ({0}) does not exist in the Participant table.'.
-                          format(sample.biobankId))
-            continue
-
-          samples.append(sample)
-          if len(samples) >= _BATCH_SIZE:
-            written += samples_dao.upsert_all(samples)
-            samples = []
-
-      if samples:
-        written += samples_dao.upsert_all(samples)
-
-    return written
-  except ValueError, e:
-    raise DataError(e)
+      for i, (sample_dicts, end_offset) in enumerate(parsed_batches):
+        samples = _filter_known_participants(
+            session, [BiobankStoredSample(**sample_dict) for sample_dict in sample_dicts])
+        counts += samples_dao.upsert_all(samples, changed_biobank_ids)
+        if i < batches_to_treat_as_changed:
+          changed_biobank_ids.update(sample.biobankId for sample in samples)
+        offset = end_offset
+        if (i + 1) % _CHECKPOINT_INTERVAL_BATCHES == 0:
+          checkpoint.save(offset, written + counts.written, changed_biobank_ids)
+  finally:
+    if pool:
+      pool.terminate()
+  checkpoint.save(offset, written + counts.written, changed_biobank_ids)
+
+  logging.info('Wrote %d samples: %d inserted, %d updated, %d unchanged.', counts.written,
+               counts.inserted, counts.updated, counts.unchanged)
+  return written + counts.written, changed_biobank_ids
+
+def _filter_known_participants(session, samples):
+  """Returns the samples whose biobank IDs belong to participants, logging the others."""
+  # DA-601 - Ensure biobank_id exists before accepting a sample record.
+  biobank_ids = set(sample.biobankId for sample in samples)
+  known_biobank_ids = set(biobank_id for biobank_id, in session.query(Participant.biobankId)
+                          .filter(Participant.biobankId.in_(biobank_ids)))
+  known_samples = []
+  for sample in samples:
+    if sample.biobankId in known_biobank_ids:
+      known_samples.append(sample)
+    else:
+      logging.error('Bio bank Id ({0}) does not exist in the Participant table.'.
+                    format(sample.biobankId))
+  return known_samples
 
 def _parse_timestamp(row, key, sample):
   str_val = row[key]
   if str_val:
     try:
-      naive = datetime.datetime.strptime(str_val, _INPUT_TIMESTAMP_FORMAT)
+      naive = _parse_naive_timestamp(str_val)
     except ValueError, e:
       raise DataError(
           'Sample %r for %r has bad timestamp %r: %s'
           % (sample.biobankStoredSampleId, sample.biobankId, str_val, e.message))
     # Assume incoming times are in Central time (CST or CDT). Convert to UTC for storage, but drop
     # tzinfo since storage is naive anyway (to make stored/fetched values consistent).
-    return _US_CENTRAL.localize(naive).astimezone(pytz.utc).replace(tzinfo=None)
+    return _central_to_naive_utc(naive)
   return None
 
+def _parse_naive_timestamp(str_val):
+  """Parses a _INPUT_TIMESTAMP_FORMAT timestamp; faster than strptime, which it falls back to."""
+  match = _INPUT_TIMESTAMP_RE.match(str_val)
+  if match:
+    return datetime.datetime(*[int(part) for part in match.groups()])
+  return datetime.datetime.strptime(str_val, _INPUT_TIMESTAMP_FORMAT)
+
+def _central_to_naive_utc(naive):
+  """Converts a naive US/Central time to naive UTC, as localizing it with pytz would."""
+  hour = naive.replace(minute=0, second=0, microsecond=0)
+  offset = _central_utc_offsets.get(hour)
+  if offset is None:
+    if len(_central_utc_offsets) >= _MAX_CACHED_UTC_OFFSETS:
+      _central_utc_offsets.clear()
+    offset = _US_CENTRAL.localize(hour).utcoffset()
+    _central_utc_offsets[hour] = offset
+  return naive - offset
+
 def _create_sample_from_row(row, biobank_id_prefix):
   """Creates a new BiobankStoredSample object from a CSV row.
 
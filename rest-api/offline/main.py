@@ -157,6 +157,8 @@ def delete_old_keys():
 @app_util.auth_required_cron
 @_alert_on_exceptions
 def participant_counts_over_time():
+  if request.args.get('dry_run') == 'true':
+    return json.dumps({'slowest_units': calculate_participant_metrics(dry_run=True)})
   calculate_participant_metrics()
   return '{"success": "true"}'
 
@@ -1,9 +1,11 @@
+import os
+
 from google.appengine.ext import deferred
 
 import clock
 import config
 
-from offline.sql_exporter import SqlExporter
+from offline.sql_exporter import SqlExporter, SqlExportFileWriter
 from dao.code_dao import CodeDao
 from dao.hpo_dao import HPODao
 from dao.database_utils import replace_isodate, get_sql_and_params_for_array
@@ -162,6 +164,23 @@ class MetricsExport(object):
     deferred.defer(MetricsExport._start_participant_export, bucket_name, filename_prefix,
                     num_shards, 0)
 
+  @staticmethod
+  def export_to_directory(directory, num_shards):
+    """Writes the same CSVs as the export tasks to a local directory, for LocalMetricsPipeline.
+    Returns their paths."""
+    paths = []
+    for csv_filename, get_sql in [(_PARTICIPANTS_CSV, _get_participant_sql),
+                                  (_HPO_IDS_CSV, _get_hpo_id_sql),
+                                  (_ANSWERS_CSV, _get_answer_sql)]:
+      for shard_number in range(num_shards):
+        sql, params = get_sql(num_shards, shard_number)
+        path = os.path.join(directory, csv_filename % shard_number)
+        with open(path, 'wb') as dest:
+          SqlExporter(None).run_export_with_writer(SqlExportFileWriter(dest), sql, params,
+                                                   backup=True)
+        paths.append(path)
+    return paths
+
   @staticmethod
   def _start_export(bucket_name, filename_prefix, num_shards, shard_number, export_methodname,
                     next_shard_methodname, next_type_methodname, finish_methodname=None):
@@ -74,7 +74,7 @@ from dateutil.relativedelta import relativedelta
 from census_regions import census_regions
 from code_constants import UNSET, RACE_QUESTION_CODE, PPI_SYSTEM, EHR_CONSENT_QUESTION_CODE
 from code_constants import CONSENT_PERMISSION_YES_CODE, PMI_SKIP_CODE
-from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao, MetricsBlockDao
 from field_mappings import QUESTION_CODE_TO_FIELD, FieldType
 from field_mappings import NON_EHR_QUESTIONNAIRE_MODULE_FIELD_NAMES
 from field_mappings import CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
@@ -152,6 +152,11 @@ class MetricsPipeline(BasePipeline):
 class FinalizeMetrics(pipeline.Pipeline):
   def run(self, future, bucket_name, input_files):  # pylint: disable=unused-argument
     metrics_version_dao = MetricsVersionDao()
+    if config.getSetting(config.METRICS_PIPELINE_PACK_BUCKETS, False):
+      # Pack before the version is served, so that it is never served partly packed.
+      version = metrics_version_dao.get_version_in_progress()
+      if version:
+        MetricsBlockDao().pack_version(version.metricsVersionId)
     metrics_version_dao.set_pipeline_finished(True)
     # After successfully writing metrics, delete old metrics, and delete the input files used to
     # generate the metrics.
@@ -175,6 +180,10 @@ class SummaryPipeline(pipeline.Pipeline):
       mapper_params.update(parent_params)
 
     num_shards = mapper_params[_NUM_SHARDS]
+    participant_reducer_spec = (
+        'offline.metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas_batched'
+        if config.getSetting(config.METRICS_PIPELINE_BATCHED_REDUCER, False)
+        else 'offline.metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas')
     # Chain together three map reduces; see module comments
     blob_key_1 = (yield mapreduce_pipeline.MapreducePipeline(
         'Process Input CSV',
@@ -182,7 +191,7 @@ class SummaryPipeline(pipeline.Pipeline):
         input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
         output_writer_spec='mapreduce.output_writers.GoogleCloudStorageConsistentOutputWriter',
         mapper_params=mapper_params,
-        reducer_spec='offline.metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas',
+        reducer_spec=participant_reducer_spec,
         reducer_params={
             'now': now,
             'output_writer': {
@@ -369,7 +378,14 @@ def sum_deltas(values, delta_map):
       delta_map[date] = int(delta)
 
 def _add_age_range_metrics(dates_and_metrics, date_of_birth, now):
-  creation_date = dates_and_metrics[0][0].date()
+  start_age_range, age_range_metrics = _get_age_range_metrics(dates_and_metrics[0][0].date(),
+                                                              date_of_birth, now)
+  dates_and_metrics.extend(age_range_metrics)
+  return start_age_range
+
+def _get_age_range_metrics(creation_date, date_of_birth, now):
+  """Returns the participant's age range on creation_date, and (datetime, metric) entries for
+  when it changes between then and now."""
   now = now or context.get().mapreduce_spec.mapper.params.get('now')
   # Add entries between the creation date and now for the participant's age range.
   start_age_range = get_bucketed_age(date_of_birth, creation_date)
@@ -377,28 +393,33 @@ def _add_age_range_metrics(dates_and_metrics, date_of_birth, now):
   year = relativedelta(years=1)
   date = date_of_birth + relativedelta(years=difference_in_years + 1)
   previous_age_range = start_age_range
+  age_range_metrics = []
   while date and date <= now.date():
     age_range = get_bucketed_age(date_of_birth, date)
     if age_range != previous_age_range:
-      dates_and_metrics.append((datetime(year=date.year, month=date.month, day=date.day),
+      age_range_metrics.append((datetime(year=date.year, month=date.month, day=date.day),
                                 make_metric(AGE_RANGE_METRIC, age_range)))
       previous_age_range = age_range
     date = date + year
-  return start_age_range
+  return start_age_range, age_range_metrics
 
 def _update_summary_fields(summary_fields, new_state):
   for summary_field in summary_fields:
     new_state[summary_field.name] = summary_field.compute_func(new_state)
 
-def _process_metric(metrics_fields, summary_fields, metric, new_state):
-  metric_name, value = parse_metric(metric)
-  something_changed = False
+def _get_state_field_and_value(metric_name, value):
+  """Returns the participant state field and value set by a metric."""
   if metric_name == EHR_CONSENT_ANSWER_METRIC:
     metric_name = CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
     if value == CONSENT_PERMISSION_YES_CODE:
       value = str(QuestionnaireStatus.SUBMITTED)
     else:
       value = str(QuestionnaireStatus.SUBMITTED_NO_CONSENT)
+  return metric_name, value
+
+def _process_metric(metrics_fields, summary_fields, metric, new_state):
+  metric_name, value = _get_state_field_and_value(*parse_metric(metric))
+  something_changed = False
   if metric_name in metrics_fields:
     if new_state[metric_name] != value:
       new_state[metric_name] = value
@@ -512,6 +533,251 @@ def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_value
     last_state = new_state
     last_hpo_id = hpo_id
 
+def _parse_change_datetime(datetime_str):
+  """Parses a date|metric value's date as parse_datetime does, without strptime for the usual
+  YYYY-MM-DDTHH:MM:SSZ form."""
+  if (len(datetime_str) == 20 and datetime_str[4] == '-' and datetime_str[7] == '-' and
+      datetime_str[10] == 'T' and datetime_str[13] == ':' and datetime_str[16] == ':' and
+      datetime_str[19] == 'Z'):
+    fields = (datetime_str[0:4], datetime_str[5:7], datetime_str[8:10], datetime_str[11:13],
+              datetime_str[14:16], datetime_str[17:19])
+    if all(field.isdigit() for field in fields):
+      return datetime(*[int(field) for field in fields])
+  return parse_datetime(datetime_str)
+
+# Lazily computed by _get_state_key_orders.
+_state_key_orders = None
+
+def _get_state_key_orders():
+  """Returns the orders in which reduce_participant_data_to_hpo_metric_date_deltas iterates over
+  the keys of its participant state, for the initial state and then each copy of it made for a
+  change, up to the first that repeats; and the index of the order that one repeats.
+
+  Dicts with the same keys can iterate over them differently depending on the order they were
+  inserted in (and each copy inserts them in the order of the last), so the batched reducer
+  replays the copies to emit deltas in the same order.
+  """
+  global _state_key_orders
+  if _state_key_orders is None:
+    metrics_conf = get_config()
+    state = {f.name: UNSET for f in metrics_conf['fields']}
+    state[TOTAL_SENTINEL] = 1
+    for summary_field in metrics_conf['summary_fields']:
+      state[summary_field.name] = UNSET
+    orders = [list(state)]
+    while True:
+      state = copy.deepcopy(state)
+      order = list(state)
+      if order in orders:
+        break
+      orders.append(order)
+    _state_key_orders = orders, orders.index(order)
+  return _state_key_orders
+
+# Most summary field values cached by a _SummaryFieldCache for each field.
+_MAX_CACHED_SUMMARY_VALUES = 100000
+
+class _ReadRecordingDict(dict):
+  """A dict that records the keys read from it."""
+  def __init__(self, *args, **kwargs):
+    super(_ReadRecordingDict, self).__init__(*args, **kwargs)
+    self.keys_read = set()
+
+  def __getitem__(self, key):
+    self.keys_read.add(key)
+    return super(_ReadRecordingDict, self).__getitem__(key)
+
+  def __contains__(self, key):
+    self.keys_read.add(key)
+    return super(_ReadRecordingDict, self).__contains__(key)
+
+  def get(self, key, default=None):
+    self.keys_read.add(key)
+    return super(_ReadRecordingDict, self).get(key, default)
+
+class _SummaryFieldCache(object):
+  """Computes summary fields as _update_summary_fields does, caching each field's values by the
+  values of the state keys its compute_func reads.
+
+  A compute_func only depends on the keys it reads, so a value it computed applies to any state
+  with the same values for all of those keys. The keys read by each field are recorded as they
+  are found (dropping the field's cached values when it reads a new one).
+  """
+  def __init__(self, summary_fields, max_values=_MAX_CACHED_SUMMARY_VALUES):
+    self._summary_fields = summary_fields
+    self._max_values = max_values
+    self._keys_read = {summary_field.name: () for summary_field in summary_fields}
+    self._values = {summary_field.name: {} for summary_field in summary_fields}
+
+  def update(self, state):
+    for summary_field in self._summary_fields:
+      name = summary_field.name
+      keys_read = self._keys_read[name]
+      values = self._values[name]
+      cache_key = tuple(state.get(key) for key in keys_read)
+      value = values.get(cache_key, _SummaryFieldCache)
+      if value is not _SummaryFieldCache:
+        state[name] = value
+        continue
+      recording_state = _ReadRecordingDict(state)
+      value = summary_field.compute_func(recording_state)
+      if not recording_state.keys_read.issubset(keys_read):
+        keys_read = tuple(recording_state.keys_read.union(keys_read))
+        self._keys_read[name] = keys_read
+        values.clear()
+        cache_key = tuple(state.get(key) for key in keys_read)
+      if len(values) >= self._max_values:
+        values.clear()
+      values[cache_key] = value
+      state[name] = value
+
+# The _SummaryFieldCache used by the batched reducer, and the run (by its now) it was made for;
+# compute_funcs may read config, so values are only reused within a run.
+_summary_field_cache = None
+_summary_field_cache_now = None
+
+def _get_summary_field_cache(summary_fields, now):
+  global _summary_field_cache, _summary_field_cache_now
+  if _summary_field_cache is None or _summary_field_cache_now != now:
+    _summary_field_cache = _SummaryFieldCache(summary_fields)
+    _summary_field_cache_now = now
+  return _summary_field_cache
+
+def reduce_participant_data_to_hpo_metric_date_deltas_batched(reducer_key, reducer_values,
+                                                              now=None):
+  """Emits the same output as reduce_participant_data_to_hpo_metric_date_deltas, as a single
+  string of hpoId|participant_type|metric|date|delta lines rather than a string per line.
+
+  Each distinct metric is parsed once and interned to an ID (in sorted order, so IDs sort as the
+  metrics do); the participant's changes are then sorted as (date, metric ID) pairs and applied
+  to a single state dict, rather than a copy of it per change. Summary fields are computed with
+  a _SummaryFieldCache.
+  """
+  #pylint: disable=unused-argument
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  metrics_conf = get_config()
+  metric_fields = get_fieldnames()
+  summary_fields = metrics_conf['summary_fields']
+  summary_field_names = [summary_field.name for summary_field in summary_fields]
+  summary_field_cache = _get_summary_field_cache(summary_fields, now)
+  key_orders, repeated_order_index = _get_state_key_orders()
+  repeating_orders = len(key_orders) - repeated_order_index
+
+  date_of_birth = None
+  datetimes = {}
+  dates_and_metrics = []
+  for reducer_value in reducer_values:
+    t = parse_tuple(reducer_value)
+    if t[0] == DATE_OF_BIRTH_PREFIX:
+      date_of_birth = datetime.strptime(t[1], DATE_FORMAT).date()
+    else:
+      dt = datetimes.get(t[0])
+      if dt is None:
+        dt = datetimes[t[0]] = _parse_change_datetime(t[0])
+      dates_and_metrics.append((dt, t[1]))
+
+  if not dates_and_metrics:
+    return
+
+  initial_date = min(dt for dt, _ in dates_and_metrics)
+  start_age_range = None
+  if date_of_birth:
+    # Age range changes all come after the initial date.
+    start_age_range, age_range_metrics = _get_age_range_metrics(initial_date.date(),
+                                                                date_of_birth, now)
+    dates_and_metrics.extend(age_range_metrics)
+
+  # Intern the metrics, and look up the state field and value each one sets (field is None for
+  # metrics that aren't tracked).
+  metrics = sorted(set(metric for _, metric in dates_and_metrics))
+  metric_ids = {metric: metric_id for metric_id, metric in enumerate(metrics)}
+  metric_names = []
+  fields_and_values = []
+  for metric in metrics:
+    metric_name, value = parse_metric(metric)
+    metric_names.append(metric_name)
+    field, value = _get_state_field_and_value(metric_name, value)
+    fields_and_values.append((field if field in metric_fields else None, value))
+  changes = sorted((dt, metric_ids[metric]) for dt, metric in dates_and_metrics)
+  change_metric_ids = [metric_id for _, metric_id in changes]
+
+  state = {f.name: UNSET for f in metrics_conf['fields']}
+  state[TOTAL_SENTINEL] = 1
+  last_hpo_id = UNSET
+  # The starting HPO is the first one set, not counting age range changes.
+  for metric_id in change_metric_ids:
+    if metric_names[metric_id] == HPO_ID_METRIC:
+      last_hpo_id = fields_and_values[metric_id][1]
+      state[HPO_ID_METRIC] = last_hpo_id
+      break
+  if start_age_range is not None:
+    state[AGE_RANGE_METRIC] = start_age_range
+  summary_field_cache.update(state)
+
+  lines = []
+  formatted_date = initial_date.date().isoformat()
+  for k in key_orders[0]:
+    lines.append(reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k,
+                                                    state[k]), formatted_date, '1'))
+
+  full_participant = False
+  num_changes = 0
+  formatted_dates = {}
+  for (dt, _), metric_id in zip(changes, change_metric_ids):
+    field, value = fields_and_values[metric_id]
+    if field is None or state[field] == value:
+      continue  # No changes so there's nothing to do.
+    # The HPO in the state is always last_hpo_id, so this changes it.
+    hpo_change = field == HPO_ID_METRIC
+    if hpo_change:
+      old_state = dict(state)
+    else:
+      # Only this field and the summary fields computed from it can change.
+      old_state = {name: state[name] for name in summary_field_names}
+      old_state[field] = state[field]
+    state[field] = value
+    summary_field_cache.update(state)
+    hpo_id = state[HPO_ID_METRIC]
+
+    num_changes += 1
+    if num_changes < len(key_orders):
+      key_order = key_orders[num_changes]
+    else:
+      key_order = key_orders[repeated_order_index +
+                             (num_changes - repeated_order_index) % repeating_orders]
+    if hpo_change:
+      # In the case that the HPO has changed, we need deltas for all fields.
+      changed_keys = key_order
+    else:
+      changed_keys = [k for k in key_order if k in old_state and state[k] != old_state[k]]
+
+    formatted_date = formatted_dates.get(dt)
+    if formatted_date is None:
+      formatted_date = formatted_dates[dt] = dt.date().isoformat()
+    last_full_participant = full_participant
+    for k in changed_keys:
+      v = state[k]
+      old_val = old_state[k]
+      if (k == ENROLLMENT_STATUS_METRIC and v == EnrollmentStatus.FULL_PARTICIPANT and
+          not full_participant):
+        full_participant = True
+        # Emit 1 values for the current state for all fields for the full participant type.
+        for k2 in key_order:
+          lines.append(reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k2,
+                                                          state[k2]), formatted_date, '1'))
+      lines.append(reduce_result_value(map_result_key(hpo_id, _REGISTERED_PARTICIPANT, k, v),
+                                       formatted_date, '1'))
+      if last_full_participant:
+        lines.append(reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k, v),
+                                         formatted_date, '1'))
+      lines.append(reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k,
+                                                      old_val), formatted_date, '-1'))
+      if last_full_participant:
+        lines.append(reduce_result_value(map_result_key(last_hpo_id, _FULL_PARTICIPANT, k,
+                                                        old_val), formatted_date, '-1'))
+    last_hpo_id = hpo_id
+  yield ''.join(lines)
+
 def map_hpo_metric_date_deltas_to_hpo_metric_key(row_buffer):
   """Emits (hpoId|participant_type|metric, date|delta) pairs for reducing
 
@@ -0,0 +1,226 @@
+"""Runs the three MapReduces of the metrics pipeline on one machine, without the mapreduce runtime.
+
+Each stage calls the same mapper, combiner and reducer functions as SummaryPipeline in
+offline/metrics_pipeline.py. A stage's input files are mapped in a pool of processes; each map
+task hash-partitions the pairs it emits by key into in-memory buffers, which are combined (if the
+stage has a combiner), sorted by key and spilled to local disk as runs whenever they grow past a
+limit. Each partition's runs are then merged by key and reduced in the pool. The first two stages
+write their output to local files read by the next one; the last writes MetricsBuckets for a new
+MetricsVersion, as MetricsPipeline does.
+
+The input is the CSVs written by MetricsExport.export_to_directory. Timings and counts for each
+stage are logged and returned, so this is also used to profile the pipeline
+(see tools/benchmark_metrics_pipeline.py).
+"""
+
+import cPickle
+import collections
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+import config
+from dao import database_factory
+from dao.metrics_dao import MetricsVersionDao, MetricsBlockDao
+from offline import metrics_pipeline
+
+# Number of mapped pairs a map task buffers in memory before spilling them to disk.
+DEFAULT_SPILL_PAIRS = 500000
+
+_Stage = collections.namedtuple('_Stage', ['name', 'mapper', 'combiner', 'reducer'])
+
+# The stages of SummaryPipeline, in order.
+_STAGES = [
+  _Stage('Process Input CSV', metrics_pipeline.map_csv_to_participant_and_date_metric, None,
+         metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas),
+  _Stage('Calculate Counts', metrics_pipeline.map_hpo_metric_date_deltas_to_hpo_metric_key,
+         metrics_pipeline.combine_hpo_metric_date_deltas,
+         metrics_pipeline.reduce_hpo_metric_date_deltas_to_all_date_counts),
+  _Stage('Write Metrics', metrics_pipeline.map_hpo_metric_date_counts_to_hpo_date_key, None,
+         metrics_pipeline.reduce_hpo_date_metric_counts_to_database_buckets),
+]
+
+
+class StageResult(collections.namedtuple('StageResult', ['name', 'map_seconds', 'reduce_seconds',
+                                                         'pairs', 'runs', 'keys'])):
+  """Timings for a stage, with the number of pairs mapped, runs spilled and keys reduced."""
+
+
+def _get_partition(key, num_partitions):
+  # crc32 (unlike hash()) is the same in every process, and may be negative in Python 2.
+  return (zlib.crc32(key) & 0xffffffff) % num_partitions
+
+
+def _spill(stage, buffers, spill_dir):
+  """Writes each non-empty partition buffer to a run file sorted by key, emptying the buffers.
+
+  Returns (partition, run path) for the runs written.
+  """
+  runs = []
+  for partition, buffer in enumerate(buffers):
+    if not buffer:
+      continue
+    fd, path = tempfile.mkstemp(prefix='run-%d-' % partition, dir=spill_dir)
+    with os.fdopen(fd, 'wb') as run_file:
+      for key in sorted(buffer):
+        values = buffer[key]
+        if stage.combiner:
+          values = list(stage.combiner(key, values, []))
+        cPickle.dump((key, values), run_file, cPickle.HIGHEST_PROTOCOL)
+    buffer.clear()
+    runs.append((partition, path))
+  return runs
+
+
+def _map_file(args):
+  """Maps one of a stage's input files, spilling its pairs to runs in spill_dir.
+
+  Takes a single tuple so that it can run in a multiprocessing.Pool. Returns (the number of pairs
+  mapped, [(partition, run path)]).
+  """
+  stage_index, input_path, num_partitions, spill_dir, spill_pairs = args
+  stage = _STAGES[stage_index]
+  buffers = [collections.defaultdict(list) for _ in range(num_partitions)]
+  runs = []
+  pairs = 0
+  buffered = 0
+  with open(input_path, 'rb') as input_file:
+    for key, value in stage.mapper(input_file):
+      buffers[_get_partition(key, num_partitions)][key].append(value)
+      pairs += 1
+      buffered += 1
+      if buffered >= spill_pairs:
+        runs.extend(_spill(stage, buffers, spill_dir))
+        buffered = 0
+  runs.extend(_spill(stage, buffers, spill_dir))
+  return pairs, runs
+
+
+def _read_run(path):
+  with open(path, 'rb') as run_file:
+    while True:
+      try:
+        yield cPickle.load(run_file)
+      except EOFError:
+        return
+
+
+def _merge_runs(run_paths):
+  """Yields (key, values) in key order across runs, with the values for a key from every run."""
+  merged = heapq.merge(*[_read_run(path) for path in run_paths])
+  for key, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+    values = []
+    for _, run_values in entries:
+      values.extend(run_values)
+    yield key, values
+
+
+def _reduce_partition(args):
+  """Reduces a partition's runs, writing the reducer's output (if any) to output_path.
+
+  Takes a single tuple so that it can run in a multiprocessing.Pool. Returns the number of keys
+  reduced.
+  """
+  stage_index, run_paths, output_path, reducer_params = args
+  stage = _STAGES[stage_index]
+  keys = 0
+  output_file = open(output_path, 'wb') if output_path else None
+  try:
+    for key, values in _merge_runs(run_paths):
+      if stage.combiner:
+        values = list(stage.combiner(key, values, []))
+      # The last stage's reducer writes to the database, and returns nothing.
+      results = stage.reducer(key, values, **reducer_params)
+      if results is not None:
+        for result in results:
+          output_file.write(result)
+      keys += 1
+  finally:
+    if output_file:
+      output_file.close()
+  return keys
+
+
+class LocalMetricsPipeline(object):
+  """Runs the metrics pipeline's stages in a pool of processes (or serially if processes is less
+  than 2), with partitions reduce tasks per stage (by default, one per process)."""
+
+  def __init__(self, processes=0, partitions=None, spill_pairs=DEFAULT_SPILL_PAIRS,
+               work_dir=None):
+    self.processes = processes
+    self.partitions = partitions or max(1, processes)
+    self.spill_pairs = spill_pairs
+    self.work_dir = work_dir
+
+  def run(self, input_paths, now):
+    """Calculates metrics as of now from the MetricsExport CSVs at input_paths, writing them as a
+    new MetricsVersion. Returns a StageResult for each stage."""
+    version_dao = MetricsVersionDao()
+    version_id = version_dao.set_pipeline_in_progress()
+    work_dir = tempfile.mkdtemp(prefix='metrics-pipeline-', dir=self.work_dir)
+    pool = None
+    try:
+      if self.processes > 1:
+        # Workers open their own connections; don't let them inherit ours.
+        database_factory.get_database().get_engine().dispose()
+        pool = multiprocessing.Pool(self.processes)
+      reducer_params = [{'now': now}, {'now': now}, {'version_id': version_id}]
+      results = []
+      for stage_index, params in enumerate(reducer_params):
+        result, input_paths = self._run_stage(pool, stage_index, input_paths, params, work_dir)
+        results.append(result)
+      if config.getSetting(config.METRICS_PIPELINE_PACK_BUCKETS, False):
+        MetricsBlockDao().pack_version(version_id)
+    except Exception:
+      version_dao.set_pipeline_finished(False)
+      raise
+    finally:
+      if pool:
+        pool.terminate()
+      shutil.rmtree(work_dir)
+    version_dao.set_pipeline_finished(True)
+    version_dao.delete_old_versions()
+    return results
+
+  def _run_stage(self, pool, stage_index, input_paths, reducer_params, work_dir):
+    """Runs a stage, returning its StageResult and the paths of its output files."""
+    stage = _STAGES[stage_index]
+    stage_dir = os.path.join(work_dir, 'stage-%d' % stage_index)
+    spill_dir = os.path.join(stage_dir, 'runs')
+    os.makedirs(spill_dir)
+
+    start = time.time()
+    map_results = self._map(pool, _map_file, [
+        (stage_index, path, self.partitions, spill_dir, self.spill_pairs) for path in input_paths])
+    runs_by_partition = collections.defaultdict(list)
+    for _, runs in map_results:
+      for partition, path in runs:
+        runs_by_partition[partition].append(path)
+    map_seconds = time.time() - start
+
+    start = time.time()
+    last_stage = stage_index == len(_STAGES) - 1
+    output_paths = [None if last_stage else os.path.join(stage_dir, 'output-%d' % partition)
+                    for partition in sorted(runs_by_partition)]
+    keys = self._map(pool, _reduce_partition, [
+        (stage_index, runs_by_partition[partition], output_path, reducer_params)
+        for partition, output_path in zip(sorted(runs_by_partition), output_paths)])
+    result = StageResult(stage.name, map_seconds, time.time() - start,
+                         sum(pairs for pairs, _ in map_results),
+                         sum(len(runs) for runs in runs_by_partition.itervalues()), sum(keys))
+    logging.info('%s: mapped %d pairs in %.1fs, spilled %d runs, reduced %d keys in %.1fs.',
+                 result.name, result.pairs, result.map_seconds, result.runs, result.keys,
+                 result.reduce_seconds)
+    return result, output_paths
+
+  @staticmethod
+  def _map(pool, func, tasks):
+    if pool:
+      return pool.map(func, tasks, 1)
+    return map(func, tasks)
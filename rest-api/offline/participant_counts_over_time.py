@@ -1,7 +1,15 @@
+from dao.metrics_cache_refresh_scheduler import format_slowest_units
 from dao.participant_counts_over_time_service import ParticipantCountsOverTimeService
+from offline.public_metrics_payloads import materialize_public_metrics_payloads
 
 
-def calculate_participant_metrics():
+def calculate_participant_metrics(dry_run=False):
+  """Refreshes the metrics caches and the pre-rendered public metrics responses. With dry_run,
+  nothing is written, and lines describing the slowest refresh units are returned."""
   # call metrics functions
   service = ParticipantCountsOverTimeService()
-  service.refresh_metrics_cache_data()
+  results = service.refresh_metrics_cache_data(dry_run)
+  if dry_run:
+    return format_slowest_units(results)
+  materialize_public_metrics_payloads()
+  return None
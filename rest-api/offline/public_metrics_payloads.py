@@ -0,0 +1,54 @@
+"""Pre-renders PublicMetrics API responses for the date windows the storefront asks for most.
+
+After the metrics caches are refreshed, the response for each stratification that is read from
+them is rendered (for all awardees and enrollment statuses) for windows of each of
+PUBLIC_METRICS_PRERENDERED_DAYS days ending today and tomorrow, and stored gzipped with
+MetricsPublicPayloadCacheDao. The API serves those as they are, and computes other responses.
+"""
+
+import datetime
+import logging
+
+import clock
+import config
+from api.public_metrics_api import PublicMetricsApi, DAYS_LIMIT_FOR_HISTORY_DATA, \
+  END_DATE_ONLY_STRATIFICATIONS
+from dao.metrics_cache_dao import MetricsPublicPayloadCacheDao
+
+# Lengths (in days) of the windows rendered, if PUBLIC_METRICS_PRERENDERED_DAYS isn't set.
+DEFAULT_PRERENDERED_DAYS = [30, 90, 180, 365, DAYS_LIMIT_FOR_HISTORY_DATA]
+
+
+def _get_date_ranges(stratification, today, window_days):
+  """Returns the (start date, end date) pairs to render stratification for, as the API's
+  validate_params would parse them."""
+  end_dates = [today, today + datetime.timedelta(days=1)]
+  if stratification in END_DATE_ONLY_STRATIFICATIONS:
+    return [(end_date, end_date) for end_date in end_dates]
+  return [(end_date - datetime.timedelta(days=days), end_date)
+          for end_date in end_dates for days in window_days
+          if 0 <= days <= DAYS_LIMIT_FOR_HISTORY_DATA]
+
+
+def materialize_public_metrics_payloads(today=None):
+  """Renders and stores the PublicMetrics responses for the serving metrics cache versions,
+  returning the number stored."""
+  today = today or clock.CLOCK.now().date()
+  window_days = config.getSettingList(config.PUBLIC_METRICS_PRERENDERED_DAYS,
+                                      DEFAULT_PRERENDERED_DAYS)
+  api = PublicMetricsApi()
+  dao = MetricsPublicPayloadCacheDao()
+  count = 0
+  for stratification in MetricsPublicPayloadCacheDao.PRERENDERED_STRATIFICATIONS:
+    with dao.session() as session:
+      date_inserted = dao.get_serving_version_with_session(session, stratification)
+    if date_inserted is None:
+      continue
+    for start_date, end_date in _get_date_ranges(stratification, today, window_days):
+      results = api.get_filtered_results(stratification, start_date, end_date, awardee_ids=[],
+                                         enrollment_statuses=[])
+      dao.insert_payload(date_inserted, stratification, start_date, end_date, results)
+      count += 1
+  dao.delete_old_records()
+  logging.info('Stored %d pre-rendered public metrics responses.', count)
+  return count
@@ -31,7 +31,8 @@ class OrderBy(object):
 
 class Query(object):
   def __init__(self, field_filters, order_by, max_results, pagination_token, a_id=None,
-               always_return_token=False, include_total=False, offset=False):
+               always_return_token=False, include_total=False, offset=False,
+               estimate_total=False):
     self.field_filters = field_filters
     self.order_by = order_by
     self.offset = offset
@@ -40,10 +41,14 @@ class Query(object):
     self.ancestor_id = a_id
     self.always_return_token = always_return_token
     self.include_total = include_total
+    # With include_total, allows an estimated total where the database can provide one.
+    self.estimate_total = estimate_total
 
 class Results(object):
-  def __init__(self, items, pagination_token=None, more_available=False, total=None):
+  def __init__(self, items, pagination_token=None, more_available=False, total=None,
+               total_estimated=False):
     self.items = items
     self.pagination_token = pagination_token
     self.more_available = more_available
     self.total = total
+    self.total_estimated = total_estimated
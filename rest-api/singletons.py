@@ -1,9 +1,22 @@
+import logging
 import threading
+import time
 from clock import CLOCK
 from datetime import timedelta
 
+# Guards the maps below; never held while a constructor runs. Each cache index has its own lock
+# (in _index_locks) which is held while its instance is being constructed, so that a slow reload of
+# one cache doesn't block lookups of the others.
 singletons_lock = threading.RLock()
 singletons_map = {}
+_index_locks = {}
+# Incremented by invalidate(), so that loads which started before an invalidation aren't stored.
+_generations = {}
+_refresh_threads = {}
+_stats = {}
+# The most recently constructed instance for each index, kept through expiry and invalidation so
+# that constructors can build on it (see get_last).
+_last_instances = {}
 
 CODE_CACHE_INDEX = 0
 HPO_CACHE_INDEX = 1
@@ -14,10 +27,67 @@ GENERIC_SQL_DATABASE_INDEX = 5
 MAIN_CONFIG_INDEX = 6
 DB_CONFIG_INDEX = 7
 BACKUP_SQL_DATABASE_INDEX = 8
+SERVER_CURSOR_SQL_DATABASE_INDEX = 9
+
+
+class CacheStats(object):
+  """Counters for a single cache index. Updated without locking, so they are approximate under
+  heavy concurrency."""
+  def __init__(self):
+    self.hits = 0
+    # Lookups answered with an expired instance while a background refresh was running.
+    self.stale_hits = 0
+    self.misses = 0
+    # Lookups that had to wait for another thread to finish constructing the instance.
+    self.blocked_waiters = 0
+    self.reloads = 0
+    self.reload_seconds = 0.0
+
+  def asdict(self):
+    return dict(self.__dict__)
+
 
 def reset_for_tests():
   with singletons_lock:
     singletons_map.clear()
+    _generations.clear()
+    _stats.clear()
+    _last_instances.clear()
+
+
+def wait_for_refresh_for_tests(cache_index):
+  """Blocks until any background refresh of the given cache index has finished."""
+  thread = _refresh_threads.get(cache_index)
+  if thread:
+    thread.join()
+
+
+def get_last(cache_index):
+  """Returns the most recently constructed instance for the index, even if it has expired or been
+  invalidated, or None if there isn't one."""
+  return _last_instances.get(cache_index)
+
+
+def get_stats(cache_index):
+  """Returns a dict of the counters in CacheStats for the given cache index."""
+  return _get_stats(cache_index).asdict()
+
+
+def _get_stats(cache_index):
+  stats = _stats.get(cache_index)
+  if stats is None:
+    with singletons_lock:
+      stats = _stats.setdefault(cache_index, CacheStats())
+  return stats
+
+
+def _get_index_lock(cache_index):
+  lock = _index_locks.get(cache_index)
+  if lock is None:
+    with singletons_lock:
+      lock = _index_locks.setdefault(cache_index, threading.RLock())
+  return lock
+
 
 def _get(cache_index):
   existing_pair = singletons_map.get(cache_index)
@@ -25,27 +95,92 @@ def _get(cache_index):
     return existing_pair[0]
   return None
 
-def get(cache_index, constructor, cache_ttl_seconds=None, **kwargs):
+
+def get(cache_index, constructor, cache_ttl_seconds=None, refresh_in_background=False, **kwargs):
   """Get a cache with a specified index from the list above. If not initialized, use
-  constructor to initialize it; if cache_ttl_seconds is set, reload it after that period."""
+  constructor to initialize it; if cache_ttl_seconds is set, reload it after that period.
+
+  If refresh_in_background is set, an expired instance keeps being returned while a background
+  thread constructs its replacement, rather than blocking callers on the reload.
+  """
+  stats = _get_stats(cache_index)
   # First try without a lock
-  result = _get(cache_index)
-  if result:
-    return result
+  existing_pair = singletons_map.get(cache_index)
+  if existing_pair:
+    instance, expiration_time = existing_pair
+    if expiration_time is None or expiration_time >= CLOCK.now():
+      stats.hits += 1
+      return instance
+    if refresh_in_background:
+      stats.stale_hits += 1
+      _start_background_refresh(cache_index, constructor, cache_ttl_seconds, kwargs)
+      return instance
 
-  # Then grab the lock and try again
-  with singletons_lock:
+  # Then grab the lock for this index and try again
+  lock = _get_index_lock(cache_index)
+  if not lock.acquire(False):
+    stats.blocked_waiters += 1
+    lock.acquire()
+  try:
     result = _get(cache_index)
     if result:
+      stats.hits += 1
       return result
-    else:
-      new_instance = constructor(**kwargs)
-      expiration_time = None
-      if cache_ttl_seconds is not None:
-        expiration_time = CLOCK.now() + timedelta(seconds=cache_ttl_seconds)
+    stats.misses += 1
+    return _construct(cache_index, constructor, cache_ttl_seconds, kwargs)
+  finally:
+    lock.release()
+
+
+def _construct(cache_index, constructor, cache_ttl_seconds, kwargs):
+  """Constructs and stores a new instance. Must be called holding the lock for cache_index."""
+  stats = _get_stats(cache_index)
+  generation = _generations.get(cache_index, 0)
+  start_time = time.time()
+  new_instance = constructor(**kwargs)
+  stats.reloads += 1
+  stats.reload_seconds += time.time() - start_time
+  expiration_time = None
+  if cache_ttl_seconds is not None:
+    expiration_time = CLOCK.now() + timedelta(seconds=cache_ttl_seconds)
+  with singletons_lock:
+    # If the cache was invalidated while we were loading, what we loaded may already be stale;
+    # hand it to this caller but let the next one reload.
+    if _generations.get(cache_index, 0) == generation:
       singletons_map[cache_index] = (new_instance, expiration_time)
-      return new_instance
+      _last_instances[cache_index] = new_instance
+  return new_instance
+
+
+def _start_background_refresh(cache_index, constructor, cache_ttl_seconds, kwargs):
+  with singletons_lock:
+    thread = _refresh_threads.get(cache_index)
+    if thread and thread.is_alive():
+      return
+    thread = threading.Thread(target=_refresh, name='singletons-refresh-%d' % cache_index,
+                              args=(cache_index, constructor, cache_ttl_seconds, kwargs))
+    thread.daemon = True
+    _refresh_threads[cache_index] = thread
+  thread.start()
+
+
+def _refresh(cache_index, constructor, cache_ttl_seconds, kwargs):
+  lock = _get_index_lock(cache_index)
+  if not lock.acquire(False):
+    _get_stats(cache_index).blocked_waiters += 1
+    lock.acquire()
+  try:
+    # Another thread may have reloaded the instance while we waited for the lock.
+    if _get(cache_index) is None:
+      _construct(cache_index, constructor, cache_ttl_seconds, kwargs)
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Background refresh of cache %d failed; serving the expired instance.',
+                      cache_index)
+  finally:
+    lock.release()
+
 
 def invalidate(cache_index):
   with singletons_lock:
     singletons_map[cache_index] = None
+    _generations[cache_index] = _generations.get(cache_index, 0) + 1
@@ -0,0 +1,70 @@
+"""Reference conversion of participant summaries to client JSON.
+
+Converts one summary field by field, as ParticipantSummaryDao.to_client_json did before it used
+precomputed plans. Tests and tools/benchmark_summary_json.py compare to_client_json_list with it.
+"""
+
+import clock
+from api_util import format_json_date, format_json_enum, format_json_code, format_json_hpo, \
+  format_json_org, format_json_site
+from code_constants import UNSET
+from dao.participant_summary_dao import _initialize_field_type_sets, _DATE_FIELDS, _CODE_FIELDS, \
+  _ENUM_FIELDS, _SITE_FIELDS
+from model.config_utils import to_client_biobank_id
+from model.participant_summary import WITHDRAWN_PARTICIPANT_FIELDS, \
+  WITHDRAWN_PARTICIPANT_VISIBILITY_TIME, SUSPENDED_PARTICIPANT_FIELDS
+from model.utils import to_client_participant_id
+from participant_enums import SuspensionStatus, WithdrawalStatus, get_bucketed_age
+
+
+def to_client_json_by_field(dao, model):
+  """Returns the client JSON for model, looking up codes, sites and HPOs with dao's DAOs."""
+  result = model.asdict()
+  # Participants that withdrew more than 48 hours ago should have fields other than
+  # WITHDRAWN_PARTICIPANT_FIELDS cleared.
+  if (model.withdrawalStatus == WithdrawalStatus.NO_USE and
+      (model.withdrawalTime is None or
+       model.withdrawalTime < clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME)):
+    result = {k: result.get(k) for k in WITHDRAWN_PARTICIPANT_FIELDS}
+
+  elif model.withdrawalStatus != WithdrawalStatus.NO_USE and \
+    model.suspensionStatus == SuspensionStatus.NO_CONTACT:
+    for i in SUSPENDED_PARTICIPANT_FIELDS:
+      result[i] = UNSET
+
+  result['participantId'] = to_client_participant_id(model.participantId)
+  biobank_id = result.get('biobankId')
+  if biobank_id:
+    result['biobankId'] = to_client_biobank_id(biobank_id)
+  date_of_birth = result.get('dateOfBirth')
+  if date_of_birth:
+    result['ageRange'] = get_bucketed_age(date_of_birth, clock.CLOCK.now())
+  else:
+    result['ageRange'] = UNSET
+
+  if result.get('primaryLanguage') is None:
+    result['primaryLanguage'] = UNSET
+
+  if 'organizationId' in result:
+    result['organization'] = result['organizationId']
+    del result['organizationId']
+    format_json_org(result, dao.organization_dao, 'organization')
+
+  format_json_hpo(result, dao.hpo_dao, 'hpoId')
+  result['awardee'] = result['hpoId']
+  _initialize_field_type_sets()
+  for fieldname in _DATE_FIELDS:
+    format_json_date(result, fieldname)
+  for fieldname in _CODE_FIELDS:
+    format_json_code(result, dao.code_dao, fieldname)
+  for fieldname in _ENUM_FIELDS:
+    format_json_enum(result, fieldname)
+  for fieldname in _SITE_FIELDS:
+    format_json_site(result, dao.site_dao, fieldname)
+  if (model.withdrawalStatus == WithdrawalStatus.NO_USE or
+      model.suspensionStatus == SuspensionStatus.NO_CONTACT):
+    result['recontactMethod'] = 'NO_CONTACT'
+  # Strip None values.
+  result = {k: v for k, v in result.iteritems() if v is not None}
+
+  return result
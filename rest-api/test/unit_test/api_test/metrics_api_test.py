@@ -1,7 +1,7 @@
 import datetime
 
 from model.metrics import MetricsBucket
-from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao, MetricsBlockDao
 
 from test.unit_test.unit_test_util import FlaskTestBase
 
@@ -72,3 +72,19 @@ class MetricsApiTest(FlaskTestBase):
     response = self.send_post('Metrics', {'start_date': self.tomorrow.isoformat(),
                                           'end_date': self.today.isoformat()})
     self.assertEquals([], response)
+
+  def test_get_metrics_from_packed_version(self):
+    self.version_dao.set_pipeline_in_progress()
+    later = self.today + datetime.timedelta(days=60)
+    self.bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=self.today, hpoId='',
+                                         metrics='{ "x": 1 }'))
+    self.bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=later, hpoId='PITT',
+                                         metrics='{ "x": 2, "y": 3 }'))
+    MetricsBlockDao().pack_version(1)
+    self.version_dao.set_pipeline_finished(True)
+    # Packed versions can be served for more than a week at a time.
+    response = self.send_post('Metrics', {'start_date': self.today.isoformat(),
+                                          'end_date': later.isoformat()})
+    self.assertEquals([{'facets': {'date': self.today.isoformat()}, 'entries': {'x': 1}},
+                       {'facets': {'date': later.isoformat(), 'hpoId': 'PITT'},
+                        'entries': {'x': 2, 'y': 3}}], response)
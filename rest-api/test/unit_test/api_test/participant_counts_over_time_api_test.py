@@ -12,7 +12,8 @@ from dao.code_dao import CodeDao
 from model.calendar import Calendar
 from dao.calendar_dao import CalendarDao
 from dao.participant_summary_dao import ParticipantSummaryDao
-from test.unit_test.unit_test_util import FlaskTestBase, make_questionnaire_response_json
+from test.unit_test.unit_test_util import FlaskTestBase, make_questionnaire_response_json, \
+  AZ_HPO_ID, PITT_HPO_ID
 from model.participant import Participant
 from concepts import Concept
 from model.participant_summary import ParticipantSummary
@@ -21,7 +22,7 @@ from participant_enums import EnrollmentStatus, OrganizationType, TEST_HPO_NAME,
 from dao.participant_counts_over_time_service import ParticipantCountsOverTimeService
 from dao.metrics_cache_dao import MetricsEnrollmentStatusCacheDao, MetricsGenderCacheDao, \
   MetricsAgeCacheDao, MetricsRaceCacheDao, MetricsRegionCacheDao, MetricsLifecycleCacheDao, \
-  MetricsLanguageCacheDao
+  MetricsLanguageCacheDao, get_result_cache_stats
 from code_constants import (PPI_SYSTEM, RACE_WHITE_CODE, RACE_HISPANIC_CODE, RACE_AIAN_CODE,
                             RACE_NONE_OF_THESE_CODE, PMI_SKIP_CODE, RACE_MENA_CODE)
 
@@ -905,6 +906,58 @@ class ParticipantCountsOverTimeApiTest(FlaskTestBase):
     self.assertIn({'date': '2018-01-06', 'metrics': {'consented': 0L, 'core': 0L, 'registered': 1L},
                    'hpo': u'UNSET'}, results)
 
+  def test_metrics_cache_results_reused_until_new_version(self):
+    p1 = Participant(participantId=1, biobankId=4)
+    self._insert(p1, 'Alice', 'Aardvark', 'AZ_TUCSON', time_int=self.time1)
+
+    service = ParticipantCountsOverTimeService()
+    dao = MetricsEnrollmentStatusCacheDao()
+    service.make_cache_builder().insert_cache(dao, datetime.datetime(2019, 1, 1))
+    hpo_ids = [PITT_HPO_ID, AZ_HPO_ID]
+    results = dao.get_latest_version_from_cache('2018-01-01', '2018-01-02', hpo_ids)
+    self.assertIn({'date': '2018-01-01', 'metrics': {'consented': 0L, 'core': 0L, 'registered': 1L},
+                   'hpo': u'AZ_TUCSON'}, results)
+    # Awardees in any order, and other DAO instances, share results.
+    self.assertIs(results, dao.get_latest_version_from_cache('2018-01-01', '2018-01-02',
+                                                             hpo_ids=list(reversed(hpo_ids))))
+    self.assertIs(results, MetricsEnrollmentStatusCacheDao().get_latest_version_from_cache(
+        '2018-01-01', '2018-01-02', hpo_ids))
+    stats = get_result_cache_stats()
+    self.assertEquals(2, stats['hits'])
+    self.assertEquals(1, stats['misses'])
+
+    p2 = Participant(participantId=2, biobankId=5)
+    self._insert(p2, 'Bob', 'Builder', 'AZ_TUCSON', time_int=self.time1)
+    service.make_cache_builder().insert_cache(dao, datetime.datetime(2019, 1, 2))
+    results = dao.get_latest_version_from_cache('2018-01-01', '2018-01-02', hpo_ids)
+    self.assertIn({'date': '2018-01-01', 'metrics': {'consented': 0L, 'core': 0L, 'registered': 2L},
+                   'hpo': u'AZ_TUCSON'}, results)
+    stats = get_result_cache_stats()
+    self.assertEquals(2, stats['misses'])
+    self.assertEquals(1, stats['entries'])
+
+  def test_metrics_cache_results_not_reused_from_incomplete_version(self):
+    p1 = Participant(participantId=1, biobankId=4)
+    self._insert(p1, 'Alice', 'Aardvark', 'AZ_TUCSON', time_int=self.time1)
+
+    service = ParticipantCountsOverTimeService()
+    dao = MetricsEnrollmentStatusCacheDao()
+    service.make_cache_builder().insert_cache(dao, datetime.datetime(2019, 1, 1))
+    hpo_ids = [PITT_HPO_ID, AZ_HPO_ID]
+    dao.get_latest_version_from_cache('2018-01-01', '2018-01-02', hpo_ids)
+
+    # A refresh has written PITT's rows of a new version, but not AZ_TUCSON's yet.
+    service.insert_cache_by_hpo(dao, PITT_HPO_ID, datetime.datetime(2019, 1, 2))
+    for _ in range(2):
+      self.assertEquals([], [result for result in
+                             dao.get_latest_version_from_cache('2018-01-01', '2018-01-02',
+                                                               hpo_ids)
+                             if result['hpo'] == 'AZ_TUCSON'])
+    stats = get_result_cache_stats()
+    self.assertEquals(0, stats['hits'])
+    self.assertEquals(1, stats['misses'])
+    self.assertEquals(1, stats['entries'])
+
   def test_refresh_metrics_enrollment_status_cache_data_for_public_metrics_api(self):
 
     p1 = Participant(participantId=1, biobankId=4)
@@ -4128,3 +4181,141 @@ class ParticipantCountsOverTimeApiTest(FlaskTestBase):
     self.assertEqual(ratios_by_date['2018-01-04'], 1/2.0)
     self.assertEqual(ratios_by_date['2018-01-05'], 2/2.0)
     self.assertEqual(ratios_by_date['2018-01-06'], 2/2.0)
+
+  def test_metrics_cache_builder_matches_sql(self):
+    for code_id, value in ((354, 'GenderIdentity_Woman'), (1, 'PIIState_AZ'), (2, 'PIIState_PA')):
+      self.code_dao.insert(Code(codeId=code_id, system=PPI_SYSTEM, value=value, display=u'a',
+                                topic=u'a', codeType=CodeType.MODULE, mapped=True))
+
+    self._insert(Participant(participantId=1, biobankId=4), 'Alice', 'Aardvark', 'PITT',
+                 time_int=self.time1, time_mem=self.time2, time_fp=self.time3,
+                 time_fp_stored=self.time3, gender_id=354, dob=datetime.date(2000, 1, 3),
+                 state_id=1, primary_language='en')
+    self._insert(Participant(participantId=2, biobankId=5), 'Bob', 'Builder', 'AZ_TUCSON',
+                 time_int=self.time2, time_mem=self.time4, state_id=2, primary_language='es')
+    self._insert(Participant(participantId=3, biobankId=6), 'Chad', 'Caterpillar', 'AZ_TUCSON',
+                 time_int=self.time3)
+    self._insert(Participant(participantId=4, biobankId=7), 'Dan', 'Dog', 'UNSET',
+                 unconsented=True, time_int=self.time1)
+    self._insert(Participant(participantId=5, biobankId=8, isGhostId=True), 'Ghost', 'G', 'PITT',
+                 time_int=self.time1)
+
+    service = ParticipantCountsOverTimeService()
+    builder = service.make_cache_builder()
+    for dao in (MetricsEnrollmentStatusCacheDao(), MetricsGenderCacheDao(),
+                MetricsAgeCacheDao(MetricsCacheType.PUBLIC_METRICS_EXPORT_API),
+                MetricsRaceCacheDao(), MetricsRegionCacheDao(), MetricsLanguageCacheDao(),
+                MetricsLifecycleCacheDao()):
+      sql_time = datetime.datetime(2019, 1, 1)
+      builder_time = datetime.datetime(2019, 1, 2)
+      for hpo in self.hpo_dao.get_all():
+        service.insert_cache_by_hpo(dao, hpo.hpoId, sql_time)
+      builder.insert_cache(dao, builder_time)
+
+      sql_rows = self._get_cache_rows(dao, sql_time)
+      self.assertTrue(sql_rows)
+      self.assertEquals(sql_rows, self._get_cache_rows(dao, builder_time))
+
+  def test_metrics_cache_update_matches_insert(self):
+    service, daos = self._insert_metrics_cache_base_version()
+    # Bob becomes a core participant after the base version was inserted.
+    self._update_summary(2, enrollmentStatusCoreStoredSampleTime=self.time4)
+    self._assert_cache_update_matches_insert(service, daos)
+
+  def test_metrics_cache_update_after_stratifying_changes(self):
+    for code_id, value in ((354, 'GenderIdentity_Woman'), (1, 'PIIState_AZ'), (2, 'PIIState_PA')):
+      self.code_dao.insert(Code(codeId=code_id, system=PPI_SYSTEM, value=value, display=u'a',
+                                topic=u'a', codeType=CodeType.MODULE, mapped=True))
+    # Dan signed up long before the base version was inserted.
+    self._insert(Participant(participantId=4, biobankId=7), 'Dan', 'Dog', 'PITT',
+                 time_int=datetime.datetime(2017, 3, 1), time_mem=datetime.datetime(2017, 4, 1),
+                 state_id=1, primary_language='en')
+    service, daos = self._insert_metrics_cache_base_version()
+    # His summary changes move him to other strata on every day since then.
+    self._update_summary(4, genderIdentityId=354, dateOfBirth=datetime.date(1950, 5, 5),
+                         stateId=2, primaryLanguage='es')
+    self._assert_cache_update_matches_insert(service, daos)
+
+  def test_metrics_cache_update_after_pairing_change(self):
+    service, daos = self._insert_metrics_cache_base_version()
+    # Alice moves from PITT to AZ_TUCSON, so is no longer counted in PITT (the HPO her participant
+    # history has) on any day.
+    participant = self.dao.get(1)
+    participant.providerLink = make_primary_provider_link_for_name('AZ_TUCSON')
+    with FakeClock(datetime.datetime(2018, 1, 20)):
+      self.dao.update(participant)
+    self._assert_cache_update_matches_insert(service, daos)
+
+  def test_metrics_cache_update_after_withdrawal(self):
+    service, daos = self._insert_metrics_cache_base_version()
+    participant = self.dao.get(2)
+    participant.withdrawalStatus = WithdrawalStatus.NO_USE
+    with FakeClock(datetime.datetime(2018, 1, 20)):
+      self.dao.update(participant)
+    self._assert_cache_update_matches_insert(service, daos)
+
+  def test_metrics_cache_update_ignores_incomplete_version(self):
+    service, daos = self._insert_metrics_cache_base_version()
+    # A newer version whose refresh failed after writing AZ_TUCSON's rows up to 2018-01-02.
+    for dao in daos:
+      with dao.session() as session:
+        for row in (session.query(dao.model_type)
+                    .filter(dao.model_type.dateInserted == datetime.datetime(2018, 1, 10))
+                    .all()):
+          if row.hpoName != 'AZ_TUCSON' or row.date < datetime.date(2018, 1, 3):
+            values = row.asdict()
+            values['dateInserted'] = datetime.datetime(2018, 1, 15)
+            session.add(dao.model_type(**values))
+    self._update_summary(1, enrollmentStatusCoreStoredSampleTime=self.time4)
+    self._assert_cache_update_matches_insert(service, daos)
+
+  def _insert_metrics_cache_base_version(self):
+    """Inserts participants and a version of each metrics cache at 2018-01-10 to update from,
+    returning the service and cache DAOs."""
+    self._insert(Participant(participantId=1, biobankId=4), 'Alice', 'Aardvark', 'PITT',
+                 time_int=self.time1, time_mem=self.time2, dob=datetime.date(2000, 1, 3),
+                 primary_language='en')
+    self._insert(Participant(participantId=2, biobankId=5), 'Bob', 'Builder', 'AZ_TUCSON',
+                 time_int=self.time2, time_mem=self.time3)
+    self._insert(Participant(participantId=3, biobankId=6), 'Chad', 'Caterpillar', 'AZ_TUCSON',
+                 time_int=self.time3)
+
+    service = ParticipantCountsOverTimeService()
+    daos = (MetricsEnrollmentStatusCacheDao(), MetricsGenderCacheDao(),
+            MetricsAgeCacheDao(MetricsCacheType.PUBLIC_METRICS_EXPORT_API),
+            MetricsRaceCacheDao(), MetricsRegionCacheDao(), MetricsLanguageCacheDao(),
+            MetricsLifecycleCacheDao())
+    builder = service.make_cache_builder()
+    for dao in daos:
+      builder.insert_cache(dao, datetime.datetime(2018, 1, 10))
+    return service, daos
+
+  def _update_summary(self, participant_id, **values):
+    """Sets fields of a participant's summary after the base version was inserted."""
+    with self.ps_dao.session() as session:
+      summary = (session.query(ParticipantSummary)
+                 .filter(ParticipantSummary.participantId == participant_id).one())
+      for name, value in values.iteritems():
+        setattr(summary, name, value)
+      summary.lastModified = datetime.datetime(2018, 1, 20)
+
+  def _assert_cache_update_matches_insert(self, service, daos):
+    update_time = datetime.datetime(2018, 1, 21)
+    insert_time = datetime.datetime(2018, 1, 22)
+    update_builder = service.make_cache_builder()
+    insert_builder = service.make_cache_builder()
+    for dao in daos:
+      update_builder.update_cache(dao, update_time)
+      insert_builder.insert_cache(dao, insert_time)
+      inserted_rows = self._get_cache_rows(dao, insert_time)
+      self.assertTrue(inserted_rows)
+      self.assertEquals(inserted_rows, self._get_cache_rows(dao, update_time))
+
+  @staticmethod
+  def _get_cache_rows(dao, date_inserted):
+    """Returns the values other than dateInserted of dao's rows inserted at date_inserted."""
+    with dao.session() as session:
+      return sorted(tuple(value for key, value in sorted(row.asdict().iteritems())
+                          if key != 'dateInserted')
+                    for row in session.query(dao.model_type)
+                    .filter(dao.model_type.dateInserted == date_inserted))
@@ -1,8 +1,12 @@
 import datetime
 import httplib
+import json
 import threading
 
+import mock
+
 import main
+from api.participant_summary_api import ParticipantSummaryApi
 from clock import FakeClock
 from code_constants import (PPI_SYSTEM, RACE_WHITE_CODE, CONSENT_PERMISSION_YES_CODE,
                             RACE_NONE_OF_THESE_CODE, PMI_SKIP_CODE, DVEHRSHARING_CONSENT_CODE_YES,
@@ -292,6 +296,22 @@ class ParticipantSummaryApiTest(FlaskTestBase):
     self.assertEquals(participant_id, rec['participantId'])
     self.assertEquals(last_modified, rec['lastModified'])
 
+    results = self.send_get('ParticipantSummary/Modified?lastModified=ge%s' % last_modified)
+    self.assertEquals([{'participantId': participant_id, 'lastModified': last_modified}], results)
+    results = self.send_get('ParticipantSummary/Modified?lastModified=gt%s' % last_modified)
+    self.assertEquals([], results)
+    self.send_get('ParticipantSummary/Modified?lastModified=eq%s' % last_modified,
+                  expected_status=httplib.BAD_REQUEST)
+
+    response = self._app.get(main.PREFIX + 'ParticipantSummary/Modified?_format=ndjson')
+    self.assertEquals('application/x-ndjson', response.mimetype)
+    self.assertEquals([{'participantId': participant_id, 'lastModified': last_modified}],
+                      [json.loads(line) for line in response.data.splitlines()])
+    response = self._app.get(main.PREFIX + 'ParticipantSummary/Modified?_format=csv')
+    self.assertEquals('text/csv', response.mimetype)
+    self.assertEquals('participantId,lastModified\r\n%s,%s\r\n' % (participant_id, last_modified),
+                      response.data)
+
 
   def test_pairing_summary(self):
     participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
@@ -749,6 +769,23 @@ class ParticipantSummaryApiTest(FlaskTestBase):
     self.assertEqual(response2['total'], response['total'])
     self.assertEqual(response2['total'], num_participants)
 
+  def test_get_summary_list_streamed_in_chunks(self):
+    for _ in range(3):
+      participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
+      with FakeClock(TIME_1):
+        self.send_consent(participant['participantId'])
+
+    for url in ('ParticipantSummary?_count=2&_includeTotal=true',
+                'ParticipantSummary?_count=2&_sync=true'):
+      with mock.patch('api.base_api.STREAM_CHUNK_SIZE', 1):
+        streamed = self.send_get(url)
+        with mock.patch.object(ParticipantSummaryApi, 'stream_bundles', False):
+          unstreamed = self.send_get(url)
+      self.assertEquals(unstreamed, streamed)
+      self.assertEquals(2, len(streamed['entry']))
+      self.assertEquals('next', streamed['link'][0]['relation'])
+    self.assertEquals(3, self.send_get('ParticipantSummary?_includeTotal=true')['total'])
+
   def test_get_summary_list_returns_offset_results(self):
     num_participants = 10
     SqlTestBase.setup_codes([PMI_SKIP_CODE], code_type=CodeType.ANSWER)
@@ -1,4 +1,8 @@
 import datetime
+import json
+
+import config
+from api.public_metrics_api import PublicMetricsApi
 from clock import FakeClock
 from dao.organization_dao import OrganizationDao
 from dao.participant_dao import ParticipantDao
@@ -14,11 +18,12 @@ from model.participant import Participant
 from concepts import Concept
 from model.participant_summary import ParticipantSummary
 from participant_enums import EnrollmentStatus, OrganizationType, TEST_HPO_NAME, TEST_HPO_ID,\
-  make_primary_provider_link_for_name, MetricsCacheType
+  make_primary_provider_link_for_name, MetricsCacheType, Stratifications
 from dao.participant_counts_over_time_service import ParticipantCountsOverTimeService
 from dao.metrics_cache_dao import MetricsEnrollmentStatusCacheDao, MetricsGenderCacheDao, \
   MetricsAgeCacheDao, MetricsRaceCacheDao, MetricsRegionCacheDao, MetricsLifecycleCacheDao, \
-  MetricsLanguageCacheDao
+  MetricsLanguageCacheDao, MetricsPublicPayloadCacheDao, decompress_payload
+from offline.public_metrics_payloads import materialize_public_metrics_payloads
 from code_constants import (PPI_SYSTEM, RACE_WHITE_CODE, RACE_HISPANIC_CODE, RACE_AIAN_CODE,
                             RACE_NONE_OF_THESE_CODE, PMI_SKIP_CODE, RACE_MENA_CODE)
 
@@ -272,6 +277,42 @@ class PublicMetricsApiTest(FlaskTestBase):
     self.assertIn({'date': '2018-01-03', 'metrics': {'consented': 0, 'core': 1, 'registered': 1}},
                   results)
 
+  def test_public_metrics_serves_prerendered_payloads(self):
+    config.override_setting(config.PUBLIC_METRICS_PRERENDERED_DAYS, [7])
+    p1 = Participant(participantId=1, biobankId=4)
+    self._insert(p1, 'Alice', 'Aardvark', 'UNSET', unconsented=True, time_int=self.time1)
+
+    p2 = Participant(participantId=2, biobankId=5)
+    self._insert(p2, 'Bob', 'Builder', 'AZ_TUCSON', 'AZ_TUCSON_BANNER_HEALTH', time_int=self.time2,
+                 time_mem=self.time3)
+
+    service = ParticipantCountsOverTimeService()
+    dao = MetricsEnrollmentStatusCacheDao(MetricsCacheType.PUBLIC_METRICS_EXPORT_API)
+    service.make_cache_builder().insert_cache(dao, datetime.datetime(2019, 1, 1))
+    # Windows of 7 days ending on 2018-01-08 and 2018-01-09, for each stratification with data.
+    self.assertEquals(4, materialize_public_metrics_payloads(datetime.date(2018, 1, 8)))
+
+    payload_dao = MetricsPublicPayloadCacheDao()
+    payload = payload_dao.get_payload(Stratifications.ENROLLMENT_STATUS,
+                                      datetime.date(2018, 1, 1), datetime.date(2018, 1, 8))
+    live_results = PublicMetricsApi().get_filtered_results(
+        Stratifications.ENROLLMENT_STATUS, datetime.date(2018, 1, 1), datetime.date(2018, 1, 8),
+        awardee_ids=[], enrollment_statuses=[])
+    self.assertEquals(live_results, json.loads(decompress_payload(payload)))
+
+    qs = '&stratification=ENROLLMENT_STATUS&startDate=2018-01-01&endDate=2018-01-08'
+    results = self.send_get('PublicMetrics', query_string=qs)
+    self.assertEquals(live_results, results)
+    self.assertIn({'date': '2018-01-02', 'metrics': {'consented': 1, 'core': 0, 'registered': 1}},
+                  results)
+
+    # Payloads aren't served once the cache they were rendered from is replaced.
+    service.make_cache_builder().insert_cache(dao, datetime.datetime(2019, 1, 2))
+    self.assertIsNone(payload_dao.get_payload(Stratifications.ENROLLMENT_STATUS,
+                                              datetime.date(2018, 1, 1),
+                                              datetime.date(2018, 1, 8)))
+    self.assertEquals(live_results, self.send_get('PublicMetrics', query_string=qs))
+
   def test_public_metrics_get_gender_api(self):
 
     code1 = Code(codeId=354, system="a", value="a", display=u"a", topic=u"a",
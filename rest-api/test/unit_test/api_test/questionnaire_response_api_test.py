@@ -390,6 +390,44 @@ class QuestionnaireResponseApiTest(FlaskTestBase):
 
     self.assertEqual(expected['primaryLanguage'], summary['primaryLanguage'])
 
+  def test_insert_batch(self):
+    participant_id = self.create_participant()
+    other_participant_id = self.create_participant()
+    consent_questionnaire_id = self.create_questionnaire('study_consent.json')
+    questionnaire_id = self.create_questionnaire('questionnaire1.json')
+    consent = gen_response(participant_id, consent_questionnaire_id,
+                           string_answers=[('firstName', 'Bob'), ('lastName', 'Jones'),
+                                           ('email', 'bob@example.com')])
+    answers = [('nameOfChild', 'Cathy Jones')]
+
+    def entry(participant_id, resource):
+      return {'request': {'method': 'POST', 'url': _questionnaire_response_url(participant_id)},
+              'resource': resource}
+    bundle = {'resourceType': 'Bundle', 'type': 'batch', 'entry': [
+      entry(participant_id, consent),
+      # Responses need a consent first, which the other participant hasn't sent.
+      entry(other_participant_id,
+            gen_response(other_participant_id, questionnaire_id, string_answers=answers)),
+      entry(participant_id, gen_response(participant_id, questionnaire_id, string_answers=answers)),
+      {'request': {'method': 'POST', 'url': 'Participant'}, 'resource': consent},
+    ]}
+    response = self.send_post('QuestionnaireResponse/$batch', bundle)
+    self.assertEquals('batch-response', response['type'])
+    statuses = [entry['response']['status'] for entry in response['entry']]
+    self.assertEquals(['200 OK', '400 Bad Request', '200 OK', '400 Bad Request'], statuses)
+    self.assertEquals('error', response['entry'][1]['response']['outcome']['issue'][0]['severity'])
+
+    for response_entry in (response['entry'][0], response['entry'][2]):
+      location = response_entry['response']['location']
+      self.assertTrue(location.startswith(_questionnaire_response_url(participant_id) + '/'))
+      self.send_get(location)
+    summary = self.send_get('Participant/%s/Summary' % participant_id)
+    self.assertEquals('SUBMITTED', summary['consentForStudyEnrollment'])
+    self.assertEquals('Bob', summary['firstName'])
+
+    bundle['type'] = 'transaction'
+    self.send_post('QuestionnaireResponse/$batch', bundle, expected_status=httplib.BAD_REQUEST)
+
   def test_invalid_questionnaire(self):
     participant_id = self.create_participant()
     questionnaire_id = self.create_questionnaire('questionnaire1.json')
@@ -1,8 +1,11 @@
+import datetime
+
 import clock
-from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao, UpsertCounts
 from model.biobank_stored_sample import BiobankStoredSample
 from model.participant import Participant
 from dao.participant_dao import ParticipantDao
+from participant_enums import SampleStatus
 from unit_test_util import SqlTestBase
 
 
@@ -28,3 +31,42 @@ class BiobankStoredSampleDaoTest(SqlTestBase):
     fetched = self.dao.get(sample_id)
     self.assertEquals(test_code, created.test)
     self.assertEquals(test_code, fetched.test)
+
+  def test_upsert_all_tracks_changed_biobank_ids(self):
+    other_participant = Participant(participantId=456, biobankId=666)
+    ParticipantDao().insert(other_participant)
+    now = datetime.datetime(2019, 2, 1, 12, 30)
+
+    def make_sample(sample_id, biobank_id, confirmed=now):
+      return BiobankStoredSample(biobankStoredSampleId=sample_id, biobankId=biobank_id,
+                                 biobankOrderIdentifier='KIT', test='1ED10', confirmed=confirmed)
+
+    changed_biobank_ids = set()
+    self.dao.upsert_all([make_sample('a', 555), make_sample('b', 666)], changed_biobank_ids)
+    self.assertEquals(set([555, 666]), changed_biobank_ids)
+
+    changed_biobank_ids = set()
+    self.assertEquals(UpsertCounts(inserted=1, updated=1, unchanged=1),
+                      self.dao.upsert_all([make_sample('a', 555), make_sample('b', 666, None),
+                                           make_sample('c', 666)], changed_biobank_ids))
+    self.assertEquals(set([666]), changed_biobank_ids)
+    self.assertIsNone(self.dao.get('b').confirmed)
+    self.assertEquals(SampleStatus.RECEIVED, self.dao.get('c').status)
+
+  def test_upsert_all_in_batches_matches_merge(self):
+    now = datetime.datetime(2019, 2, 1, 12, 30)
+    samples = [BiobankStoredSample(biobankStoredSampleId='s%d' % i, biobankId=555,
+                                   biobankOrderIdentifier='KIT', test='1ED10', confirmed=now)
+               for i in range(5)]
+    self.assertEquals(UpsertCounts(inserted=5, updated=0, unchanged=0),
+                      self.dao.upsert_all(samples, batch_size=2))
+    samples[0].status = SampleStatus.DISPOSED
+    samples.append(BiobankStoredSample(biobankStoredSampleId='s5', biobankId=555,
+                                       biobankOrderIdentifier='KIT', test='1ED10'))
+    self.assertEquals(UpsertCounts(inserted=1, updated=1, unchanged=4),
+                      self.dao._upsert_all_by_merge(samples))
+    samples[1].disposed = now
+    self.assertEquals(UpsertCounts(inserted=0, updated=1, unchanged=5),
+                      self.dao.upsert_all(samples, batch_size=4))
+    self.assertEquals(SampleStatus.DISPOSED, self.dao.get('s0').status)
+    self.assertEquals(now, self.dao.get('s1').disposed)
@@ -1,5 +1,6 @@
 import datetime
 
+import singletons
 from clock import FakeClock
 from unit_test_util import SqlTestBase
 from dao.code_dao import CodeDao, CodeBookDao, CodeHistoryDao
@@ -217,6 +218,44 @@ class CodeDaoTest(SqlTestBase):
                            created=TIME, parentId=3)
     self.assertEquals(expectedAnswer1.asdict(), self.code_dao.get(4).asdict())
 
+  def test_incremental_refresh_relinks_children(self):
+    with FakeClock(TIME):
+      module = self.code_dao.insert(Code(system='a', value='m', codeType=CodeType.MODULE,
+                                         mapped=True))
+      question_1 = self.code_dao.insert(Code(system='a', value='q1', codeType=CodeType.QUESTION,
+                                             mapped=True, parentId=module.codeId))
+      question_2 = self.code_dao.insert(Code(system='a', value='q2', codeType=CodeType.QUESTION,
+                                             mapped=True, parentId=module.codeId))
+      answer = self.code_dao.insert(Code(system='a', value='c1', codeType=CodeType.ANSWER,
+                                         mapped=True, parentId=question_1.codeId))
+      self.assertEquals(2, len(self.code_dao.get(module.codeId).children))
+
+    # Change questions the way another server would, refreshing the cache after each change. Each
+    # refresh reads the previously changed question again, since it's within the overlap.
+    for minutes, question_id in ((20, question_1.codeId), (25, question_2.codeId),
+                                 (30, question_2.codeId)):
+      old_module = self.code_dao.get(module.codeId)
+      old_children = list(old_module.children)
+      with FakeClock(TIME + datetime.timedelta(minutes=minutes)):
+        with self.code_dao.session() as session:
+          session.query(Code).get(question_id).display = u'changed %d' % minutes
+        singletons.invalidate(singletons.CODE_CACHE_INDEX)
+        new_module = self.code_dao.get(module.codeId)
+      self.assertEquals(u'changed %d' % minutes, self.code_dao.get(question_id).display)
+      self.assertIs(new_module, self.code_dao.get_code('a', 'm'))
+      self.assertEquals([question_1.codeId, question_2.codeId],
+                        [code.codeId for code in new_module.children])
+      new_question_1 = self.code_dao.get(question_1.codeId)
+      self.assertIs(new_question_1, new_module.children[0])
+      self.assertIs(new_module, new_question_1.parent)
+      new_answer = self.code_dao.get(answer.codeId)
+      self.assertEquals([new_answer], new_question_1.children)
+      self.assertIs(new_question_1, new_answer.parent)
+      self.assertEquals([], self.code_dao.get(question_2.codeId).children)
+      # The previous cache's codes weren't changed.
+      self.assertEquals(old_children, old_module.children)
+      self.assertIsNot(new_module, old_module)
+
 def _make_concept(concept_topic, concept_type, code, display, child_concepts=None):
   concept = { 'property': [{ 'code': 'concept-topic', 'valueCode': concept_topic },
                            { 'code': 'concept-type', 'valueCode': concept_type } ],
@@ -0,0 +1,56 @@
+from mock import patch
+
+from dao.id_reservation import reserve_id, get_id_reservation_stats
+from dao.participant_dao import ParticipantDao
+from model.participant import Participant
+from unit_test_util import SqlTestBase
+
+
+class IdReservationTest(SqlTestBase):
+  def setUp(self):
+    super(IdReservationTest, self).setUp()
+    self.dao = ParticipantDao()
+
+  def test_reserve_skips_taken_ids(self):
+    self.dao.insert(Participant(participantId=5, biobankId=6))
+    with patch('random.randint', side_effect=[5, 7, 8, 7]), \
+         patch('dao.id_reservation.ID_RESERVATION_BATCH_SIZE', 4):
+      self.assertEquals(7, reserve_id(self.dao, 'participantId'))
+      self.assertEquals(8, reserve_id(self.dao, 'participantId'))
+    stats = get_id_reservation_stats()[('Participant', 'participantId')]
+    self.assertEquals(0, stats['available'])
+    self.assertEquals(4, stats['drawn'])
+    # 5 is in use, and 7 was drawn twice.
+    self.assertEquals(2, stats['taken'])
+    self.assertEquals(0.5, stats['collision_rate'])
+    self.assertEquals(1, stats['refills'])
+    self.assertEquals(1, stats['depletions'])
+    self.assertEquals(2, stats['reserved'])
+
+  def test_insert_retries_after_collision(self):
+    with patch('random.randint', side_effect=[5, 9, 6, 8, 11, 12, 13, 14]), \
+         patch('dao.id_reservation.ID_RESERVATION_BATCH_SIZE', 2):
+      p1 = self.dao.insert(Participant())
+      # Another server uses the participant ID left in the pool.
+      self.dao.insert(Participant(participantId=9, biobankId=10))
+      p2 = self.dao.insert(Participant())
+    self.assertEquals((5, 6), (p1.participantId, p1.biobankId))
+    self.assertEquals((11, 13), (p2.participantId, p2.biobankId))
+    stats = get_id_reservation_stats()
+    # Only the participant ID collided.
+    self.assertEquals(1, stats[('Participant', 'participantId')]['insert_collisions'])
+    self.assertEquals(0, stats[('Participant', 'biobankId')]['insert_collisions'])
+    self.assertEquals(2, stats[('Participant', 'participantId')]['depletions'])
+    self.assertEquals(3, stats[('Participant', 'participantId')]['reserved'])
+
+  def test_insert_collision_recorded_for_duplicate_field(self):
+    with patch('random.randint', side_effect=[5, 9, 6, 8, 11, 12, 13, 14]), \
+         patch('dao.id_reservation.ID_RESERVATION_BATCH_SIZE', 2):
+      self.dao.insert(Participant())
+      # Another server uses the biobank ID left in the pool.
+      self.dao.insert(Participant(participantId=20, biobankId=8))
+      participant = self.dao.insert(Participant())
+    self.assertEquals((11, 13), (participant.participantId, participant.biobankId))
+    stats = get_id_reservation_stats()
+    self.assertEquals(0, stats[('Participant', 'participantId')]['insert_collisions'])
+    self.assertEquals(1, stats[('Participant', 'biobankId')]['insert_collisions'])
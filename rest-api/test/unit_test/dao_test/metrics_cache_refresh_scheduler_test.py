@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+
+from dao.metrics_cache_refresh_scheduler import MetricsCacheRefreshScheduler, RefreshUnit, \
+  format_slowest_units
+
+
+class MetricsCacheRefreshSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.lock = threading.Lock()
+    self.running = 0
+    self.max_running = 0
+    self.dry_runs = []
+
+  def _make_unit(self, name, rows, seconds=0.05):
+    def run(dry_run=False):
+      with self.lock:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.dry_runs.append(dry_run)
+      time.sleep(seconds)
+      with self.lock:
+        self.running -= 1
+      return rows
+    return RefreshUnit(name, run)
+
+  def test_run_concurrently_within_connection_budget(self):
+    units = [self._make_unit('unit %d' % i, i) for i in range(8)]
+    results = MetricsCacheRefreshScheduler(workers=4, connection_budget=3).run(units)
+    self.assertEquals(['unit %d' % i for i in range(8)], [result.name for result in results])
+    self.assertEquals(range(8), [result.rows for result in results])
+    self.assertTrue(all(result.duration > 0 and result.error is None for result in results))
+    self.assertEquals(3, self.max_running)
+    self.assertEquals([False] * 8, self.dry_runs)
+
+  def test_run_serially(self):
+    units = [self._make_unit('unit %d' % i, i, seconds=0) for i in range(3)]
+    MetricsCacheRefreshScheduler().run(units, dry_run=True)
+    self.assertEquals(1, self.max_running)
+    self.assertEquals([True] * 3, self.dry_runs)
+
+  def test_failed_unit_stops_run(self):
+    def fail(dry_run=False):
+      raise ValueError('failed')
+    units = ([RefreshUnit('failing', fail)] +
+             [self._make_unit('unit %d' % i, i) for i in range(4)])
+    with self.assertRaises(ValueError):
+      MetricsCacheRefreshScheduler(workers=2).run(units)
+    self.assertLess(len(self.dry_runs), 4)
+
+  def test_format_slowest_units(self):
+    units = [self._make_unit('fast', 1, seconds=0), self._make_unit('slow', 2, seconds=0.1),
+             self._make_unit('medium', 3, seconds=0.05)]
+    results = MetricsCacheRefreshScheduler(workers=3).run(units, dry_run=True)
+    lines = format_slowest_units(results, count=2)
+    self.assertEquals(3, len(lines))
+    self.assertTrue(lines[0].endswith('slow'))
+    self.assertTrue(lines[1].endswith('medium'))
+    self.assertTrue(lines[2].endswith('total of 3 units'))
+    self.assertIn(' 6 rows', lines[2])
@@ -1,8 +1,10 @@
 import datetime
+import json
 
 from clock import FakeClock
 from model.metrics import MetricsVersion, MetricsBucket
-from dao.metrics_dao import MetricsVersionDao, MetricsBucketDao, SERVING_METRICS_DATA_VERSION
+from dao.metrics_dao import MetricsVersionDao, MetricsBucketDao, MetricsBlockDao, \
+  SERVING_METRICS_DATA_VERSION, METRICS_BLOCK_DAYS
 from unit_test_util import SqlTestBase
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import PreconditionFailed
@@ -161,3 +163,34 @@ class MetricsDaoTest(SqlTestBase):
     with FakeClock(TIME_5):
       self.metrics_version_dao.delete_old_versions()
       self.assertIsNone(self.metrics_version_dao.get_with_children(1))
+
+  def test_pack_version(self):
+    self.metrics_version_dao.set_pipeline_in_progress()
+    start_date = datetime.date(2018, 1, 1)
+    # Buckets across several blocks, with gaps and metrics that only some of them include.
+    for day in range(0, 3 * METRICS_BLOCK_DAYS, 3):
+      bucket_date = start_date + datetime.timedelta(days=day)
+      metrics = {'Participant': day, 'Participant.ageRange.18-25': 0}
+      if day % 2:
+        metrics['Participant.state.PIIState_PA'] = day * 2
+      self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=bucket_date,
+                                                   hpoId='', metrics=json.dumps(metrics)))
+      if day % 9 == 0:
+        self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=bucket_date,
+                                                     hpoId=PITT,
+                                                     metrics=json.dumps({'Participant': 1})))
+    self.metrics_version_dao.set_pipeline_finished(True)
+    end_date = start_date + datetime.timedelta(days=3 * METRICS_BLOCK_DAYS)
+    ranges = [(start_date, end_date), (start_date + datetime.timedelta(days=10), start_date),
+              (start_date + datetime.timedelta(days=4), start_date + datetime.timedelta(days=40))]
+    expected = [[self.metrics_bucket_dao.to_client_json(bucket)
+                 for bucket in self.metrics_bucket_dao.get_active_buckets(range_start, range_end)]
+                for range_start, range_end in ranges]
+    self.assertEquals(None, MetricsBlockDao().get_active_client_json(start_date, end_date))
+
+    block_dao = MetricsBlockDao()
+    num_blocks = block_dao.pack_version(1)
+    self.assertEquals(len(block_dao.get_all()), num_blocks)
+    self.assertEquals([], self.metrics_bucket_dao.get_active_buckets())
+    for (range_start, range_end), expected_json in zip(ranges, expected):
+      self.assertEquals(expected_json, block_dao.get_active_client_json(range_start, range_end))
@@ -1,7 +1,7 @@
 import datetime
 
-from dao.base_dao import MAX_INSERT_ATTEMPTS
 from dao.hpo_dao import HPODao
+from dao.id_reservation import MAX_REFILL_ATTEMPTS
 from dao.participant_dao import ParticipantDao, ParticipantHistoryDao
 from participant_enums import make_primary_provider_link_for_name, make_primary_provider_link_for_id
 from dao.participant_summary_dao import ParticipantSummaryDao
@@ -78,7 +78,8 @@ class ParticipantDaoTest(SqlTestBase):
       self.dao.insert(p)
     p2 = Participant()
     time = datetime.datetime(2016, 1, 1)
-    with random_ids([1, 3, 2, 3]):
+    # Participant ID 1 is found to be taken when the ID pool is refilled, and skipped.
+    with random_ids([1, 2, 3]):
       with FakeClock(time):
         p2 = self.dao.insert(p2)
     expected_participant = self._participant_with_defaults(
@@ -89,10 +90,7 @@ class ParticipantDaoTest(SqlTestBase):
     p = Participant()
     with random_ids([1, 2]):
       self.dao.insert(p)
-    rand_ints = []
-    for i in range(0, MAX_INSERT_ATTEMPTS):
-      rand_ints.append(1)
-      rand_ints.append(i)
+    rand_ints = [1] * MAX_REFILL_ATTEMPTS
     p2 = Participant()
     with random_ids(rand_ints):
       with self.assertRaises(ServiceUnavailable):
@@ -102,10 +100,7 @@ class ParticipantDaoTest(SqlTestBase):
     p = Participant()
     with random_ids([1, 2]):
       self.dao.insert(p)
-    rand_ints = []
-    for i in range(0, MAX_INSERT_ATTEMPTS):
-      rand_ints.append(i + 2)
-      rand_ints.append(2)
+    rand_ints = [3] + [2] * MAX_REFILL_ATTEMPTS
     p2 = Participant()
     with random_ids(rand_ints):
       with self.assertRaises(ServiceUnavailable):
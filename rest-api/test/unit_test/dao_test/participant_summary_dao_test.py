@@ -1,6 +1,7 @@
 import copy
 import datetime
 import json
+import mock
 import time
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 
@@ -10,19 +11,24 @@ from code_constants import BIOBANK_TESTS
 from dao.base_dao import json_serial
 from dao.biobank_order_dao import BiobankOrderDao
 from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.code_dao import CodeDao
 from dao.participant_dao import ParticipantDao
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.physical_measurements_dao import PhysicalMeasurementsDao
+from dao.site_dao import SiteDao
 from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
 from model.biobank_stored_sample import BiobankStoredSample
+from model.code import Code, CodeType
 from model.measurements import PhysicalMeasurements
 from model.participant import Participant
 from model.participant_summary import ParticipantSummary
+from model.site import Site
 from participant_enums import EnrollmentStatus, PhysicalMeasurementsStatus, SampleStatus, \
-  QuestionnaireStatus
+  QuestionnaireStatus, SuspensionStatus, WithdrawalStatus
 from query import Query, Operator, FieldFilter, OrderBy
+from test.participant_summary_json import to_client_json_by_field
 from test_data import load_measurement_json
-from unit_test_util import NdbTestBase, PITT_HPO_ID, cancel_biobank_order, \
+from unit_test_util import NdbTestBase, PITT_HPO_ID, PITT_ORG_ID, cancel_biobank_order, \
   get_restore_or_cancel_info
 
 
@@ -85,6 +91,31 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     results = self.dao.query(query)
     self.assertEqual(results.total, num_participants)
 
+  def test_query_with_total_reused_for_later_pages(self):
+    for i in range(3):
+      self._insert(Participant(participantId=i, biobankId=i))
+    query = Query([], OrderBy('participantId', True), 2, None, include_total=True)
+    results = self.dao.query(query)
+    self.assertEqual(results.total, 3)
+    self.assertFalse(results.total_estimated)
+    self._insert(Participant(participantId=3, biobankId=3))
+
+    # The next page reuses the total counted for the first one.
+    next_page = Query([], OrderBy('participantId', True), 2, results.pagination_token,
+                      include_total=True)
+    self.assertEqual(self.dao.query(next_page).total, 3)
+    # A new first page counts again.
+    self.assertEqual(self.dao.query(query).total, 4)
+
+  def test_query_with_estimated_total(self):
+    for i in range(3):
+      self._insert(Participant(participantId=i, biobankId=i))
+    query = Query([], None, 10, None, include_total=True, estimate_total=True)
+    results = self.dao.query(query)
+    self.assertTrue(results.total_estimated)
+    self.assertGreaterEqual(results.total, 0)
+    self.assertEqual(len(results.items), 3)
+
   def testQuery_noSummaries(self):
     self.assert_no_results(self.no_filter_query)
     self.assert_no_results(self.one_filter_query)
@@ -233,6 +264,84 @@ class ParticipantSummaryDaoTest(NdbTestBase):
                                                 datetime.date(1978, 10, 10), 2])),
                         [ps_3, ps_4])
 
+  def _query_all_pages(self, query):
+    participant_ids = []
+    while True:
+      results = self.dao.query(query)
+      participant_ids.extend(summary.participantId for summary in results.items)
+      if not results.pagination_token:
+        return participant_ids
+      query = _with_token(query, results.pagination_token)
+
+  def testQuery_rowValuePagination_matchesOrOfAnds(self):
+    for participant_id, last_name in enumerate(['Jones', 'Jones', 'Aardvark', 'Jones', 'Zebra'],
+                                               start=1):
+      self._insert(Participant(participantId=participant_id, biobankId=10 - participant_id),
+                   'Bob', last_name)
+    ps_2 = self.dao.get(2)
+    ps_2.dateOfBirth = datetime.date(1978, 10, 10)
+    self.dao.update(ps_2)
+
+    for query in (self.no_filter_query, self.ascending_biobank_id_query,
+                  self.descending_biobank_id_query, self.hpo_id_order_query):
+      self.dao.use_row_value_pagination = False
+      expected_ids = self._query_all_pages(query)
+      self.dao.use_row_value_pagination = True
+      self.assertEquals(expected_ids, self._query_all_pages(query))
+      self.assertItemsEqual(range(1, 6), expected_ids)
+
+  def testToClientJsonList_matchesByFieldConversion(self):
+    code_dao = CodeDao()
+    mapped_code = code_dao.insert(Code(system='a', value='mapped', display='m', mapped=True,
+                                       codeType=CodeType.ANSWER))
+    unmapped_code = code_dao.insert(Code(system='a', value='unmapped', display='u', mapped=False,
+                                         codeType=CodeType.ANSWER))
+    site = SiteDao().insert(Site(siteName='site', googleGroup='site@googlegroups.com',
+                                 mayolinkClientNumber=12345, hpoId=PITT_HPO_ID))
+    with clock.FakeClock(TIME_3):
+      for participant_id in range(1, 7):
+        self._insert(Participant(participantId=participant_id, biobankId=participant_id + 10))
+    summaries = [self.dao.get(participant_id) for participant_id in range(1, 7)]
+    # Dates, datetimes, enums, mapped codes, sites, the organization and plain fields.
+    summaries[0].dateOfBirth = datetime.date(1978, 10, 10)
+    summaries[0].genderIdentityId = mapped_code.codeId
+    summaries[0].physicalMeasurementsCreatedSiteId = site.siteId
+    summaries[0].physicalMeasurementsFinalizedSiteId = site.siteId
+    summaries[0].hpoId = PITT_HPO_ID
+    summaries[0].organizationId = PITT_ORG_ID
+    summaries[0].consentForStudyEnrollmentTime = TIME_1
+    summaries[0].enrollmentStatus = EnrollmentStatus.FULL_PARTICIPANT
+    summaries[0].questionnaireOnTheBasics = QuestionnaireStatus.SUBMITTED
+    summaries[0].sampleStatus1ED04 = SampleStatus.RECEIVED
+    summaries[0].zipCode = '12345'
+    # An unmapped code and a set language.
+    summaries[1].genderIdentityId = unmapped_code.codeId
+    summaries[1].stateId = mapped_code.codeId
+    summaries[1].primaryLanguage = 'es'
+    # No contact, which clears the contact fields.
+    summaries[2].suspensionStatus = SuspensionStatus.NO_CONTACT
+    summaries[2].zipCode = '12345'
+    summaries[2].physicalMeasurementsCreatedSiteId = site.siteId
+    # Withdrawn within 48 hours, which keeps all fields.
+    summaries[3].withdrawalStatus = WithdrawalStatus.NO_USE
+    summaries[3].withdrawalTime = TIME_2
+    summaries[3].genderIdentityId = mapped_code.codeId
+    # Withdrawn before that, which clears all but the withdrawn participant fields.
+    summaries[4].withdrawalStatus = WithdrawalStatus.NO_USE
+    summaries[4].withdrawalTime = TIME_1
+    summaries[4].dateOfBirth = datetime.date(1990, 1, 1)
+    summaries[4].organizationId = PITT_ORG_ID
+    # Withdrawn and no contact.
+    summaries[5].withdrawalStatus = WithdrawalStatus.NO_USE
+    summaries[5].withdrawalTime = TIME_2
+    summaries[5].suspensionStatus = SuspensionStatus.NO_CONTACT
+
+    with clock.FakeClock(TIME_3):
+      self.assertEquals([to_client_json_by_field(self.dao, summary) for summary in summaries],
+                        self.dao.to_client_json_list(summaries))
+      self.assertEquals(to_client_json_by_field(self.dao, summaries[0]),
+                        self.dao.to_client_json(summaries[0]))
+
   def test_update_from_samples(self):
     # baseline_tests = ['BASELINE1', 'BASELINE2']
     baseline_tests = ["1PST8", "2PST8"]
@@ -360,6 +469,85 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     self.assertEquals(
       self.dao.get(p_dna_samples.participantId).enrollmentStatusCoreOrderedSampleTime, None)
 
+  def test_update_from_samples_matches_subquery_update(self):
+    config.override_setting(config.BASELINE_SAMPLE_TEST_CODES, ['1ED10', '1PST8', '1UR10'])
+    config.override_setting(config.DNA_SAMPLE_TEST_CODES, ['1ED10', '1SAL2'])
+    sample_dao = BiobankStoredSampleDao()
+    sample_ids = iter(range(1000, 2000))
+
+    def add_sample(participant, test, status=SampleStatus.RECEIVED, confirmed=TIME_1,
+                   disposed=None):
+      sample_dao.insert(BiobankStoredSample(
+          biobankStoredSampleId=str(next(sample_ids)), biobankId=participant.biobankId,
+          biobankOrderIdentifier='KIT', test=test, status=status, confirmed=confirmed,
+          disposed=disposed))
+
+    received = self._insert(Participant(participantId=1, biobankId=11))
+    add_sample(received, '1ED10')
+    add_sample(received, '1PST8', confirmed=TIME_2)
+    add_sample(received, '1SAL2', confirmed=None)
+    mixed = self._insert(Participant(participantId=2, biobankId=22))
+    add_sample(mixed, '1ED10', status=SampleStatus.SAMPLE_NOT_RECEIVED, confirmed=TIME_3,
+               disposed=TIME_3)
+    add_sample(mixed, '1ED10', confirmed=TIME_2)
+    add_sample(mixed, '1UR10', status=SampleStatus.DISPOSED, disposed=TIME_2)
+    add_sample(mixed, 'NOT1')
+    disposed = self._insert(Participant(participantId=3, biobankId=33))
+    add_sample(disposed, '1SAL2', status=SampleStatus.QUALITY_ISSUE, disposed=TIME_2)
+    add_sample(disposed, '1SAL2', status=SampleStatus.LAB_ACCIDENT, disposed=TIME_3)
+    self._insert(Participant(participantId=4, biobankId=44))
+    # A summary with sample fields left over from samples that are gone.
+    stale = Participant(participantId=5, biobankId=55)
+    self.participant_dao.insert(stale)
+    summary = self.participant_summary(stale)
+    summary.sampleStatus1ED10 = SampleStatus.RECEIVED
+    summary.sampleStatus1ED10Time = TIME_1
+    summary.numBaselineSamplesArrived = 1
+    summary.samplesToIsolateDNA = SampleStatus.RECEIVED
+    self.dao.insert(summary)
+    initial_summaries = {summary.participantId: summary.asdict() for summary in self.dao.get_all()}
+
+    def get_summaries():
+      return sorted((summary.asdict() for summary in self.dao.get_all()),
+                    key=lambda summary: summary['participantId'])
+
+    with clock.FakeClock(TIME_4):
+      self.dao._update_from_biobank_stored_samples_by_subquery()
+    expected_summaries = get_summaries()
+    self.assertNotEquals(sorted(initial_summaries.values(), key=lambda s: s['participantId']),
+                         expected_summaries)
+
+    with self.dao.session() as session:
+      for participant_id, fields in initial_summaries.iteritems():
+        session.query(ParticipantSummary).filter(
+            ParticipantSummary.participantId == participant_id).update(
+                fields, synchronize_session=False)
+    with clock.FakeClock(TIME_4):
+      self.dao.update_from_biobank_stored_samples()
+    self.assertEquals(expected_summaries, get_summaries())
+
+  def test_update_from_samples_for_biobank_ids(self):
+    config.override_setting(config.BASELINE_SAMPLE_TEST_CODES, ['1ED10'])
+    sample_dao = BiobankStoredSampleDao()
+    participants = [self._insert(Participant(participantId=i, biobankId=i * 11))
+                    for i in range(1, 4)]
+    for participant in participants:
+      sample_dao.insert(BiobankStoredSample(
+          biobankStoredSampleId=str(participant.biobankId), biobankId=participant.biobankId,
+          biobankOrderIdentifier='KIT', test='1ED10', confirmed=TIME_1))
+
+    with mock.patch('dao.participant_summary_dao._SAMPLE_UPDATE_BATCH_SIZE', 1):
+      self.dao.update_from_biobank_stored_samples(biobank_ids=set([11, 33]))
+
+    updated, not_updated, also_updated = [self.dao.get(participant.participantId)
+                                          for participant in participants]
+    self.assertEquals(SampleStatus.RECEIVED, updated.sampleStatus1ED10)
+    self.assertEquals(1, updated.numBaselineSamplesArrived)
+    self.assertEquals(SampleStatus.RECEIVED, also_updated.sampleStatus1ED10)
+    self.assertEquals(1, also_updated.numBaselineSamplesArrived)
+    self.assertIsNone(not_updated.sampleStatus1ED10)
+    self.assertEquals(0, not_updated.numBaselineSamplesArrived)
+
   def test_calculate_enrollment_status(self):
     self.assertEquals(EnrollmentStatus.FULL_PARTICIPANT,
                       self.dao.calculate_enrollment_status(True,
@@ -1,7 +1,8 @@
 import datetime
 
 from dao.code_dao import CodeDao
-from dao.questionnaire_dao import QuestionnaireDao, QuestionnaireHistoryDao
+from dao.questionnaire_dao import QuestionnaireDao, QuestionnaireHistoryDao, StructureQuestion, \
+  StructureConcept, get_structure_cache_stats
 from dao.questionnaire_dao import QuestionnaireConceptDao, QuestionnaireQuestionDao
 from model.code import Code, CodeType
 from model.questionnaire import Questionnaire, QuestionnaireHistory
@@ -118,6 +119,36 @@ class QuestionnaireDaoTest(SqlTestBase):
     self.assertEquals(questionnaire.asdict(),
                       self.dao.get_latest_questionnaire_with_concept(self.CODE_1.codeId).asdict())
 
+  def test_get_structure(self):
+    q = Questionnaire(resource=RESOURCE_1)
+    q.concepts.append(self.CONCEPT_1)
+    q.concepts.append(self.CONCEPT_2)
+    q.questions.append(self.QUESTION_1)
+    q.questions.append(self.QUESTION_2)
+    with FakeClock(TIME):
+      self.dao.insert(q)
+
+    with self.questionnaire_history_dao.session() as session:
+      self.assertIsNone(self.questionnaire_history_dao.get_structure_with_session(session, [1, 2]))
+      structure = self.questionnaire_history_dao.get_structure_with_session(session, [1, 1])
+      self.assertEquals({1: StructureQuestion(1, 'a', 4), 2: StructureQuestion(2, 'd', 5)},
+                        structure.questions_by_id)
+      self.assertEquals((StructureConcept(1), StructureConcept(2)), structure.concepts)
+      self.assertEquals([StructureQuestion(2, 'd', 5)], structure.get_questions([2, 2, 3]))
+      # Later lookups are served from the cache.
+      self.assertIs(structure,
+                    self.questionnaire_history_dao.get_structure_with_session(session, [1, 1]))
+    self.assertEquals({'hits': 1, 'misses': 2, 'entries': 1}, get_structure_cache_stats())
+
+    # Updating the questionnaire drops its cached versions.
+    with FakeClock(TIME_2):
+      self.dao.update(Questionnaire(questionnaireId=1, version=1, resource=RESOURCE_2))
+    self.assertEquals(0, get_structure_cache_stats()['entries'])
+    with self.questionnaire_history_dao.session() as session:
+      structure = self.questionnaire_history_dao.get_structure_with_session(session, [1, 2])
+    self.assertEquals({}, structure.questions_by_id)
+    self.assertEquals((), structure.concepts)
+
   def test_insert_duplicate(self):
     q = Questionnaire(questionnaireId=1, resource=RESOURCE_1)
     self.dao.insert(q)
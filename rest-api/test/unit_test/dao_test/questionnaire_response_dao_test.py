@@ -13,9 +13,9 @@ import config
 from dao.code_dao import CodeDao
 from dao.participant_dao import ParticipantDao
 from dao.participant_summary_dao import ParticipantSummaryDao
-from dao.questionnaire_dao import QuestionnaireDao
+from dao.questionnaire_dao import QuestionnaireDao, QuestionnaireHistoryDao
 from dao.questionnaire_response_dao import QuestionnaireResponseDao, QuestionnaireResponseAnswerDao
-from dao.questionnaire_response_dao import _raise_if_gcloud_file_missing
+from dao.questionnaire_response_dao import _raise_if_gcloud_file_missing, _get_answer_dispatch
 from model.code import Code, CodeType
 from model.participant import Participant
 from model.questionnaire import Questionnaire, QuestionnaireQuestion, QuestionnaireConcept
@@ -522,6 +522,44 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
         firstName=self.first_name, lastName=self.last_name, email=self.email)
     self.assertEquals(expected_ps.asdict(), self.participant_summary_dao.get(1).asdict())
 
+  def test_insert_compiles_answer_dispatch(self):
+    self.insert_codes()
+    p = Participant(participantId=1, biobankId=2)
+    with FakeClock(TIME):
+      self.participant_dao.insert(p)
+    self._setup_questionnaire()
+    qr = QuestionnaireResponse(questionnaireResponseId=1, questionnaireId=1, questionnaireVersion=1,
+                               participantId=1, resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+    qr.answers.extend(self._names_and_email_answers())
+    with FakeClock(TIME_2):
+      self.questionnaire_response_dao.insert(qr)
+
+    with self.questionnaire_response_dao.session() as session:
+      structure = QuestionnaireHistoryDao().get_structure_with_session(session, [1, 1])
+    # Question 2's code isn't a PPI code, so its answers don't update the summary.
+    self.assertEquals([1, 3, 4, 5, 6], sorted(structure.answer_dispatch.keys()))
+
+  def test_answer_dispatch_not_kept_with_missing_codes(self):
+    self.insert_codes()
+    self._setup_questionnaire()
+    with self.questionnaire_response_dao.session() as session:
+      structure = QuestionnaireHistoryDao().get_structure_with_session(session, [1, 1])
+    structure.answer_dispatch = None
+    code_dao = CodeDao()
+    # Another server added a question's code, but this server's cache doesn't have it yet.
+    missing_question_id = structure.questions_by_id.values()[0].questionnaireQuestionId
+    get_with_ids = code_dao.get_with_ids
+    with mock.patch.object(code_dao, 'get_with_ids',
+                           side_effect=lambda ids: [None] + get_with_ids(ids[1:])):
+      answer_dispatch = _get_answer_dispatch(structure, code_dao)
+    self.assertEquals(sorted(set([1, 3, 4, 5, 6]) - set([missing_question_id])),
+                      sorted(answer_dispatch.keys()))
+    self.assertIsNone(structure.answer_dispatch)
+
+    answer_dispatch = _get_answer_dispatch(structure, code_dao)
+    self.assertEquals([1, 3, 4, 5, 6], sorted(answer_dispatch.keys()))
+    self.assertIs(answer_dispatch, structure.answer_dispatch)
+
   def test_insert_qr_three_times(self):
     """Adds three questionnaire responses for the same participant.
 
@@ -667,6 +705,110 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
     # changes.
     self.assertEquals(expected_ps3.asdict(), self.participant_summary_dao.get(1).asdict())
 
+  def test_end_current_answers_for_concepts(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      self.participant_dao.insert(Participant(participantId=1, biobankId=2))
+    self._setup_questionnaire()
+    qr = QuestionnaireResponse(questionnaireResponseId=1, questionnaireId=1, questionnaireVersion=1,
+                               participantId=1, resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+    qr.answers.append(QuestionnaireResponseAnswer(questionnaireResponseAnswerId=1,
+                                                  questionnaireResponseId=1, questionId=1,
+                                                  valueSystem='a', valueCodeId=3))
+    qr.answers.append(QuestionnaireResponseAnswer(questionnaireResponseAnswerId=2,
+                                                  questionnaireResponseId=1, questionId=2,
+                                                  valueSystem='c', valueCodeId=4))
+    qr.answers.extend(self._names_and_email_answers())
+    with FakeClock(TIME_2):
+      self.questionnaire_response_dao.insert(qr)
+
+    code_ids = [self.CODE_1.codeId, self.CODE_2.codeId]
+    with self.questionnaire_response_answer_dao.session() as session:
+      self.assertEquals(0, self.questionnaire_response_answer_dao.end_current_answers_for_concepts(
+          session, 1, code_ids, TIME_3, exclude_response_id=1))
+      self.assertEquals(0, self.questionnaire_response_answer_dao.end_current_answers_for_concepts(
+          session, 2, code_ids, TIME_3))
+      self.assertEquals(2, self.questionnaire_response_answer_dao.end_current_answers_for_concepts(
+          session, 1, code_ids, TIME_3))
+      # Answers that have already ended are left alone.
+      self.assertEquals(0, self.questionnaire_response_answer_dao.end_current_answers_for_concepts(
+          session, 1, code_ids, TIME_4))
+    end_times = {answer.questionId: answer.endTime
+                 for answer in self.questionnaire_response_dao.get_with_children(1).answers}
+    self.assertEquals({1: TIME_3, 2: TIME_3, 3: None, 4: None, 5: None}, end_times)
+
+  def test_end_current_answers_for_concepts_only_ends_participants_current_answers(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      self.participant_dao.insert(Participant(participantId=1, biobankId=2))
+      self.participant_dao.insert(Participant(participantId=2, biobankId=3))
+    self._setup_questionnaire()
+    for response_id, participant_id, end_time in [(1, 1, TIME_2), (2, 1, None), (3, 2, None)]:
+      qr = QuestionnaireResponse(questionnaireResponseId=response_id, questionnaireId=1,
+                                 questionnaireVersion=1, participantId=participant_id,
+                                 resource=QUESTIONNAIRE_RESPONSE_RESOURCE, created=TIME)
+      qr.answers.extend([
+          QuestionnaireResponseAnswer(questionId=1, valueSystem='a', valueCodeId=3,
+                                      endTime=end_time),
+          QuestionnaireResponseAnswer(questionId=2, valueSystem='c', valueCodeId=4,
+                                      endTime=end_time),
+          QuestionnaireResponseAnswer(questionId=3, valueString=self.first_name)])
+      with self.questionnaire_response_dao.session() as session:
+        session.add(qr)
+
+    with self.questionnaire_response_answer_dao.session() as session:
+      self.assertEquals(1, self.questionnaire_response_answer_dao.end_current_answers_for_concepts(
+          session, 1, [self.CODE_1.codeId], TIME_3))
+
+    end_times = {(answer.questionnaireResponseId, answer.questionId): answer.endTime
+                 for answer in self.questionnaire_response_answer_dao.get_all()}
+    self.assertEquals({(1, 1): TIME_2, (1, 2): TIME_2, (1, 3): None,
+                       (2, 1): TIME_3, (2, 2): None, (2, 3): None,
+                       (3, 1): None, (3, 2): None, (3, 3): None}, end_times)
+
+  def test_insert_for_participant(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      self.participant_dao.insert(Participant(participantId=1, biobankId=2))
+    self._setup_questionnaire()
+
+    def make_response(questionnaire_id=1, gender_identity_code_id=None):
+      qr = QuestionnaireResponse(questionnaireId=questionnaire_id, questionnaireVersion=1,
+                                 participantId=1, resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+      qr.answers.extend([
+          QuestionnaireResponseAnswer(questionId=3, valueString=self.first_name),
+          QuestionnaireResponseAnswer(questionId=4, valueString=self.last_name),
+          QuestionnaireResponseAnswer(questionId=5, valueString=self.email)])
+      if gender_identity_code_id:
+        qr.answers.append(QuestionnaireResponseAnswer(questionId=1, valueSystem='a',
+                                                      valueCodeId=gender_identity_code_id))
+      return qr
+
+    def raise_bad_request():
+      raise BadRequest('Invalid resource.')
+
+    factories = [make_response, raise_bad_request, lambda: make_response(questionnaire_id=2),
+                 lambda: make_response(gender_identity_code_id=3)]
+    with FakeClock(TIME_2):
+      results = self.questionnaire_response_dao.insert_for_participant(1, factories)
+    self.assertEquals(1, results[0].participantId)
+    self.assertIsInstance(results[1], BadRequest)
+    self.assertIsInstance(results[2], BadRequest)
+    self.assertIn('not found', results[2].description)
+    self.assertEquals(3, results[3].answers[-1].valueCodeId)
+    for result in (results[0], results[3]):
+      self.assertIsNotNone(self.questionnaire_response_dao.get(result.questionnaireResponseId))
+
+    summary = self.participant_summary_dao.get(1)
+    self.assertEquals(QuestionnaireStatus.SUBMITTED, summary.consentForStudyEnrollment)
+    self.assertEquals(TIME_2, summary.consentForStudyEnrollmentTime)
+    self.assertEquals(3, summary.genderIdentityId)
+    self.assertEquals(self.first_name, summary.firstName)
+
+    # Nothing is inserted for a participant that doesn't exist.
+    results = self.questionnaire_response_dao.insert_for_participant(2, [make_response])
+    self.assertIsInstance(results[0], BadRequest)
+
   def _get_questionnaire_response_with_consents(self, *consent_paths):
     self.insert_codes()
     questionnaire = self._setup_questionnaire()
@@ -1,4 +1,5 @@
 import datetime
+import singletons
 from clock import FakeClock
 from unit_test.unit_test_util import PITT_ORG_ID, AZ_ORG_ID
 from unit_test_util import SqlTestBase, PITT_HPO_ID, UNSET_HPO_ID, AZ_HPO_ID
@@ -45,6 +46,27 @@ class SiteDaoTest(SqlTestBase):
                       self.site_dao.get_by_google_group('site2@googlegroups.com').asdict())
     self.assertIsNone(self.site_dao.get_by_google_group('site@googlegroups.com'))
 
+  def test_incremental_refresh(self):
+    site = self.site_dao.insert(Site(siteName='site', googleGroup='site@googlegroups.com',
+                                     mayolinkClientNumber=12345, hpoId=PITT_HPO_ID))
+    self.assertEquals('site@googlegroups.com', self.site_dao.get(site.siteId).googleGroup)
+    loaded_time = singletons.get_last(singletons.SITE_CACHE_INDEX).loaded_time
+    # Change the site the way another server would, without invalidating this server's cache.
+    with self.site_dao.session() as session:
+      session.query(Site).get(site.siteId).googleGroup = 'site2@googlegroups.com'
+    self.assertEquals('site@googlegroups.com', self.site_dao.get(site.siteId).googleGroup)
+
+    with FakeClock(datetime.datetime.utcnow() + datetime.timedelta(minutes=2)):
+      singletons.invalidate(singletons.SITE_CACHE_INDEX)
+      self.assertEquals('site2@googlegroups.com', self.site_dao.get(site.siteId).googleGroup)
+      self.assertEquals(site.siteId,
+                        self.site_dao.get_by_google_group('site2@googlegroups.com').siteId)
+      self.assertIsNone(self.site_dao.get_by_google_group('site@googlegroups.com'))
+      # The change was merged into the existing cache rather than reloading everything.
+      self.assertEquals(loaded_time,
+                        singletons.get_last(singletons.SITE_CACHE_INDEX).loaded_time)
+      self.assertEquals(datetime.timedelta(0), self.site_dao.get_cache_age())
+
   def test_participant_pairing_updates_on_change(self):
     TIME = datetime.datetime(2018, 1, 1)
     TIME2 = datetime.datetime(2018, 1, 2)
@@ -1,6 +1,7 @@
 import StringIO
 import csv
 import datetime
+import mock
 import random
 import time
 
@@ -242,12 +243,58 @@ class BiobankSamplesPipelineTest(CloudStorageSqlTestBase, NdbTestBase):
     self.assertEquals(sample.biobankStoredSampleId, row[cols.SAMPLE_ID])
     self.assertEquals(sample.test, row[cols.TEST_CODE])
 
+  def _make_checkpoint(self):
+    return biobank_samples_pipeline._GcsCheckpoint('/%s/samples.checkpoint' % _FAKE_BUCKET)
+
   def test_column_missing(self):
     with open(test_data.data_path('biobank_samples_missing_field.csv')) as samples_file:
-      reader = csv.DictReader(samples_file, delimiter='\t')
       with self.assertRaises(biobank_samples_pipeline.DataError):
-        biobank_samples_pipeline._upsert_samples_from_csv(reader)
-
+        biobank_samples_pipeline._upsert_samples_from_file(samples_file, self._make_checkpoint())
+
+  def test_samples_for_unknown_biobank_ids_skipped(self):
+    for participant_id, biobank_id in ((1, 11), (3, 33)):
+      self.participant_dao.insert(Participant(participantId=participant_id, biobankId=biobank_id))
+    samples_file = test_data.open_biobank_samples([11, 22, 33], ['1ED10', '1ED10', '1ED10'])
+
+    with mock.patch('offline.biobank_samples_pipeline.logging') as mock_logging:
+      written, changed_biobank_ids = biobank_samples_pipeline._upsert_samples_from_file(
+          StringIO.StringIO(samples_file), self._make_checkpoint())
+
+    self.assertEquals(2, written)
+    self.assertEquals(set([11, 33]), changed_biobank_ids)
+    self.assertEquals(set([11, 33]),
+                      set(sample.biobankId for sample in BiobankStoredSampleDao().get_all()))
+    mock_logging.error.assert_called_once_with(
+        'Bio bank Id (22) does not exist in the Participant table.')
+
+  def test_upsert_resumes_from_checkpoint(self):
+    for participant_id, biobank_id in ((1, 11), (2, 22), (3, 33)):
+      self.participant_dao.insert(Participant(participantId=participant_id, biobankId=biobank_id))
+    samples_file = test_data.open_biobank_samples([11, 22, 33], ['1ED10', '1ED10', '1ED10'])
+    header, first_row = samples_file.split('\n')[:2]
+    checkpoint = self._make_checkpoint()
+    checkpoint.save(len(header) + len(first_row) + 2, 1, set([11]))
+
+    written, changed_biobank_ids = biobank_samples_pipeline._upsert_samples_from_file(
+        StringIO.StringIO(samples_file), checkpoint)
+
+    self.assertEquals(3, written)
+    self.assertEquals(set([11, 22, 33]), changed_biobank_ids)
+    self.assertEquals(set([22, 33]),
+                      set(sample.biobankId for sample in BiobankStoredSampleDao().get_all()))
+    self.assertEquals((len(samples_file), 3, set([11, 22, 33])), checkpoint.load())
+    checkpoint.delete()
+    self.assertIsNone(checkpoint.load())
+
+  def test_central_to_naive_utc_matches_pytz(self):
+    central = pytz.timezone('US/Central')
+    # Covers both 2018 daylight saving time changes, including the skipped and repeated hours.
+    local_time = datetime.datetime(2018, 3, 10, 0, 30, 15)
+    while local_time < datetime.datetime(2018, 11, 5):
+      self.assertEquals(
+          central.localize(local_time).astimezone(pytz.utc).replace(tzinfo=None),
+          biobank_samples_pipeline._central_to_naive_utc(local_time))
+      local_time += datetime.timedelta(minutes=30)
 
   def test_get_reconciliation_report_paths(self):
     dt = datetime.datetime(2016, 12, 22, 18, 30, 45)
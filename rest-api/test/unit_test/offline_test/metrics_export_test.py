@@ -1,7 +1,10 @@
 from __future__ import print_function
 
+import collections
 import datetime
 import json
+import shutil
+import tempfile
 
 import offline.metrics_export
 from clock import FakeClock
@@ -23,6 +26,10 @@ from model.participant import Participant
 from offline.metrics_config import ANSWER_FIELD_TO_QUESTION_CODE, get_participant_fields, \
   HPO_ID_FIELDS, ANSWER_FIELDS
 from offline.metrics_export import MetricsExport, _HPO_IDS_CSV, _PARTICIPANTS_CSV, _ANSWERS_CSV
+from offline.metrics_pipeline import map_csv_to_participant_and_date_metric, \
+  reduce_participant_data_to_hpo_metric_date_deltas, \
+  reduce_participant_data_to_hpo_metric_date_deltas_batched
+from offline.metrics_pipeline_local import LocalMetricsPipeline
 from offline_test.gcs_utils import assertCsvContents
 from participant_enums import WithdrawalStatus, make_primary_provider_link_for_name, \
   WithdrawalReason
@@ -734,6 +741,60 @@ class MetricsExportTest(CloudStorageSqlTestBase, FlaskTestBase):
     # There is a biobank order on 1/4, but it gets ignored since it's after the run date.
     self.assertBucket(bucket_map, TIME_4, '')
 
+  def test_local_metrics_pipeline_matches_mapreduce(self):
+    self._create_data()
+    with FakeClock(TIME_3):
+      MetricsExport.start_export_tasks(BUCKET_NAME, 2)
+      run_deferred_tasks(self)
+    with FakeClock(TIME_4):
+      test_support.execute_until_empty(self.taskqueue)
+    mapreduce_version_id = MetricsVersionDao().get_serving_version().metricsVersionId
+
+    directory = tempfile.mkdtemp()
+    try:
+      with FakeClock(TIME_4 + datetime.timedelta(hours=1)):
+        input_paths = MetricsExport.export_to_directory(directory, 2)
+        # A small spill limit and more partitions than shards, so keys are merged across runs.
+        results = LocalMetricsPipeline(partitions=3, spill_pairs=5).run(input_paths, TIME_4)
+    finally:
+      shutil.rmtree(directory)
+
+    self.assertEquals(['Process Input CSV', 'Calculate Counts', 'Write Metrics'],
+                      [result.name for result in results])
+    self.assertTrue(all(result.runs > 3 for result in results))
+    local_version = MetricsVersionDao().get_serving_version()
+    self.assertNotEquals(mapreduce_version_id, local_version.metricsVersionId)
+    self.assertEquals(self._get_bucket_metrics(mapreduce_version_id),
+                      self._get_bucket_metrics(local_version.metricsVersionId))
+
+  def test_batched_delta_reducer_matches_reducer(self):
+    self._create_data()
+    directory = tempfile.mkdtemp()
+    try:
+      with FakeClock(TIME_3):
+        input_paths = MetricsExport.export_to_directory(directory, 2)
+      participant_values = collections.defaultdict(list)
+      for path in input_paths:
+        with open(path, 'rb') as input_file:
+          for participant_id, value in map_csv_to_participant_and_date_metric(input_file):
+            participant_values[participant_id].append(value)
+    finally:
+      shutil.rmtree(directory)
+
+    self.assertEquals(['1', '2', '5', '9'], sorted(participant_values))
+    for participant_id, values in participant_values.iteritems():
+      expected = ''.join(reduce_participant_data_to_hpo_metric_date_deltas(participant_id, values,
+                                                                           now=TIME_4))
+      self.assertTrue(expected)
+      self.assertMultiLineEqual(expected, ''.join(
+          reduce_participant_data_to_hpo_metric_date_deltas_batched(participant_id, values,
+                                                                    now=TIME_4)))
+
+  @staticmethod
+  def _get_bucket_metrics(metrics_version_id):
+    buckets = MetricsVersionDao().get_with_children(metrics_version_id).buckets
+    return {(bucket.date, bucket.hpoId): json.loads(bucket.metrics) for bucket in buckets}
+
   def assertBucket(self, bucket_map, dt, hpoId, metrics=None):
     bucket = bucket_map.get((dt.date(), hpoId))
     if metrics:
@@ -1,5 +1,6 @@
 from clock import FakeClock
 import datetime
+import threading
 import unittest
 import singletons
 
@@ -37,3 +38,50 @@ class SingletonsTest(unittest.TestCase):
     with FakeClock(TIME_3):
       self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401))
 
+
+  def test_get_ttl_refresh_in_background(self):
+    with FakeClock(TIME_1):
+      self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 86401,
+                                          refresh_in_background=True))
+
+    with FakeClock(TIME_3):
+      # The expired instance is returned while the new one is constructed.
+      self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 86401,
+                                          refresh_in_background=True))
+      singletons.wait_for_refresh_for_tests(123)
+      self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401,
+                                          refresh_in_background=True))
+    self.assertEquals(1, singletons.get_stats(123)['stale_hits'])
+
+  def test_invalidate_reloads_synchronously(self):
+    self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 86401,
+                                        refresh_in_background=True))
+    singletons.invalidate(123)
+    self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401,
+                                        refresh_in_background=True))
+
+  def test_slow_constructor_does_not_block_other_indexes(self):
+    constructing = threading.Event()
+    finish = threading.Event()
+
+    def slow_constructor():
+      constructing.set()
+      finish.wait()
+      return 'slow'
+
+    thread = threading.Thread(target=singletons.get, args=(123, slow_constructor))
+    thread.start()
+    constructing.wait()
+    self.assertEquals(1, singletons.get(456, SingletonsTest.foo))
+    finish.set()
+    thread.join()
+    self.assertEquals('slow', singletons.get(123, slow_constructor))
+
+  def test_stats(self):
+    singletons.get(123, SingletonsTest.foo)
+    singletons.get(123, SingletonsTest.foo)
+    stats = singletons.get_stats(123)
+    self.assertEquals(1, stats['misses'])
+    self.assertEquals(1, stats['hits'])
+    self.assertEquals(1, stats['reloads'])
+    self.assertEquals(0, stats['blocked_waiters'])
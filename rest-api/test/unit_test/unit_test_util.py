@@ -33,6 +33,9 @@ import config
 import config_api
 import main
 import dao.base_dao
+import dao.id_reservation
+import dao.metrics_cache_dao
+import dao.questionnaire_dao
 import singletons
 
 from code_constants import PPI_SYSTEM
@@ -181,6 +184,10 @@ class _TestDb(object):
 
   def setup(self, with_data=True, with_views=False, with_consent_codes=False):
     singletons.reset_for_tests()  # Clear the db connection cache.
+    dao.base_dao.reset_total_cache_for_tests()
+    dao.metrics_cache_dao.reset_result_cache_for_tests()
+    dao.questionnaire_dao.reset_structure_cache_for_tests()
+    dao.id_reservation.reset_id_pools_for_tests()
     if self.__use_mysql:
       if 'CIRCLECI' in os.environ:
         # Default no-pw login, according to https://circleci.com/docs/1.0/manually/#databases .
@@ -795,7 +802,10 @@ def pretty(obj):
 
 @contextlib.contextmanager
 def random_ids(ids):
-  with patch('random.randint', side_effect=ids):
+  # Reserve IDs one at a time, so that each ID reserved for an insert is the next of ids.
+  dao.id_reservation.reset_id_pools_for_tests()
+  with patch('random.randint', side_effect=ids), \
+       patch('dao.id_reservation.ID_RESERVATION_BATCH_SIZE', 1):
     yield
 
 def run_deferred_tasks(test):
@@ -0,0 +1,64 @@
+"""Runs the metrics pipeline locally over MetricsExport CSVs, serially and in pools of processes.
+
+Each run writes a new MetricsVersion of buckets to the database, as the MapReduce pipeline does,
+and logs the time taken by each of its stages. The CSVs are read from --input_dir (e.g. copied from
+the metrics bucket) or, if it isn't given, exported from the database first.
+
+Usage:
+  tools/run_benchmark.sh metrics_pipeline --input_dir /tmp/metrics --processes 0,4
+"""
+
+import datetime
+import glob
+import os
+import shutil
+import tempfile
+
+from benchmark_util import Timer
+from main_util import get_parser, configure_logging
+from offline.metrics_export import MetricsExport
+from offline.metrics_pipeline_local import LocalMetricsPipeline, DEFAULT_SPILL_PAIRS
+
+
+def main(args):
+  timer = Timer()
+  export_dir = None
+  if args.input_dir:
+    input_paths = sorted(glob.glob(os.path.join(args.input_dir, '*.csv')))
+  else:
+    export_dir = tempfile.mkdtemp(prefix='metrics-export-')
+    with timer.time('export %d shards' % args.shards):
+      input_paths = MetricsExport.export_to_directory(export_dir, args.shards)
+  try:
+    now = datetime.datetime.utcnow()
+    for processes in [int(processes) for processes in args.processes.split(',')]:
+      pipeline = LocalMetricsPipeline(processes=processes, partitions=args.partitions,
+                                      spill_pairs=args.spill_pairs)
+      with timer.time('pipeline, %d processes' % processes):
+        results = pipeline.run(input_paths, now)
+      for result in results:
+        timer.timings.append(('  %s map, %d processes' % (result.name, processes),
+                              result.map_seconds))
+        timer.timings.append(('  %s reduce, %d processes' % (result.name, processes),
+                              result.reduce_seconds))
+  finally:
+    if export_dir:
+      shutil.rmtree(export_dir)
+  timer.log('Local metrics pipeline timings:')
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--input_dir', help='Directory of MetricsExport CSVs to read')
+  parser.add_argument('--shards', help='Number of shards to export, without --input_dir',
+                      type=int, default=4)
+  parser.add_argument('--processes',
+                      help='Comma-separated pool sizes to run with (0 runs serially)',
+                      default='0,4')
+  parser.add_argument('--partitions', help='Reduce tasks per stage (default: one per process)',
+                      type=int)
+  parser.add_argument('--spill_pairs',
+                      help='Mapped pairs buffered by each map task before spilling to disk',
+                      type=int, default=DEFAULT_SPILL_PAIRS)
+  main(parser.parse_args())
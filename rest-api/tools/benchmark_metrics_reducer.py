@@ -0,0 +1,114 @@
+"""Times the metrics pipeline's participant delta reducers on generated participant histories.
+
+Generates values like those the first metrics MapReduce maps for each participant (HPO changes,
+questionnaire submissions, answers, samples and dates of birth), runs them through
+reduce_participant_data_to_hpo_metric_date_deltas and its batched alternative, and checks that
+both emit the same bytes. Nothing is read from or written to the database.
+
+Usage:
+  tools/run_benchmark.sh metrics_reducer --participants 1000000
+"""
+
+import datetime
+import json
+import logging
+import os
+import random
+
+import config
+from benchmark_util import Timer
+from code_constants import CONSENT_PERMISSION_YES_CODE, CONSENT_PERMISSION_NO_CODE, PMI_SKIP_CODE
+from dao.database_utils import format_datetime
+from field_mappings import NON_EHR_QUESTIONNAIRE_MODULE_FIELD_NAMES
+from main_util import get_parser, configure_logging
+from offline import metrics_pipeline
+from offline.metrics_config import HPO_ID_METRIC, RACE_METRIC, CENSUS_REGION_METRIC, \
+  PHYSICAL_MEASUREMENTS_METRIC, SAMPLES_TO_ISOLATE_DNA_METRIC, BIOSPECIMEN_METRIC, \
+  BIOSPECIMEN_SAMPLES_METRIC, EHR_CONSENT_ANSWER_METRIC, SPECIMEN_COLLECTED_VALUE, \
+  SAMPLES_ARRIVED_VALUE, SUBMITTED_VALUE
+from participant_enums import Race, PhysicalMeasurementsStatus, SampleStatus
+
+_BASE_CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config', 'base_config.json')
+_HPOS = ['PITT', 'AZ_TUCSON', 'COLUMBIA', 'UNSET']
+_GENDER_IDENTITIES = ['GenderIdentity_Man', 'GenderIdentity_Woman', PMI_SKIP_CODE]
+_STATES = ['PIIState_AZ', 'PIIState_PA', 'PIIState_NY', PMI_SKIP_CODE]
+_START_TIME = datetime.datetime(2017, 5, 1)
+
+
+def _make_participant_values(rand):
+  """Returns the date|metric and DOB|date values mapped for a generated participant."""
+  sign_up = _START_TIME + datetime.timedelta(seconds=rand.randint(0, 3 * 10 ** 7))
+
+  def value(metric_name, metric_value, max_days=200):
+    dt = sign_up + datetime.timedelta(seconds=rand.randint(0, max_days * 86400))
+    return metrics_pipeline.make_tuple(format_datetime(dt),
+                                       metrics_pipeline.make_metric(metric_name, metric_value))
+
+  values = [value(HPO_ID_METRIC, rand.choice(_HPOS), max_days=0)]
+  values.extend(value(HPO_ID_METRIC, rand.choice(_HPOS)) for _ in range(rand.choice([0, 0, 1, 2])))
+  if rand.random() < 0.8:
+    values.append(metrics_pipeline.make_tuple(
+        metrics_pipeline.DATE_OF_BIRTH_PREFIX,
+        (datetime.date(1930, 1, 1) + datetime.timedelta(days=rand.randint(0, 25000))).isoformat()))
+  for field_name in NON_EHR_QUESTIONNAIRE_MODULE_FIELD_NAMES:
+    if rand.random() < 0.6:
+      values.append(value(field_name, SUBMITTED_VALUE))
+  if rand.random() < 0.6:
+    values.append(value(EHR_CONSENT_ANSWER_METRIC,
+                        rand.choice([CONSENT_PERMISSION_YES_CODE, CONSENT_PERMISSION_NO_CODE])))
+  if rand.random() < 0.5:
+    values.append(value(PHYSICAL_MEASUREMENTS_METRIC, str(PhysicalMeasurementsStatus.COMPLETED)))
+  if rand.random() < 0.4:
+    values.append(value(SAMPLES_TO_ISOLATE_DNA_METRIC, str(SampleStatus.RECEIVED)))
+  if rand.random() < 0.5:
+    values.append(value(BIOSPECIMEN_METRIC, SPECIMEN_COLLECTED_VALUE))
+  if rand.random() < 0.4:
+    values.append(value(BIOSPECIMEN_SAMPLES_METRIC, SAMPLES_ARRIVED_VALUE))
+  if rand.random() < 0.7:
+    values.append(value(RACE_METRIC, str(rand.choice(list(Race)))))
+  if rand.random() < 0.7:
+    values.append(value('genderIdentity', rand.choice(_GENDER_IDENTITIES)))
+  if rand.random() < 0.7:
+    values.append(value('state', rand.choice(_STATES)))
+    values.append(value(CENSUS_REGION_METRIC, rand.choice(['WEST', 'NORTHEAST', PMI_SKIP_CODE])))
+  rand.shuffle(values)
+  return values
+
+
+def _reduce_all(reducer, participants, now):
+  return [''.join(reducer(str(participant_id), values, now=now))
+          for participant_id, values in enumerate(participants)]
+
+
+def main(args):
+  # The summary fields read the baseline modules from config, which isn't available here.
+  with open(_BASE_CONFIG_PATH) as config_file:
+    config.override_setting(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, json.load(config_file)[
+        config.BASELINE_PPI_QUESTIONNAIRE_FIELDS])
+  rand = random.Random(args.seed)
+  now = datetime.datetime(2018, 12, 1)
+  timer = Timer()
+  with timer.time('generate %d participants' % args.participants):
+    participants = [_make_participant_values(rand) for _ in xrange(args.participants)]
+  with timer.time('reduce'):
+    expected = _reduce_all(metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas,
+                           participants, now)
+  with timer.time('reduce, batched'):
+    actual = _reduce_all(
+        metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas_batched,
+        participants, now)
+  for participant_id, (expected_output, actual_output) in enumerate(zip(expected, actual)):
+    if expected_output != actual_output:
+      raise AssertionError('Outputs differ for participant %d.' % participant_id)
+  logging.info('Reduced %d delta lines.', sum(output.count('\n') for output in expected))
+  timer.log('Participant delta reducer timings:')
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--participants', help='Number of participants to generate', type=int,
+                      default=100000)
+  parser.add_argument('--seed', help='Random seed for generated participants', type=int,
+                      default=1)
+  main(parser.parse_args())
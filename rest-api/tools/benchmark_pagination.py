@@ -0,0 +1,63 @@
+"""Compares or-of-ands and row value pagination filters for ParticipantSummaryDao.query by page depth.
+
+Pages through participant_summary ordered by lastModified (as the _sync API does), timing each page
+with both pagination modes.
+
+Usage:
+  tools/run_benchmark.sh pagination --seed 200000 --page_size 5000
+"""
+
+import logging
+
+from benchmark_util import time_call, seed_participant_summaries, \
+  delete_seeded_participant_summaries
+from dao.participant_summary_dao import ParticipantSummaryDao
+from main_util import get_parser, configure_logging
+from query import Query, OrderBy
+
+
+def _page_timings(dao, page_size, max_pages):
+  timings = []
+  token = None
+  for _ in range(max_pages):
+    query = Query([], OrderBy('lastModified', True), page_size, token, always_return_token=True)
+    query.backfill_sync = False
+    elapsed, results = time_call(lambda: dao.query(query))
+    timings.append(elapsed)
+    if not results.more_available:
+      break
+    token = results.pagination_token
+  return timings
+
+
+def main(args):
+  if args.seed:
+    seed_participant_summaries(args.seed)
+  try:
+    dao = ParticipantSummaryDao()
+    dao.use_row_value_pagination = False
+    or_of_ands_timings = _page_timings(dao, args.page_size, args.max_pages)
+    dao.use_row_value_pagination = True
+    row_value_timings = _page_timings(dao, args.page_size, args.max_pages)
+  finally:
+    if args.seed and not args.keep_seeded:
+      delete_seeded_participant_summaries()
+
+  logging.info('%6s %16s %16s', 'page', 'or_of_ands (ms)', 'row_value (ms)')
+  for page, (or_of_ands, row_value) in enumerate(zip(or_of_ands_timings, row_value_timings)):
+    logging.info('%6d %16.1f %16.1f', page, or_of_ands * 1000, row_value * 1000)
+  logging.info('%6s %16.1f %16.1f', 'total', sum(or_of_ands_timings) * 1000,
+               sum(row_value_timings) * 1000)
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--seed', help='Number of participant summaries to seed before running',
+                      type=int, default=0)
+  parser.add_argument('--keep_seeded', help='Leave seeded rows in the database afterwards',
+                      action='store_true')
+  parser.add_argument('--page_size', help='Results per page', type=int, default=5000)
+  parser.add_argument('--max_pages', help='Maximum number of pages to fetch', type=int,
+                      default=100)
+  main(parser.parse_args())
@@ -0,0 +1,108 @@
+"""Times parsing of a generated Biobank samples CSV, serially and in pools of processes.
+
+Also compares converting the CSV's US/Central timestamps to UTC with strptime and pytz for every
+value against the pipeline's parsing with cached UTC offsets. Nothing is written to the database.
+
+Usage:
+  tools/run_benchmark.sh sample_parse --rows 1000000 --processes 0,2,4
+"""
+
+import datetime
+import multiprocessing
+import os
+import tempfile
+
+import pytz
+
+from benchmark_util import Timer
+from code_constants import BIOBANK_TESTS
+from main_util import get_parser, configure_logging
+from offline import biobank_samples_pipeline
+from offline.biobank_samples_pipeline import CsvColumns
+
+_BIOBANK_ID_PREFIX = 'Z'
+_START_TIME = datetime.datetime(2017, 1, 1)
+
+
+def _write_samples_csv(csv_file, num_rows):
+  columns = CsvColumns.ALL
+  csv_file.write('\t'.join(columns) + '\n')
+  for i in xrange(num_rows):
+    confirmed = (_START_TIME + datetime.timedelta(minutes=7 * i)).strftime(
+        biobank_samples_pipeline._INPUT_TIMESTAMP_FORMAT)
+    values = {
+      CsvColumns.SAMPLE_ID: 'BENCH%d' % i,
+      CsvColumns.PARENT_ID: '',
+      CsvColumns.CONFIRMED_DATE: confirmed,
+      CsvColumns.EXTERNAL_PARTICIPANT_ID: '%s%d' % (_BIOBANK_ID_PREFIX, 100000000 + i // 10),
+      CsvColumns.BIOBANK_ORDER_IDENTIFIER: 'KIT-%d' % (i // 10),
+      CsvColumns.TEST_CODE: BIOBANK_TESTS[i % len(BIOBANK_TESTS)],
+      CsvColumns.CREATE_DATE: confirmed,
+      CsvColumns.STATUS: 'In Circulation',
+      CsvColumns.DISPOSAL_DATE: '',
+      CsvColumns.SAMPLE_FAMILY: 'F%d' % i,
+    }
+    csv_file.write('\t'.join(values[column] for column in columns) + '\n')
+
+
+def _parse_file(path, processes):
+  """Parses every batch of the file as _upsert_samples_from_file does, returning the sample count."""
+  with open(path, 'rb') as csv_file:
+    fieldnames, offset = biobank_samples_pipeline._read_fieldnames(csv_file)
+    batches = ((lines, end_offset, fieldnames, _BIOBANK_ID_PREFIX)
+               for lines, end_offset in biobank_samples_pipeline._read_batches(csv_file, offset))
+    if processes > 1:
+      pool = multiprocessing.Pool(processes)
+      try:
+        return sum(len(sample_dicts) for sample_dicts, _ in biobank_samples_pipeline._imap_in_order(
+            pool, biobank_samples_pipeline._parse_batch, batches, 2 * processes))
+      finally:
+        pool.terminate()
+    return sum(len(biobank_samples_pipeline._parse_batch(batch)[0]) for batch in batches)
+
+
+def _convert_timestamps_with_pytz(timestamps):
+  central = pytz.timezone('US/Central')
+  for timestamp in timestamps:
+    naive = datetime.datetime.strptime(timestamp, biobank_samples_pipeline._INPUT_TIMESTAMP_FORMAT)
+    central.localize(naive).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def _convert_timestamps_with_cache(timestamps):
+  for timestamp in timestamps:
+    biobank_samples_pipeline._central_to_naive_utc(
+        biobank_samples_pipeline._parse_naive_timestamp(timestamp))
+
+
+def main(args):
+  timer = Timer()
+  timestamps = [(_START_TIME + datetime.timedelta(minutes=7 * i)).strftime(
+      biobank_samples_pipeline._INPUT_TIMESTAMP_FORMAT) for i in xrange(args.rows)]
+  with timer.time('strptime + pytz timestamps %d' % args.rows):
+    _convert_timestamps_with_pytz(timestamps)
+  with timer.time('cached offset timestamps %d' % args.rows):
+    _convert_timestamps_with_cache(timestamps)
+
+  fd, path = tempfile.mkstemp(suffix='.csv')
+  try:
+    with os.fdopen(fd, 'w') as csv_file:
+      _write_samples_csv(csv_file, args.rows)
+    for processes in [int(processes) for processes in args.processes.split(',')]:
+      with timer.time('parse %d rows, %d processes' % (args.rows, processes)):
+        num_samples = _parse_file(path, processes)
+      if num_samples != args.rows:
+        raise AssertionError('Parsed %d samples from %d rows.' % (num_samples, args.rows))
+  finally:
+    os.remove(path)
+  timer.log('Sample CSV parse timings:')
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--rows', help='Number of sample rows to generate', type=int,
+                      default=1000000)
+  parser.add_argument('--processes',
+                      help='Comma-separated pool sizes to parse with (0 parses serially)',
+                      default='0,2,4')
+  main(parser.parse_args())
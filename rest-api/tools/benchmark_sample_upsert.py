@@ -0,0 +1,87 @@
+"""Compares session.merge() and bulk INSERT ... ON DUPLICATE KEY UPDATE upserts of Biobank samples.
+
+For each sample count, upserts that many new samples (all inserts) and then the same samples with
+changed confirmed times (all updates) with each method, and logs the time taken.
+
+Usage:
+  tools/run_benchmark.sh sample_upsert --sizes 10000,100000,1000000 --batch_size 1000
+"""
+
+import datetime
+
+from benchmark_util import Timer, seed_participant_summaries, delete_seeded_participant_summaries
+from code_constants import BIOBANK_TESTS
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.database_factory import get_database
+from main_util import get_parser, configure_logging
+from model.biobank_stored_sample import BiobankStoredSample
+
+# Seeded sample IDs start with this, to stay clear of any samples already in the database.
+_SAMPLE_ID_PREFIX = 'BENCH'
+# Samples per seeded participant.
+_SAMPLES_PER_PARTICIPANT = 10
+_CONFIRMED = datetime.datetime(2019, 1, 1)
+
+
+def _make_samples(num_samples, biobank_ids, confirmed):
+  return [BiobankStoredSample(
+      biobankStoredSampleId='%s%d' % (_SAMPLE_ID_PREFIX, i),
+      biobankId=biobank_ids[i % len(biobank_ids)],
+      biobankOrderIdentifier='KIT-%d' % (i // _SAMPLES_PER_PARTICIPANT),
+      test=BIOBANK_TESTS[i % len(BIOBANK_TESTS)],
+      confirmed=confirmed)
+          for i in range(num_samples)]
+
+
+def _delete_samples():
+  get_database().get_engine().execute(BiobankStoredSample.__table__.delete().where(
+      BiobankStoredSample.biobankStoredSampleId.like(_SAMPLE_ID_PREFIX + '%')))
+
+
+def _upsert_in_batches(upsert, samples, batch_size):
+  """Upserts samples in batch_size calls, as biobank_samples_pipeline does."""
+  for start in range(0, len(samples), batch_size):
+    upsert(samples[start:start + batch_size])
+
+
+def main(args):
+  sizes = [int(size) for size in args.sizes.split(',')]
+  dao = BiobankStoredSampleDao()
+  methods = [
+    ('merge', dao._upsert_all_by_merge),
+    ('bulk', lambda samples: dao.upsert_all(samples, batch_size=args.batch_size)),
+  ]
+  biobank_ids = seed_participant_summaries(
+      max(1, max(sizes) // _SAMPLES_PER_PARTICIPANT))
+  timer = Timer()
+  try:
+    for size in sizes:
+      if args.skip_merge_over and size > args.skip_merge_over:
+        size_methods = [method for method in methods if method[0] != 'merge']
+      else:
+        size_methods = methods
+      for name, upsert in size_methods:
+        _delete_samples()
+        new_samples = _make_samples(size, biobank_ids, _CONFIRMED)
+        with timer.time('%s insert %d' % (name, size)):
+          _upsert_in_batches(upsert, new_samples, args.batch_size)
+        changed_samples = _make_samples(size, biobank_ids, _CONFIRMED + datetime.timedelta(days=1))
+        with timer.time('%s update %d' % (name, size)):
+          _upsert_in_batches(upsert, changed_samples, args.batch_size)
+  finally:
+    _delete_samples()
+    delete_seeded_participant_summaries()
+  timer.log('Sample upsert timings (batch size %d):' % args.batch_size)
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--sizes', help='Comma-separated numbers of samples to upsert',
+                      default='10000,100000,1000000')
+  parser.add_argument('--batch_size', help='Samples per upsert_all call and INSERT statement',
+                      type=int, default=1000)
+  parser.add_argument('--skip_merge_over',
+                      help='Only time the bulk upsert for sample counts over this', type=int,
+                      default=0)
+  main(parser.parse_args())
@@ -0,0 +1,61 @@
+"""Compares converting participant summaries to client JSON field by field (with the reference
+conversion in test/participant_summary_json.py) and with the precomputed plans used by
+ParticipantSummaryDao.to_client_json_list.
+
+Converts pages of summaries as the ParticipantSummary API does, and checks that both paths produce
+the same output.
+
+Usage:
+  tools/run_benchmark.sh summary_json --seed 20000 --page_size 5000
+"""
+
+import logging
+
+from benchmark_util import time_call, seed_participant_summaries, \
+  delete_seeded_participant_summaries
+from dao.participant_summary_dao import ParticipantSummaryDao
+from main_util import get_parser, configure_logging
+from query import Query, OrderBy
+from test.participant_summary_json import to_client_json_by_field
+
+
+def main(args):
+  if args.seed:
+    seed_participant_summaries(args.seed)
+  try:
+    dao = ParticipantSummaryDao()
+    query = Query([], OrderBy('participantId', True), args.page_size, None)
+    summaries = dao.query(query).items
+  finally:
+    if args.seed and not args.keep_seeded:
+      delete_seeded_participant_summaries()
+  if not summaries:
+    logging.error('No participant summaries to convert; use --seed.')
+    return
+
+  by_field_seconds, by_field_json = time_call(
+      lambda: [to_client_json_by_field(dao, summary) for summary in summaries], args.repeat)
+  planned_seconds, planned_json = time_call(lambda: dao.to_client_json_list(summaries),
+                                            args.repeat)
+  if by_field_json != planned_json:
+    logging.error('Outputs differ!')
+
+  logging.info('Converted %d summaries (best of %d runs):', len(summaries), args.repeat)
+  logging.info('  %-12s %10.1f ms %10.1f us/row', 'by field', by_field_seconds * 1000,
+               by_field_seconds * 1e6 / len(summaries))
+  logging.info('  %-12s %10.1f ms %10.1f us/row', 'planned', planned_seconds * 1000,
+               planned_seconds * 1e6 / len(summaries))
+  logging.info('  speedup      %10.1fx', by_field_seconds / planned_seconds)
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--seed', help='Number of participant summaries to seed before running',
+                      type=int, default=0)
+  parser.add_argument('--keep_seeded', help='Leave seeded rows in the database afterwards',
+                      action='store_true')
+  parser.add_argument('--page_size', help='Summaries to convert', type=int, default=5000)
+  parser.add_argument('--repeat', help='Number of runs to take the best time from', type=int,
+                      default=5)
+  main(parser.parse_args())
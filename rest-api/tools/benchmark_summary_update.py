@@ -0,0 +1,132 @@
+"""Times applying questionnaire responses to participant summaries, as
+QuestionnaireResponseDao._update_participant_summary does when responses are inserted.
+
+Inserts the questionnaire in test/test-data/all_consents_questionnaire.json (adding its codes),
+generates responses answering its questions and applies them to participant summaries in memory,
+with the questionnaire's answer dispatch table compiled once (as on the server) and compiled again
+for every response. Checks that both produce the same summaries. Only the questionnaire and its
+codes are written to the database.
+
+Usage:
+  tools/run_benchmark.sh summary_update --responses 10000
+"""
+
+import json
+import logging
+import os
+import random
+import time
+
+import clock
+import config
+from benchmark_util import SEED_PARTICIPANT_ID_START
+from dao.code_dao import CodeDao
+from dao.questionnaire_dao import QuestionnaireDao, QuestionnaireHistoryDao
+from dao.questionnaire_response_dao import QuestionnaireResponseDao, _ParticipantSummaryUpdate
+from main_util import get_parser, configure_logging
+from model.code import CodeType
+from model.participant import Participant
+from model.participant_summary import ParticipantSummary
+from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from participant_enums import WithdrawalStatus, SuspensionStatus
+
+_QUESTIONNAIRE_PATH = os.path.join(os.path.dirname(__file__), '..', 'test', 'test-data',
+                                   'all_consents_questionnaire.json')
+
+
+def _insert_questionnaire():
+  """Inserts the questionnaire, returning its structure and {linkId: [option code IDs]}."""
+  with open(_QUESTIONNAIRE_PATH) as questionnaire_file:
+    resource_json = json.load(questionnaire_file)
+  config.override_setting(config.ADD_QUESTIONNAIRE_CODES_IF_MISSING, [True])
+  dao = QuestionnaireDao()
+  questionnaire = dao.insert(QuestionnaireDao.from_client_json(resource_json))
+  code_dao = CodeDao()
+  option_code_ids = {}
+  for question in resource_json['group']['question']:
+    code_id_map = code_dao.get_or_add_codes({
+        (option['system'], option['code']): (option.get('display'), CodeType.ANSWER, None)
+        for option in question.get('option', [])})
+    option_code_ids[question['linkId']] = code_id_map.values()
+  with dao.session() as session:
+    structure = QuestionnaireHistoryDao().get_structure_with_session(
+        session, [questionnaire.questionnaireId, questionnaire.version])
+  return structure, option_code_ids
+
+
+def _make_responses(structure, option_code_ids, num_responses, rand):
+  now = clock.CLOCK.now()
+  responses = []
+  for i in range(num_responses):
+    response = QuestionnaireResponse(questionnaireId=structure.questionnaireId,
+                                     questionnaireVersion=structure.version,
+                                     participantId=SEED_PARTICIPANT_ID_START + i,
+                                     created=now, authored=now,
+                                     resource=json.dumps({'resourceType': 'QuestionnaireResponse'}))
+    for question in structure.questions_by_id.itervalues():
+      response.answers.append(QuestionnaireResponseAnswer(
+          questionId=question.questionnaireQuestionId,
+          valueCodeId=rand.choice(option_code_ids[question.linkId])))
+    responses.append(response)
+  return responses
+
+
+def _make_summary_update(participant_id):
+  participant = Participant(participantId=participant_id, biobankId=participant_id)
+  participant.participantSummary = ParticipantSummary(
+      participantId=participant_id, biobankId=participant_id, firstName='First',
+      lastName='Last', email='first.last@example.com',
+      withdrawalStatus=WithdrawalStatus.NOT_WITHDRAWN,
+      suspensionStatus=SuspensionStatus.NOT_SUSPENDED)
+  return _ParticipantSummaryUpdate(participant)
+
+
+def _time_updates(structure, responses, recompile, repeat):
+  """Returns the best time over repeat runs of applying the responses to new summaries, and the
+  summaries from the last run."""
+  dao = QuestionnaireResponseDao()
+  question_code_ids = [question.codeId for question in structure.questions_by_id.itervalues()]
+  resource_jsons = [json.loads(response.resource) for response in responses]
+  best = None
+  for _ in range(repeat):
+    updates = [_make_summary_update(response.participantId) for response in responses]
+    structure.answer_dispatch = None
+    start = time.time()
+    for update, response, resource_json in zip(updates, responses, resource_jsons):
+      if recompile:
+        structure.answer_dispatch = None
+      dao._update_participant_summary(update, response, list(question_code_ids), structure,
+                                      resource_json)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, [update.participant_summary.asdict() for update in updates]
+
+
+def main(args):
+  structure, option_code_ids = _insert_questionnaire()
+  responses = _make_responses(structure, option_code_ids, args.responses, random.Random(args.seed))
+
+  compiled_seconds, compiled_summaries = _time_updates(structure, responses, False, args.repeat)
+  recompiled_seconds, recompiled_summaries = _time_updates(structure, responses, True,
+                                                           args.repeat)
+  if compiled_summaries != recompiled_summaries:
+    logging.error('Summaries differ!')
+
+  logging.info('Applied %d responses with %d answers each (best of %d runs):', len(responses),
+               len(structure.questions_by_id), args.repeat)
+  logging.info('  %-12s %10.1f ms %10.1f us/response', 'compiled', compiled_seconds * 1000,
+               compiled_seconds * 1e6 / len(responses))
+  logging.info('  %-12s %10.1f ms %10.1f us/response', 'recompiled', recompiled_seconds * 1000,
+               recompiled_seconds * 1e6 / len(responses))
+  logging.info('  speedup      %10.1fx', recompiled_seconds / compiled_seconds)
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--responses', help='Number of questionnaire responses to apply', type=int,
+                      default=10000)
+  parser.add_argument('--repeat', help='Number of runs to take the best time from', type=int,
+                      default=5)
+  parser.add_argument('--seed', help='Random seed for generated answers', type=int, default=1)
+  main(parser.parse_args())
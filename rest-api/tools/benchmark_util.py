@@ -0,0 +1,114 @@
+"""Shared helpers for the tools/benchmark_*.py scripts.
+
+Benchmarks run against the database named by DB_CONNECTION_STRING, which should be a scratch local
+database (see tools/run_benchmark.sh); seeding writes directly to its tables.
+"""
+
+import datetime
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from dao.database_factory import get_database
+from model.hpo import HPO
+from model.participant import Participant
+from model.participant_summary import ParticipantSummary
+from participant_enums import UNSET_HPO_ID, WithdrawalStatus, SuspensionStatus, \
+  EnrollmentStatus, OrganizationType
+
+# Participant IDs used by seeded rows start here, to stay clear of any rows already in the database.
+SEED_PARTICIPANT_ID_START = 100000000
+_SEED_BATCH_SIZE = 5000
+_SEED_START_TIME = datetime.datetime(2018, 1, 1)
+
+
+class Timer(object):
+  """Records the wall clock duration of named steps."""
+
+  def __init__(self):
+    self.timings = []
+
+  @contextmanager
+  def time(self, label):
+    start = time.time()
+    yield
+    self.timings.append((label, time.time() - start))
+
+  def log(self, title):
+    logging.info(title)
+    for label, seconds in self.timings:
+      logging.info('  %-40s %10.1f ms', label, seconds * 1000)
+
+
+def time_call(func, repeat=1):
+  """Returns the best wall clock time in seconds over repeat calls of func, and its last result."""
+  best = None
+  result = None
+  for _ in range(repeat):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+
+def seed_participant_summaries(num_participants, seed=1):
+  """Bulk inserts num_participants participants with summaries, using Core inserts.
+
+  Returns the list of participant IDs inserted.
+  """
+  rand = random.Random(seed)
+  engine = get_database().get_engine()
+  if not engine.execute(HPO.__table__.select().where(HPO.hpoId == UNSET_HPO_ID)).first():
+    engine.execute(HPO.__table__.insert(), hpo_id=UNSET_HPO_ID, name='UNSET',
+                   display_name='Unset', organization_type=OrganizationType.UNSET)
+  participant_ids = []
+  for batch_start in range(0, num_participants, _SEED_BATCH_SIZE):
+    participants = []
+    summaries = []
+    for i in range(batch_start, min(batch_start + _SEED_BATCH_SIZE, num_participants)):
+      participant_id = SEED_PARTICIPANT_ID_START + i
+      last_modified = _SEED_START_TIME + datetime.timedelta(seconds=rand.randint(0, 10 ** 8))
+      participants.append({
+        'participantId': participant_id,
+        'biobankId': participant_id,
+        'version': 1,
+        'lastModified': last_modified,
+        'signUpTime': last_modified,
+        'hpoId': UNSET_HPO_ID,
+        'withdrawalStatus': WithdrawalStatus.NOT_WITHDRAWN,
+        'suspensionStatus': SuspensionStatus.NOT_SUSPENDED,
+      })
+      summaries.append({
+        'participantId': participant_id,
+        'biobankId': participant_id,
+        'lastModified': last_modified,
+        'firstName': 'First%d' % rand.randint(0, 1000),
+        'lastName': 'Last%d' % rand.randint(0, 1000),
+        'dateOfBirth': datetime.date(1940, 1, 1) + datetime.timedelta(days=rand.randint(0, 20000)),
+        'hpoId': UNSET_HPO_ID,
+        'enrollmentStatus': EnrollmentStatus.INTERESTED,
+        'withdrawalStatus': WithdrawalStatus.NOT_WITHDRAWN,
+        'suspensionStatus': SuspensionStatus.NOT_SUSPENDED,
+      })
+      participant_ids.append(participant_id)
+    engine.execute(Participant.__table__.insert(), [_to_columns(Participant, p)
+                                                    for p in participants])
+    engine.execute(ParticipantSummary.__table__.insert(), [_to_columns(ParticipantSummary, s)
+                                                           for s in summaries])
+    logging.info('Seeded %d of %d participants.', len(participant_ids), num_participants)
+  return participant_ids
+
+
+def delete_seeded_participant_summaries():
+  engine = get_database().get_engine()
+  engine.execute(ParticipantSummary.__table__.delete().where(
+      ParticipantSummary.participantId >= SEED_PARTICIPANT_ID_START))
+  engine.execute(Participant.__table__.delete().where(
+      Participant.participantId >= SEED_PARTICIPANT_ID_START))
+
+
+def _to_columns(model_type, field_values):
+  """Converts a dict keyed by model field names into one keyed by column names."""
+  return {getattr(model_type, k).property.columns[0].name: v for k, v in field_values.iteritems()}
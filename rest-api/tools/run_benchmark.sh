@@ -0,0 +1,22 @@
+#!/bin/bash -e
+
+# Runs one of the tools/benchmark_*.py scripts against the local database.
+# The benchmarks seed and delete their own rows, so point them at a scratch database.
+
+USAGE="tools/run_benchmark.sh <name, e.g. pagination> [benchmark args]"
+NAME=$1
+if [ -z "${NAME}" ]
+then
+  echo "Usage: $USAGE"
+  exit 1
+fi
+shift
+
+if [ -z "${DB_CONNECTION_STRING}" ]
+then
+  source tools/setup_local_vars.sh
+  set_local_db_connection_string
+fi
+
+source tools/set_path.sh
+python tools/benchmark_${NAME}.py "$@"